@@ -0,0 +1,281 @@
+# bench_pipeline.py
+
+# Pushes N synthetic books through a chain of no-op filters and reports
+# throughput, end-to-end latency and filesystem operations per token.
+# Everything is built the way production builds it: the buckets come
+# from a Pipeline made from a config dict, the books are chosen from a
+# BookLedger by a Secretary and staged into the start bucket by a
+# Stager, and each filter runs in its own process, set up from the same
+# environment variables the Orchestrator would give it.  Run it before
+# and after a change to Pipe, dump_token, a token store or the polling
+# loop and compare.
+#
+# Usage: python benchmarks/bench_pipeline.py [--tokens 1000 10000 100000]
+#            [--stages 3] [--delay 0] [--wakeup inotify] [--durability none]
+#            [--codec json] [--store directory|sqlite] [--shards 0]
+#            [--batch-size 1] [--concurrency 1] [--ops]
+#        (run with src/ on PYTHONPATH)
+#
+# Filesystem operations are counted by wrapping the os functions the
+# pipeline reaches the filesystem through (open, rename, replace, stat,
+# scandir, listdir, unlink, utime, fsync, mkdir) in every filter
+# process; --ops breaks the total down by function.  SQLite's own I/O
+# happens below Python and is not counted.
+
+import argparse
+import builtins
+import collections
+import csv
+import io
+import multiprocessing
+import os
+import signal
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from pipeline.book_ledger import BookLedger
+from pipeline.plumbing import Filter, Pipeline, Token
+from pipeline.secretary import Secretary
+from pipeline.stager import Stager
+from pipeline.token_bag import TokenBag
+from utils.shard_buckets import reshard
+
+COUNTED = [
+    "open",
+    "rename",
+    "replace",
+    "stat",
+    "lstat",
+    "scandir",
+    "listdir",
+    "unlink",
+    "utime",
+    "fsync",
+    "mkdir",
+]
+
+
+def count_fs_ops() -> collections.Counter:
+    """Wrap the os functions that touch the filesystem so each call is counted.
+
+    Returns:
+        collections.Counter: Calls so far, by function; it keeps counting
+    """
+    counts: collections.Counter = collections.Counter()
+
+    def counting(name, func):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    for name in COUNTED:
+        setattr(os, name, counting(name, getattr(os, name)))
+    # Path.open and open() reach the filesystem through io.open
+    builtins.open = io.open = counting("open", io.open)
+    return counts
+
+
+class NoOp(Filter):
+    """Stands in for a real stage, like Mover without the files.
+
+    Attributes:
+        delay (float): Seconds to sleep over each token
+        last (bool): Whether this is the final stage, which stamps each
+                     token with the time it finished
+    """
+
+    def __init__(self, pipe, delay: float = 0, last: bool = False, **kwargs) -> None:
+        super().__init__(pipe, **kwargs)
+        self.delay = delay
+        self.last = last
+
+    def validate_token(self, token: Token) -> bool:
+        return True
+
+    def process_token(self, token: Token) -> bool:
+        if self.delay:
+            time.sleep(self.delay)
+        if self.last:
+            token.put_prop("finished_at", time.time())
+        return True
+
+    def process_batch(self, tokens: list[Token]) -> list[bool]:
+        return [self.process_token(token) for token in tokens]
+
+
+def make_config(root: Path, stages: int, args) -> dict:
+    names = ["start"] + [f"stage{n}" for n in range(1, stages)] + ["done"]
+    config = {
+        "global": {
+            "wakeup": args.wakeup,
+            "durability": args.durability,
+            "token_codec": args.codec,
+            "poll_interval": args.poll_interval,
+        },
+        "buckets": [{"name": name, "path": str(root / name)} for name in names],
+        "filters": [
+            {
+                "name": f"noop{n}",
+                "batch_size": args.batch_size,
+                "concurrency": args.concurrency,
+                "pipe": {"in": names[n], "out": names[n + 1]},
+            }
+            for n in range(stages)
+        ],
+    }
+    if args.store == "sqlite":
+        config["global"]["token_store"] = str(root / "tokens.db")
+    return config
+
+
+def filter_env(config: dict, filt: dict) -> dict:
+    """The environment the Orchestrator would start this filter with."""
+    settings = config["global"]
+    env = {
+        "WAKEUP": settings["wakeup"],
+        "DURABILITY": settings["durability"],
+        "TOKEN_CODEC": settings["token_codec"],
+        "BATCH_SIZE": str(filt["batch_size"]),
+        "CONCURRENCY": str(filt["concurrency"]),
+    }
+    if "token_store" in settings:
+        env["TOKEN_STORE"] = settings["token_store"]
+    return env
+
+
+def run_filter(config: dict, index: int, delay: float, results) -> None:
+    filt = config["filters"][index]
+    os.environ.update(filter_env(config, filt))
+    counts = count_fs_ops()
+    # the child builds its own Pipeline, and so its own store connections
+    pipeline = Pipeline(config)
+    pipe = pipeline.pipe(filt["pipe"]["in"], filt["pipe"]["out"])
+    noop = NoOp(
+        pipe,
+        delay,
+        last=index == len(config["filters"]) - 1,
+        poll_interval=config["global"]["poll_interval"],
+    )
+    signal.signal(signal.SIGTERM, lambda *_: noop.stop())
+    noop.run_forever()
+    results.put(dict(counts))
+
+
+def seed(config: dict, root: Path, n: int) -> None:
+    """Choose n books from a ledger and stage them, as the Manager does."""
+    ledger_file = root / "ledger.csv"
+    with ledger_file.open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["barcode", "date_chosen", "date_completed", "status"])
+        for i in range(n):
+            writer.writerow([f"3210107{i:07d}", "", "", ""])
+    bag_dir = root / "token_bag"
+    bag_dir.mkdir()
+
+    pipeline = Pipeline(config)
+    secretary = Secretary(TokenBag(bag_dir), BookLedger(ledger_file))
+    secretary.choose_books(n)
+    stager = Stager(secretary, root / "processing", pipeline.bucket("start"), pipeline.store)
+    stager.update_tokens()
+    staged_at = time.time()
+    for token in secretary.bag.tokens:
+        token.put_prop("staged_at", staged_at)
+    stager.stage(commit=False)
+
+
+def measure(n: int, args) -> dict:
+    ctx = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        config = make_config(root, args.stages, args)
+        for bucket in config["buckets"]:
+            Path(bucket["path"]).mkdir()
+            if args.shards:
+                reshard(Path(bucket["path"]), args.shards)
+        pipeline = Pipeline(config)
+        done = pipeline.bucket("done")
+
+        results = ctx.Queue()
+        procs = [
+            ctx.Process(target=run_filter, args=(config, i, args.delay, results), daemon=True)
+            for i in range(args.stages)
+        ]
+        for p in procs:
+            p.start()
+        time.sleep(0.5)  # let the filters set up their watchers
+
+        start = time.monotonic()
+        seed(config, root, n)
+        seeded = time.monotonic()
+        try:
+            while pipeline.store.counts(done)["waiting_tokens"] < n:
+                time.sleep(0.05)
+            finished = time.monotonic()
+        finally:
+            for p in procs:
+                p.terminate()
+            ops: collections.Counter = collections.Counter()
+            for _ in procs:
+                ops.update(results.get(timeout=args.poll_interval + 30))
+            for p in procs:
+                p.join()
+
+        latencies = []
+        for barcode in pipeline.store.barcodes(done):
+            content = pipeline.store.load(done, barcode)
+            latencies.append(content["finished_at"] - content["staged_at"])
+        latencies.sort()
+        return {
+            "seed_s": seeded - start,
+            "elapsed_s": finished - start,
+            "throughput": n / (finished - start),
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "ops": ops,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a chain of no-op filters")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--stages", type=int, default=3)
+    parser.add_argument("--delay", type=float, default=0, help="seconds each filter sleeps")
+    parser.add_argument("--wakeup", choices=["poll", "inotify"], default="inotify")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--durability", choices=["none", "fsync", "group"], default="none")
+    parser.add_argument("--codec", default="json")
+    parser.add_argument("--store", choices=["directory", "sqlite"], default="directory")
+    parser.add_argument("--shards", type=int, default=0, help="shard levels for every bucket")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--ops", action="store_true", help="break down filesystem operations")
+    args = parser.parse_args()
+
+    print(
+        f"{args.stages} stages, store {args.store}, wakeup {args.wakeup},"
+        f" durability {args.durability}, codec {args.codec}, shards {args.shards},"
+        f" batch {args.batch_size}, concurrency {args.concurrency}, delay {args.delay}s"
+    )
+    print(
+        f"{'tokens':>8} {'seed s':>8} {'total s':>8} {'tokens/s':>9}"
+        f" {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'fs ops/token':>13}"
+    )
+    for n in args.tokens:
+        r = measure(n, args)
+        ops_per_token = sum(r["ops"].values()) / n
+        print(
+            f"{n:>8} {r['seed_s']:>8.2f} {r['elapsed_s']:>8.2f} {r['throughput']:>9.1f}"
+            f" {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['max_ms']:>9.1f} {ops_per_token:>13.1f}"
+        )
+        if args.ops:
+            for name, count in r["ops"].most_common():
+                print(f"{'':>8} {name:>10} {count / n:>8.2f}/token")
+
+
+if __name__ == "__main__":
+    main()
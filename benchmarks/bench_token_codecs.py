@@ -0,0 +1,70 @@
+# bench_token_codecs.py
+
+# Compares the token codecs on a token carrying a long processing log,
+# the case where indented JSON costs the most: time to encode, time to
+# decode, and the size of the token file.
+#
+# Usage: python benchmarks/bench_token_codecs.py [--entries 200] [--rounds 2000]
+#        (run with src/ on PYTHONPATH)
+
+import argparse
+import time
+
+from pipeline import token_codecs
+
+
+def make_content(entries: int) -> dict:
+    return {
+        "barcode": "32101078166681",
+        "status": "downloaded",
+        "log": [
+            {
+                "timestamp": "2025-01-01T00:00:00.000000+00:00",
+                "level": "INFO",
+                "stage": "downloader",
+                "message": f"step {n} completed",
+            }
+            for n in range(entries)
+        ],
+    }
+
+
+def measure(codec, content: dict, rounds: int) -> tuple[float, float, int]:
+    """Time a codec.
+
+    Returns:
+        tuple[float, float, int]: Microseconds per encode and per decode,
+                                  and the encoded size in bytes
+    """
+    start = time.perf_counter()
+    for _ in range(rounds):
+        data = codec.encode(content)
+    encode_us = (time.perf_counter() - start) / rounds * 1e6
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        token_codecs.decode(data)
+    decode_us = (time.perf_counter() - start) / rounds * 1e6
+    return encode_us, decode_us, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=200, help="log entries per token")
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    content = make_content(args.entries)
+    print(f"{'codec':>8} {'encode us':>10} {'decode us':>10} {'bytes':>8}")
+    for name in token_codecs.CODECS:
+        try:
+            codec = token_codecs.get_codec(name)
+        except ImportError as e:
+            print(f"{name:>8} skipped: {e}")
+            continue
+        encode_us, decode_us, size = measure(codec, content, args.rounds)
+        print(f"{name:>8} {encode_us:>10.1f} {decode_us:>10.1f} {size:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# bench_token_latency.py
+
+# Measures how long a token takes to travel through a chain of no-op
+# filters, with the filters either polling their input buckets or
+# waiting on inotify.  Each filter runs in its own process, as it would
+# under the Orchestrator.
+#
+# Usage: python benchmarks/bench_token_latency.py [--stages 6] [--tokens 10]
+#        (run with src/ on PYTHONPATH)
+
+import argparse
+import multiprocessing
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from pipeline.plumbing import Filter, Pipe, Token, dump_token
+
+
+class NoOp(Filter):
+    def validate_token(self, token: Token) -> bool:
+        return True
+
+    def process_token(self, token: Token) -> bool:
+        return True
+
+
+def run_stage(in_path: Path, out_path: Path, poll_interval: float, wakeup: str):
+    NoOp(Pipe(in_path, out_path), poll_interval=poll_interval, wakeup=wakeup).run_forever()
+
+
+def measure(stages: int, tokens: int, poll_interval: float, wakeup: str) -> list[float]:
+    """Push tokens one at a time through the chain and time each trip.
+
+    Returns:
+        list[float]: End-to-end latency of each token in seconds
+    """
+    ctx = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        buckets = [Path(tmpdir) / f"bucket{i}" for i in range(stages + 1)]
+        for b in buckets:
+            b.mkdir()
+
+        procs = [
+            ctx.Process(
+                target=run_stage,
+                args=(buckets[i], buckets[i + 1], poll_interval, wakeup),
+                daemon=True,
+            )
+            for i in range(stages)
+        ]
+        for p in procs:
+            p.start()
+        # give the filters time to set up their watchers
+        time.sleep(0.5)
+
+        latencies = []
+        try:
+            for n in range(tokens):
+                barcode = f"bench{n}"
+                done = buckets[-1] / f"{barcode}.json"
+                staged = Path(tmpdir) / f"{barcode}.json"
+                dump_token(Token({"barcode": barcode}), staged)
+                start = time.monotonic()
+                staged.rename(buckets[0] / staged.name)
+                while not done.exists():
+                    time.sleep(0.001)
+                latencies.append(time.monotonic() - start)
+        finally:
+            for p in procs:
+                p.terminate()
+                p.join()
+        return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", type=int, default=6)
+    parser.add_argument("--tokens", type=int, default=10)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print(f"{args.stages} stages, {args.tokens} tokens, poll interval {args.poll_interval}s")
+    for wakeup in ("poll", "inotify"):
+        latencies = measure(args.stages, args.tokens, args.poll_interval, wakeup)
+        print(
+            f"{wakeup:>8}: mean {statistics.mean(latencies) * 1000:9.1f} ms"
+            f"  median {statistics.median(latencies) * 1000:9.1f} ms"
+            f"  max {max(latencies) * 1000:9.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
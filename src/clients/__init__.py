@@ -1,2 +1,3 @@
 from .grin_client import GrinClient as GrinClient
+from .grin_client import shared_grin_client as shared_grin_client
 from .object_store import S3Client as S3Client
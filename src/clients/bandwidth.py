@@ -0,0 +1,195 @@
+# bandwidth.py
+
+# One bandwidth budget for every filter on the host.  Each downloader
+# and uploader is its own process, and left alone they all fill the
+# library's link at once; the network team wants us held to a rate
+# during business hours and let loose overnight.  A Bandwidth is a token
+# bucket kept in a small state file that every process opens and locks
+# (fcntl.flock) while it draws from it, so all the filters that use the
+# same file share one rate between them.
+#
+# The rate depends on the time of day.  Profiles are tried in order and
+# the first whose window holds the current local time applies; outside
+# all of them the default rate does.  A rate of 0 means no limit:
+#
+#   bandwidth:
+#     path: /var/tmp/grin/bandwidth
+#     rate: 0
+#     profiles:
+#       - days: [mon, tue, wed, thu, fri]
+#         from: "08:00"
+#         to: "18:00"
+#         rate: 20M     # bytes per second
+#
+# A window may run past midnight ("22:00" to "06:00").  Unquoted times
+# like 18:00 are read by YAML as minutes since midnight, which is also
+# accepted.
+#
+# Bytes are drawn before they are sent or after they are received, in
+# chunks, so a process that takes more than the bucket holds goes into
+# debt and sleeps it off; those that draw after it wait their turn
+# behind the debt.  The budget counts bytes in both directions.
+
+import asyncio
+import fcntl
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from utils.sizes import parse_size
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def minute_of_day(when: str | int) -> int:
+    """Read a time of day, "HH:MM" or minutes since midnight."""
+    if isinstance(when, int):
+        return when
+    hours, minutes = when.strip().split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+class Profile:
+    """
+    A rate that applies in a window of the day, on some days of the week.
+
+    Attributes:
+        start (int): Minute of the day the window opens
+        end (int): Minute of the day it closes; before start if it runs
+                   past midnight
+        days (set[int]): Days of the week it applies on, Monday being 0
+        rate (int): Bytes per second; 0 for no limit
+    """
+
+    def __init__(self, start: str | int, end: str | int, rate, days=None) -> None:
+        self.start = minute_of_day(start)
+        self.end = minute_of_day(end)
+        self.rate = parse_size(rate or 0)
+        self.days = {DAYS.index(day.lower()[:3]) for day in days} if days else set(range(7))
+
+    @classmethod
+    def from_config(cls, profile: dict) -> "Profile":
+        return cls(profile["from"], profile["to"], profile.get("rate"), profile.get("days"))
+
+    def applies(self, when: datetime) -> bool:
+        minute = when.hour * 60 + when.minute
+        if self.start <= self.end:
+            return self.start <= minute < self.end and when.weekday() in self.days
+        # past midnight: the early hours belong to the window opened the day before
+        if minute >= self.start:
+            return when.weekday() in self.days
+        return minute < self.end and (when.weekday() - 1) % 7 in self.days
+
+
+class Bandwidth:
+    """
+    A token bucket of bytes, shared with every process using the same file.
+
+    Attributes:
+        path (Path | None): The state file; None for no limit
+        rate (int): Bytes per second outside the profiles; 0 for no limit
+        profiles (list[Profile]): Rates for windows of the day
+        burst (float): Seconds of the current rate the bucket holds
+    """
+
+    def __init__(
+        self,
+        path: Path | str | None = None,
+        rate: int | str = 0,
+        profiles: Iterable[Profile] = (),
+        burst: float = 1.0,
+    ) -> None:
+        self.path = Path(path) if path else None
+        self.rate = parse_size(rate)
+        self.profiles = list(profiles)
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._fd: int | None = None
+        self._pid: int | None = None
+
+    @classmethod
+    def from_env(cls) -> "Bandwidth":
+        """Read the budget from the environment.
+
+        Uses BANDWIDTH_FILE, BANDWIDTH_RATE and BANDWIDTH_PROFILES (a JSON
+        list of profiles), which the orchestrator sets from the
+        configuration.
+        """
+        profiles = json.loads(os.environ.get("BANDWIDTH_PROFILES") or "[]")
+        return cls(
+            path=os.environ.get("BANDWIDTH_FILE"),
+            rate=os.environ.get("BANDWIDTH_RATE", 0),
+            profiles=[Profile.from_config(p) for p in profiles],
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None and bool(self.rate or any(p.rate for p in self.profiles))
+
+    def rate_at(self, when: datetime) -> int:
+        """Bytes per second allowed at a time; 0 for no limit."""
+        for profile in self.profiles:
+            if profile.applies(when):
+                return profile.rate
+        return self.rate
+
+    def reserve(self, n: int) -> float:
+        """Draw n bytes from the bucket.
+
+        Args:
+            n (int): Bytes about to be sent, or just received
+
+        Returns:
+            float: Seconds to wait before going on
+        """
+        if n <= 0 or not self.enabled:
+            return 0.0
+        rate = self.rate_at(datetime.now())
+        if not rate:
+            return 0.0
+        capacity = rate * self.burst
+        with self._lock:
+            fd = self.state_file()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                try:
+                    state = json.loads(os.pread(fd, 256, 0))
+                    tokens, stamp = state["tokens"], state["stamp"]
+                except (ValueError, KeyError):
+                    tokens, stamp = capacity, now
+                tokens = min(capacity, tokens + max(0.0, now - stamp) * rate) - n
+                data = json.dumps({"tokens": tokens, "stamp": now}).encode()
+                os.pwrite(fd, data, 0)
+                os.ftruncate(fd, len(data))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def state_file(self) -> int:
+        # flock locks belong to an open file, which a forked child would
+        # share with its parent, so each process opens its own
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def take(self, n: int) -> None:
+        """Draw n bytes, sleeping until the budget allows them."""
+        if wait := self.reserve(n):
+            time.sleep(wait)
+
+    async def atake(self, n: int) -> None:
+        """Like take, without blocking the event loop while it waits."""
+        if wait := self.reserve(n):
+            await asyncio.sleep(wait)
+
+    def throttle(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Pass chunks through, drawing each from the budget."""
+        for chunk in chunks:
+            self.take(len(chunk))
+            yield chunk
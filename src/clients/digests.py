@@ -0,0 +1,119 @@
+# digests.py
+
+# Checksums of a book, computed as its bytes stream past rather than by
+# reading the file again: SHA-256 and MD5 for the record, and CRC32,
+# which S3 can check against the whole object even when it arrives as a
+# multipart upload.  Each stage that moves a book's bytes (downloading,
+# decrypting, uploading) updates a Digests with them; the results are
+# kept on the token under "digests", one set for the encrypted file and
+# one for the decrypted tarball:
+#
+#   "digests": {"encrypted": {"sha256": "...", "md5": "...",
+#                             "crc32": "1c291ca3", "size": 2147483648},
+#               "decrypted": {...}}
+
+import base64
+import hashlib
+import zlib
+from pathlib import Path
+from typing import Iterable, Iterator
+
+# Bytes read at a time when a file has to be digested after all
+CHUNK_SIZE = 1 << 20
+
+
+class Digests:
+    """
+    SHA-256, MD5 and CRC32 of a stream of bytes, and its length.
+
+    Attributes:
+        size (int): Bytes digested so far
+    """
+
+    def __init__(self) -> None:
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5(usedforsecurity=False)
+        self._crc32 = 0
+        self.size = 0
+
+    def update(self, data: bytes) -> None:
+        self._sha256.update(data)
+        self._md5.update(data)
+        self._crc32 = zlib.crc32(data, self._crc32)
+        self.size += len(data)
+
+    def tee(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Digest chunks on their way somewhere else."""
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    @classmethod
+    def of_file(cls, path: Path) -> "Digests":
+        """Digest a file by reading it, for when its bytes did not stream past in order."""
+        digests = cls()
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digests.update(chunk)
+        return digests
+
+    def hexdigests(self) -> dict:
+        """The digests, as kept on a token."""
+        return {
+            "sha256": self._sha256.hexdigest(),
+            "md5": self._md5.hexdigest(),
+            "crc32": f"{self._crc32:08x}",
+            "size": self.size,
+        }
+
+
+class DigestingReader:
+    """
+    A readable stream that digests what is read through it.
+
+    Attributes:
+        stream: The stream read from
+        digests (Digests): Digests of everything read so far
+    """
+
+    def __init__(self, stream, digests: Digests | None = None) -> None:
+        self.stream = stream
+        self.digests = digests or Digests()
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.stream.read(n)
+        self.digests.update(data)
+        return data
+
+
+def mismatches(expected: dict | None, actual: dict) -> list[str]:
+    """The digests that differ between two sets; none if nothing was expected.
+
+    Args:
+        expected (dict | None): Digests recorded earlier, from hexdigests()
+        actual (dict): Digests just computed, from hexdigests()
+
+    Returns:
+        list[str]: Names of the digests that differ
+    """
+    return [name for name, value in (expected or {}).items() if actual.get(name) != value]
+
+
+def s3_checksum_args(digests: dict) -> dict:
+    """Arguments for an S3 upload that has S3 check the object against digests.
+
+    S3 recomputes the CRC32 of the whole object, multipart or not, and
+    refuses the upload if it differs. The SHA-256 and MD5 are stored as
+    object metadata.
+
+    Args:
+        digests (dict): Digests of the file, from hexdigests()
+
+    Returns:
+        dict: ExtraArgs for boto3's upload_file or upload_fileobj
+    """
+    crc32 = base64.b64encode(bytes.fromhex(digests["crc32"])).decode()
+    return {
+        "ChecksumCRC32": crc32,
+        "Metadata": {"sha256": digests["sha256"], "md5": digests["md5"]},
+    }
@@ -13,8 +13,14 @@ import csv
 import functools
 import time
 import threading
+import asyncio
+import contextlib
+import importlib.util
 from dotenv import load_dotenv
+from google.auth.transport.requests import Request
 from clients.auth_util import load_creds_or_die, build_auth_header
+from clients.bandwidth import Bandwidth
+from clients.ranged_download import RangedDownload
 
 
 load_dotenv()
@@ -62,14 +68,98 @@ def table_to_dictlist(table, fields) -> list:
     return [dict(zip(fields, row)) for row in table]
 
 
+def http2_available() -> bool:
+    """Whether httpx can speak HTTP/2, which needs the h2 package."""
+    return importlib.util.find_spec("h2") is not None
+
+
+def client_settings() -> dict:
+    """Keyword arguments for the httpx clients a GrinClient keeps.
+
+    Read from the environment: GRIN_HTTP2 ("auto", "true" or "false";
+    auto uses HTTP/2 when h2 is installed), GRIN_MAX_CONNECTIONS,
+    GRIN_MAX_KEEPALIVE, GRIN_KEEPALIVE_EXPIRY (seconds an idle connection
+    is kept) and GRIN_TIMEOUT (seconds to wait to connect, or for data).
+    """
+    http2 = os.environ.get("GRIN_HTTP2", "auto").lower()
+    return {
+        "http2": http2_available() if http2 == "auto" else http2 == "true",
+        "limits": httpx.Limits(
+            max_connections=int(os.environ.get("GRIN_MAX_CONNECTIONS", 20)),
+            max_keepalive_connections=int(os.environ.get("GRIN_MAX_KEEPALIVE", 10)),
+            keepalive_expiry=float(os.environ.get("GRIN_KEEPALIVE_EXPIRY", 30)),
+        ),
+        "timeout": httpx.Timeout(float(os.environ.get("GRIN_TIMEOUT", 5))),
+        "follow_redirects": True,
+    }
+
+
+async def close_abandoned(client: httpx.AsyncClient) -> None:
+    """Close an async client whose event loop has closed.
+
+    Its connections cannot be shut down cleanly without their loop, but
+    aclose still marks the client closed and empties its pool, so nothing
+    holds the sockets and they are closed as they are collected.
+    """
+    with contextlib.suppress(RuntimeError):
+        await client.aclose()
+
+
+class GrinAuth(httpx.Auth):
+    """
+    Signs each request with a current OAuth access token.
+
+    An access token lasts about an hour, and a pooled client lasts as long
+    as its process, so the bearer header is built afresh for every
+    request, refreshing the credentials once they have expired. A 401 is
+    taken to mean the token was revoked or expired early: the credentials
+    are refreshed and the request is sent once more.
+
+    Attributes:
+        creds: The Google OAuth credentials
+    """
+
+    def __init__(self, creds) -> None:
+        self.creds = creds
+        self._lock = threading.Lock()
+
+    def auth_header(self, refresh: bool = False) -> dict:
+        with self._lock:
+            if refresh and self.creds.refresh_token:
+                self.creds.refresh(Request())
+            return build_auth_header(self.creds)
+
+    def auth_flow(self, request: httpx.Request):
+        request.headers.update(self.auth_header())
+        response = yield request
+        if response.status_code == 401:
+            request.headers.update(self.auth_header(refresh=True))
+            yield request
+
+
 class GrinClient:
+    """
+    Client for the GRIN portal.
+
+    Every request goes through one pooled httpx.Client, made on first use
+    and kept for the life of the GrinClient, so requests reuse open
+    connections (over HTTP/2 where it is available) instead of opening
+    a new one each time. The client is safe to share among threads;
+    coroutines share an httpx.AsyncClient, one per event loop. The clients
+    sign each request through GrinAuth, so a long-lived client keeps a
+    current access token.
+
+    Filters should not make a GrinClient per token: shared_grin_client()
+    gives every caller in a process the same one.
+    """
+
     def __init__(self, directory: str = "PRNC") -> None:
         load_dotenv()  # ensure .env is read
         secrets = os.environ["GOOGLE_SECRETS_FILE"]
         token = os.environ["GOOGLE_TOKEN_FILE"]
 
-        creds = load_creds_or_die(secrets, token)
-        self.auth_header = build_auth_header(creds)
+        self.creds = load_creds_or_die(secrets, token)
+        self.auth = GrinAuth(self.creds)
         # self.base_url = base_url.rstrip("/")
 
         self.base_url = "https://books.google.com/libraries"
@@ -81,6 +171,62 @@ class GrinClient:
         self._in_process = None
         self._failed = None
 
+        self._http: httpx.Client | None = None
+        self._async_clients: dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._http_lock = threading.Lock()
+
+        # shared with the other filters on the host; see clients.bandwidth
+        self.bandwidth = Bandwidth.from_env()
+
+    @property
+    def http(self) -> httpx.Client:
+        """The pooled client every request goes through."""
+        with self._http_lock:
+            if self._http is None:
+                self._http = httpx.Client(auth=self.auth, **client_settings())
+            return self._http
+
+    async def async_http(self) -> httpx.AsyncClient:
+        """The pooled async client for the running event loop.
+
+        An AsyncClient's connections belong to the loop that opened them,
+        so each loop gets its own. Clients left behind by loops that have
+        since closed are closed here, before a new one is made.
+        """
+        loop = asyncio.get_running_loop()
+        with self._http_lock:
+            stale = [l for l in self._async_clients if l.is_closed()]
+            stale_clients = [self._async_clients.pop(l) for l in stale]
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(auth=self.auth, **client_settings())
+                self._async_clients[loop] = client
+        for old in stale_clients:
+            await close_abandoned(old)
+        return client
+
+    def close(self) -> None:
+        """Close the pooled connections; the client reopens them if used again."""
+        with self._http_lock:
+            if self._http is not None:
+                self._http.close()
+                self._http = None
+            async_clients, self._async_clients = self._async_clients, {}
+        for loop, client in async_clients.items():
+            if loop.is_running():
+                # in use on another thread; it can only be closed from there
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+            elif not loop.is_closed():
+                loop.run_until_complete(client.aclose())
+            else:
+                asyncio.run(close_abandoned(client))
+
+    def __enter__(self) -> "GrinClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
     # @property
     # def auth_header(self):
     #     return {"Authorization": f"Bearer {self.creds.access_token}"}
@@ -90,9 +236,9 @@ class GrinClient:
         """Makes an HTTP request to grin using httpx
         and returns the response."""
         if method == "GET":
-            response = httpx.get(url, headers=self.auth_header)
+            response = self.http.get(url, follow_redirects=False)
         elif method == "POST":
-            response = httpx.post(url, headers=self.auth_header)
+            response = self.http.post(url, follow_redirects=False)
         else:
             raise ValueError(f"{method} method not supported by make_grin_request")
 
@@ -102,11 +248,9 @@ class GrinClient:
         return f"{self.base_url}/{self.directory}/{resource_str}"
 
     def _request(self, url: str, method: str = "GET", **kwargs):
-        # Always include auth header, and surface *useful* errors
-        headers = kwargs.pop("headers", {})
-        headers = {**self.auth_header, **headers}
+        # The client sends the auth header; surface *useful* errors
         try:
-            r = httpx.request(method, url, headers=headers, follow_redirects=True, **kwargs)
+            r = self.http.request(method, url, **kwargs)
             r.raise_for_status()
             return r
         except httpx.HTTPStatusError as e:
@@ -201,9 +345,7 @@ class GrinClient:
     def convert_book(self, barcode: str):
         result = {}
         url = f"{self.resource_url('_process')}?barcodes={barcode}"
-        response = httpx.post(
-            url=url, headers=self.auth_header, follow_redirects=True
-        ).raise_for_status()
+        response = self.http.post(url=url).raise_for_status()
         with io.StringIO(response.text) as f:
             reader = csv.DictReader(f, delimiter="\t")
             for row in reader:
@@ -214,7 +356,7 @@ class GrinClient:
         responses = {}
         for barcode in barcode_list:
             url = f"{self.resource_url('_process')}?barcodes={barcode}"
-            response = httpx.post(url=url, headers=self.auth_header, follow_redirects=True)
+            response = self.http.post(url=url)
 
             with io.StringIO(response.text) as f:
                 reader = csv.DictReader(f, delimiter="\t")
@@ -224,12 +366,13 @@ class GrinClient:
         return responses
 
     def convert(self, barcode_list: list):
-        url = f"{self.resource_url('_process')}?process_format=json"
+        # GRIN answers in the same tab-separated form as for convert_book
+        url = self.resource_url("_process")
         data = {
             #  'barcodes': '\n'.join(barcode_list)
             "barcodes": barcode_list
         }
-        response = httpx.post(url=url, headers=self.auth_header, follow_redirects=True, data=data)
+        response = self.http.post(url=url, data=data).raise_for_status()
 
         response_dict = {}
         with io.StringIO(response.text) as f:
@@ -239,15 +382,82 @@ class GrinClient:
 
         return response_dict
 
-    def download_file(self, url, outpath):
-        with httpx.stream("GET", url, headers=self.auth_header, follow_redirects=True) as response:
+    def download_file(self, url, outpath, parts=None):
+        """Download a file, picking up where an earlier attempt stopped.
+
+        The file is written to <outpath>.part and renamed to outpath when
+        complete; see clients.ranged_download.
+
+        Args:
+            url (str): The file to download
+            outpath (str): Where to put it
+            parts (int | None): How many byte ranges to fetch at once, for
+                                files large enough to be worth it; defaults
+                                to the GRIN_DOWNLOAD_PARTS environment
+                                variable, or 1
+
+        Returns:
+            dict: The file's digests; see clients.digests
+        """
+        parts = parts or int(os.environ.get("GRIN_DOWNLOAD_PARTS", 1))
+        download = RangedDownload(url, outpath, parts, self.bandwidth)
+        download.run(self.http)
+        return download.digests.hexdigests()
+
+    @contextlib.contextmanager
+    def stream_book(self, barcode):
+        """Open a book's encrypted tarball to be read as it arrives.
+
+        Yields:
+            httpx.Response: The response, whose body has not been read
+        """
+        url = self.resource_url(f"{barcode}.tar.gz.gpg")
+        with self.http.stream("GET", url) as response:
             response.raise_for_status()
-            with open(outpath, "wb") as f:
-                for chunk in response.iter_bytes():
-                    f.write(chunk)
+            yield response
 
     def download_book(self, barcode, target_dir):
         fname = f"{barcode}.tar.gz.gpg"
         src_url = self.resource_url(fname)
         outpath = f"{target_dir}/{fname}"
-        self.download_file(src_url, outpath)
+        return self.download_file(src_url, outpath)
+
+    async def adownload_file(self, url, outpath):
+        """Like download_file, but waits on the network without blocking
+        the event loop, so many downloads can share one thread. The file
+        is fetched in one stream, resuming from any .part file."""
+        download = RangedDownload(url, outpath, bandwidth=self.bandwidth)
+        await download.astream(await self.async_http())
+        return download.digests.hexdigests()
+
+    async def adownload_book(self, barcode, target_dir):
+        fname = f"{barcode}.tar.gz.gpg"
+        src_url = self.resource_url(fname)
+        outpath = f"{target_dir}/{fname}"
+        return await self.adownload_file(src_url, outpath)
+
+
+_shared_client: GrinClient | None = None
+_shared_lock = threading.Lock()
+
+
+def shared_grin_client() -> GrinClient:
+    """The GrinClient for this process, made on first use.
+
+    A forked child makes its own, rather than sharing its parent's
+    connections.
+    """
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = GrinClient()
+        return _shared_client
+
+
+def _forget_shared_client() -> None:
+    global _shared_client, _shared_lock
+    _shared_client = None
+    _shared_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_shared_client)
@@ -2,11 +2,16 @@
 
 # This module implements clients to object-storage services that may
 # be used to upload Google Books objects (tarballs) to a storage
-# system.
+# system.  Uploads draw from the host's shared bandwidth budget, if it
+# has one (see clients.bandwidth).
 
 from pathlib import Path
 from collections import namedtuple
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import NoCredentialsError
+from clients.bandwidth import Bandwidth
+from clients.digests import s3_checksum_args
 
 S3Object = namedtuple(
     "S3Rec",
@@ -34,6 +39,12 @@ class S3Client(ObjectStore):
         self.bucket_name = bucket_name
         self.cache = local_cache
         self.client = boto3.client("s3")
+        self.bandwidth = Bandwidth.from_env()
+
+    @property
+    def callback(self):
+        """What boto3 calls with each amount of bytes sent, to throttle the upload."""
+        return self.bandwidth.take if self.bandwidth.enabled else None
 
     def object_exists(self, key: str) -> bool:
         try:
@@ -44,18 +55,81 @@ class S3Client(ObjectStore):
         except self.client.exceptions.NoSuchKey:
             return False
 
-    def store_file(self, file_path, object_name=None) -> bool:
+    def store_file(self, file_path, object_name=None, digests=None) -> bool:
+        """Upload a file.
+
+        Args:
+            file_path: The file to upload
+            object_name (str | None): The key to store it under; defaults to
+                                      the file's name without its suffix
+            digests (dict | None): The file's digests (see clients.digests).
+                                   S3 refuses the upload if the object's
+                                   CRC32 differs, and keeps the SHA-256 and
+                                   MD5 as metadata.
+
+        Returns:
+            bool: True if the object was stored
+        """
         if object_name is None:
             object_name = Path(file_path).stem
+        extra_args = s3_checksum_args(digests) if digests else None
         try:
-            self.client.upload_file(file_path, self.bucket_name, object_name)
+            self.client.upload_file(
+                file_path,
+                self.bucket_name,
+                object_name,
+                ExtraArgs=extra_args,
+                Callback=self.callback,
+            )
             return True
 
         except self.client.exceptions.NoCredentialsError as e:
             print(f"AWS credentials not available: {e}")
             return False
 
-    def store_object(self, barcode, overwrite=False) -> bool:
+    def store_stream(
+        self, stream, object_name, part_size=8 * 1024 * 1024, parts_in_memory=4
+    ) -> bool:
+        """Upload from a stream, in parts, without knowing its length beforehand.
+
+        At most parts_in_memory parts of part_size bytes are held at once. If
+        reading the stream raises, the multipart upload is aborted and no
+        object is created.
+
+        Args:
+            stream: Anything with a read(n) method that returns n bytes
+                    until the end of the data
+            object_name (str): The key to store it under
+            part_size (int): Bytes per part; S3 needs at least 5 MiB
+            parts_in_memory (int): How many parts may wait to be uploaded
+
+        Returns:
+            bool: True if the object was stored
+        """
+        config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=parts_in_memory,
+        )
+        config.max_in_memory_upload_chunks = parts_in_memory
+        # the stream's digests are not known until its end, so S3 checks each part
+        extra_args = {"ChecksumAlgorithm": "CRC32"}
+        try:
+            self.client.upload_fileobj(
+                stream,
+                self.bucket_name,
+                object_name,
+                ExtraArgs=extra_args,
+                Config=config,
+                Callback=self.callback,
+            )
+            return True
+
+        except NoCredentialsError as e:
+            print(f"AWS credentials not available: {e}")
+            return False
+
+    def store_object(self, barcode, overwrite=False, digests=None) -> bool:
         result = False
         file_path = self.cache / Path(barcode).with_suffix(".tgz")
         if file_path.is_file():
@@ -63,9 +137,9 @@ class S3Client(ObjectStore):
                 print(f"object {barcode} has already been stored.")
                 if overwrite is True:
                     print(f"overwriting {barcode}")
-                    result = self.store_file(file_path, barcode)
+                    result = self.store_file(file_path, barcode, digests)
             else:
-                result = self.store_file(file_path, barcode)
+                result = self.store_file(file_path, barcode, digests)
         return result
 
     def list_objects(self):
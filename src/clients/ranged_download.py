@@ -0,0 +1,277 @@
+# ranged_download.py
+
+# Downloads that survive a dropped connection.  A book is written to
+# <outpath>.part and renamed to <outpath> only once it is complete, so a
+# transfer that fails at 90% leaves 90% of the book behind; the next
+# attempt asks for the rest with an HTTP Range request instead of
+# starting again from zero.  A large book can also be fetched as several
+# byte ranges at once, each written into place in the .part file with
+# os.pwrite.
+#
+# Progress is kept beside the .part file in <outpath>.part.json:
+#
+#   {"url": "...", "size": 2147483648, "validator": "\"etag\"",
+#    "ranges": [[0, 536870912, 104857600], ...]}
+#
+# Each range is [start, end, next]: bytes start to end (exclusive) are
+# wanted, and those before next have been written.  A sequential
+# download has no ranges; the size of the .part file says how far it
+# got.  The validator (the ETag, or failing that Last-Modified) is sent
+# back as If-Range, so if the book changed on the server it is fetched
+# from the start instead of being spliced together from two versions.
+#
+# The book's digests (see clients.digests) are computed as it streams
+# in.  Only a download that was resumed or fetched in parallel has to
+# read back what is already on disk, since its bytes did not all arrive
+# in order.
+#
+# Every chunk is drawn from a Bandwidth (see clients.bandwidth), which
+# holds the download to the host's shared budget, if it has one.
+
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+
+from clients.bandwidth import Bandwidth
+from clients.digests import Digests
+
+# Bytes read from the network at a time
+CHUNK_SIZE = 1 << 20
+
+# A parallel download's progress is saved after every this many chunks
+SAVE_EVERY = 16
+
+# Books smaller than this many bytes per part are fetched in one stream
+MIN_PART_SIZE = 32 << 20
+
+
+def content_range_total(response: httpx.Response) -> int | None:
+    """The full size of the resource, from a Content-Range header."""
+    match = re.search(r"/(\d+)\s*$", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def validator(response: httpx.Response) -> str | None:
+    return response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+
+class RangedDownload:
+    """
+    One book's download into <outpath>.part, resumed where it stopped.
+
+    Attributes:
+        url (str): Where the book is
+        outpath (Path): Where it goes once complete
+        part (Path): Where it is written until then
+        progress_path (Path): Where the download's progress is kept
+        parts (int): How many ranges to fetch at once, if the server
+                     allows ranges and the book is big enough
+        digests (Digests | None): Digests of the book, once it is complete
+        bandwidth (Bandwidth): The budget the download draws from
+    """
+
+    def __init__(
+        self,
+        url: str,
+        outpath: Path | str,
+        parts: int = 1,
+        bandwidth: Bandwidth | None = None,
+    ) -> None:
+        self.url = url
+        self.outpath = Path(outpath)
+        self.part = self.outpath.with_name(self.outpath.name + ".part")
+        self.progress_path = self.outpath.with_name(self.outpath.name + ".part.json")
+        self.parts = max(1, parts)
+        self._lock = threading.Lock()
+        self.progress: dict = {"url": url, "size": None, "validator": None, "ranges": []}
+        self.digests: Digests | None = None
+        self.bandwidth = bandwidth or Bandwidth()
+
+    def load_progress(self) -> None:
+        """Pick up the progress of an earlier attempt, if it was for this url."""
+        try:
+            progress = json.loads(self.progress_path.read_text())
+        except (OSError, ValueError):
+            return
+        if progress.get("url") == self.url and self.part.exists():
+            self.progress = progress
+
+    def save_progress(self) -> None:
+        with self._lock:
+            data = json.dumps(self.progress)
+            tmp = self.progress_path.with_name(self.progress_path.name + ".tmp")
+            tmp.write_text(data)
+            os.replace(tmp, self.progress_path)
+
+    def resume_headers(self, offset: int) -> dict:
+        if offset == 0:
+            return {}
+        headers = {"Range": f"bytes={offset}-"}
+        if self.progress["validator"]:
+            headers["If-Range"] = self.progress["validator"]
+        return headers
+
+    def finish(self) -> Path:
+        if self.digests is None:
+            self.digests = Digests.of_file(self.part)
+        os.replace(self.part, self.outpath)
+        self.progress_path.unlink(missing_ok=True)
+        return self.outpath
+
+    def run(self, client: httpx.Client) -> Path:
+        """Download the book, resuming and splitting it into ranges where possible.
+
+        Args:
+            client (httpx.Client): The client to fetch with, from any number
+                                   of threads; it must follow redirects
+
+        Returns:
+            Path: The completed file
+
+        Raises:
+            httpx.HTTPError: If a request fails; what was written is kept
+                             for the next attempt
+        """
+        self.load_progress()
+        if self.progress["ranges"] and self.still_valid(client):
+            logging.info(f"resuming {len(self.progress['ranges'])}-part download of {self.url}")
+            self.fetch_ranges(client)
+            return self.finish()
+        if self.parts > 1 and not self.part.exists() and self.split(client):
+            self.fetch_ranges(client)
+            return self.finish()
+        self.stream(client)
+        return self.finish()
+
+    def still_valid(self, client: httpx.Client) -> bool:
+        """Whether the book has not changed since the ranges were saved."""
+        headers = {"Range": "bytes=0-0"}
+        if self.progress["validator"]:
+            headers["If-Range"] = self.progress["validator"]
+        with client.stream("GET", self.url, headers=headers) as response:
+            response.raise_for_status()
+            valid = response.status_code == 206 and (
+                content_range_total(response) == self.progress["size"]
+            )
+        if not valid:
+            logging.info(f"{self.url} changed on the server; downloading it again")
+            self.part.unlink(missing_ok=True)
+            self.progress_path.unlink(missing_ok=True)
+            self.progress["ranges"] = []
+        return valid
+
+    def split(self, client: httpx.Client) -> bool:
+        """Plan a parallel download, if the server allows ranges and the book is big.
+
+        Returns:
+            bool: True if the book is to be fetched in parts
+        """
+        with client.stream("GET", self.url, headers={"Range": "bytes=0-0"}) as response:
+            response.raise_for_status()
+            size = content_range_total(response) if response.status_code == 206 else None
+            self.progress["validator"] = validator(response)
+        if size is None or size < self.parts * MIN_PART_SIZE:
+            return False
+        step = -(-size // self.parts)
+        self.progress["size"] = size
+        self.progress["ranges"] = [
+            [start, min(start + step, size), start] for start in range(0, size, step)
+        ]
+        with open(self.part, "wb") as f:
+            f.truncate(size)
+        self.save_progress()
+        return True
+
+    def fetch_ranges(self, client: httpx.Client) -> None:
+        fd = os.open(self.part, os.O_WRONLY)
+        try:
+            pending = [r for r in self.progress["ranges"] if r[2] < r[1]]
+            with ThreadPoolExecutor(len(pending) or 1, thread_name_prefix="range") as pool:
+                futures = [pool.submit(self.fetch_range, client, fd, r) for r in pending]
+            for future in futures:
+                future.result()
+        finally:
+            os.close(fd)
+            self.save_progress()
+
+    def fetch_range(self, client: httpx.Client, fd: int, byte_range: list) -> None:
+        start, end, position = byte_range
+        headers = {"Range": f"bytes={position}-{end - 1}"}
+        with client.stream("GET", self.url, headers=headers) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise httpx.HTTPError(f"{self.url} ignored the range {position}-{end - 1}")
+            for n, chunk in enumerate(response.iter_bytes(CHUNK_SIZE), 1):
+                chunk = chunk[: end - position]
+                self.bandwidth.take(len(chunk))
+                os.pwrite(fd, chunk, position)
+                position += len(chunk)
+                byte_range[2] = position
+                if n % SAVE_EVERY == 0:
+                    self.save_progress()
+
+    def stream(self, client: httpx.Client) -> None:
+        """Fetch the book in one stream, starting after what is in the .part file."""
+        offset = self.part.stat().st_size if self.part.exists() else 0
+        with client.stream("GET", self.url, headers=self.resume_headers(offset)) as response:
+            if response.status_code == 416 and content_range_total(response) == offset:
+                return  # the .part file already holds it all
+            response.raise_for_status()
+            f = self.open_part(response, offset)
+            with f:
+                for chunk in response.iter_bytes(CHUNK_SIZE):
+                    self.bandwidth.take(len(chunk))
+                    f.write(chunk)
+                    self.digests.update(chunk)
+
+    async def astream(self, client: httpx.AsyncClient) -> Path:
+        """Like stream, on an event loop, then finish the download.
+
+        Args:
+            client (httpx.AsyncClient): The client to fetch with; it must
+                                        follow redirects
+
+        Returns:
+            Path: The completed file
+        """
+        self.load_progress()
+        if self.progress["ranges"]:
+            # left by a parallel download, which cannot be resumed in one stream
+            self.part.unlink(missing_ok=True)
+            self.progress["ranges"] = []
+        offset = self.part.stat().st_size if self.part.exists() else 0
+        async with client.stream("GET", self.url, headers=self.resume_headers(offset)) as response:
+            if response.status_code == 416 and content_range_total(response) == offset:
+                return self.finish()
+            response.raise_for_status()
+            f = self.open_part(response, offset)
+            with f:
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    await self.bandwidth.atake(len(chunk))
+                    f.write(chunk)
+                    self.digests.update(chunk)
+        return self.finish()
+
+    def open_part(self, response: httpx.Response, offset: int):
+        """Open the .part file where the response's body goes."""
+        if response.status_code == 206 and offset:
+            logging.info(f"resuming {self.url} at byte {offset}")
+            self.digests = Digests.of_file(self.part)
+            f = open(self.part, "r+b")
+            f.seek(offset)
+        else:
+            if offset:
+                logging.info(f"{self.url} cannot be resumed; downloading it again")
+            self.digests = Digests()
+            f = open(self.part, "wb")
+        self.progress["validator"] = validator(response)
+        length = response.headers.get("Content-Length")
+        self.progress["size"] = content_range_total(response) or (int(length) if length else None)
+        self.save_progress()
+        return f
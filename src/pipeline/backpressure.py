@@ -0,0 +1,123 @@
+# backpressure.py
+
+# Keeps a fast stage from burying a slow one.  Nothing else stops the
+# Downloader pulling dozens of multi-GB .tar.gz.gpg files into the
+# processing bucket while the Decryptor and Uploader fall behind, until
+# the disk fills and every stage fails at once.  A filter checks its
+# Backpressure before claiming tokens, and claims nothing while it says
+# to pause:
+#
+# - while the filter's output bucket holds wip_limit tokens or more,
+#   waiting or being worked on by the next stage, and
+# - while fewer than min_free_space bytes are free on the filesystem
+#   holding the processing bucket.
+#
+# Give the free-space threshold only to the stages that fill the disk
+# (the Downloader, the Decryptor); the stages after them free it.
+#
+# The limits are soft.  A check is good for `interval` seconds, and each
+# worker of a concurrent filter may claim one more token before it sees
+# the pause, so leave some headroom under the real limits.
+
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from utils.sizes import parse_size
+
+if TYPE_CHECKING:
+    from pipeline.token_store import TokenStore
+
+
+class Backpressure:
+    """
+    Tells a filter when to stop claiming tokens.
+
+    Attributes:
+        wip_limit (int): Most tokens the output bucket may hold before the
+                         filter pauses; 0 for no limit
+        min_free_space (int): Bytes that must stay free under path; 0 for
+                              no threshold
+        path (Path | None): A directory on the filesystem to watch, the
+                            processing bucket
+        interval (float): Seconds a check is good for
+    """
+
+    def __init__(
+        self,
+        wip_limit: int = 0,
+        min_free_space: int = 0,
+        path: Path | None = None,
+        interval: float = 1.0,
+    ) -> None:
+        self.wip_limit = wip_limit
+        self.min_free_space = min_free_space
+        self.path = Path(path) if path else None
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._checked: float | None = None
+        self._reason: str | None = None
+
+    @classmethod
+    def from_env(cls) -> "Backpressure":
+        """Read the limits from the environment.
+
+        Uses WIP_LIMIT, MIN_FREE_SPACE and FREE_SPACE_PATH, which the
+        orchestrator sets from the configuration.
+        """
+        path = os.environ.get("FREE_SPACE_PATH")
+        return cls(
+            wip_limit=int(os.environ.get("WIP_LIMIT", 0)),
+            min_free_space=parse_size(os.environ.get("MIN_FREE_SPACE", 0)),
+            path=Path(path) if path else None,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.wip_limit or (self.min_free_space and self.path))
+
+    def check(self, store: "TokenStore", bucket: Path) -> str | None:
+        """Whether to pause, and why.
+
+        Args:
+            store (TokenStore): The store holding the output bucket
+            bucket (Path): The filter's output bucket
+
+        Returns:
+            str | None: Why the filter should pause, or None if it may claim
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if self._checked is not None and now - self._checked < self.interval:
+                return self._reason
+            reason = self.measure(store, Path(bucket))
+            if reason != self._reason:
+                if reason:
+                    logging.info(f"pausing: {reason}")
+                else:
+                    logging.info("resuming")
+            self._checked, self._reason = now, reason
+            return reason
+
+    def measure(self, store: "TokenStore", bucket: Path) -> str | None:
+        if self.wip_limit:
+            counts = store.counts(bucket)
+            wip = counts["waiting_tokens"] + counts["in_process_tokens"]
+            if wip >= self.wip_limit:
+                return f"{bucket.name} holds {wip} tokens, its limit is {self.wip_limit}"
+        if self.min_free_space and self.path:
+            try:
+                free = shutil.disk_usage(self.path).free
+            except OSError as e:
+                # better to carry on than to stall the pipeline on a typo
+                logging.error(f"cannot tell the free space in {self.path}: {e}")
+                return None
+            if free < self.min_free_space:
+                return f"{free} bytes free in {self.path}, {self.min_free_space} wanted"
+        return None
@@ -0,0 +1,92 @@
+# decryption.py
+
+# Runs gpg over a stream of encrypted bytes and hands back the decrypted
+# bytes as a readable stream, so a book can be decrypted on its way from
+# one place to another (GRIN to S3, or one file to another) without gpg
+# reading or writing any file itself.
+
+import subprocess
+import threading
+from collections import deque
+from typing import Iterable
+
+
+class Decryption:
+    """
+    A gpg process decrypting a stream, read like a file.
+
+    A thread feeds the encrypted chunks to gpg's stdin while the caller
+    reads gpg's stdout; the pipes between them hold the only buffers. At
+    the end of the output, read raises if feeding gpg failed or gpg
+    exited with an error, instead of returning the empty end-of-file.
+
+    Attributes:
+        bytes_in (int): Encrypted bytes fed to gpg so far
+        bytes_out (int): Decrypted bytes read so far
+    """
+
+    def __init__(self, chunks: Iterable[bytes], passphrase: str) -> None:
+        self.proc = subprocess.Popen(
+            ["gpg", "--batch", "--yes", "--passphrase", passphrase, "--decrypt"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.error: BaseException | None = None
+        self.stderr: deque[bytes] = deque(maxlen=20)
+        self.feeder = threading.Thread(target=self.feed, args=(chunks,), daemon=True)
+        self.drainer = threading.Thread(target=self.drain, daemon=True)
+        self.feeder.start()
+        self.drainer.start()
+
+    def feed(self, chunks: Iterable[bytes]) -> None:
+        try:
+            for chunk in chunks:
+                self.proc.stdin.write(chunk)
+                self.bytes_in += len(chunk)
+        except BaseException as e:
+            self.error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+
+    def drain(self) -> None:
+        for line in self.proc.stderr:
+            self.stderr.append(line)
+
+    def read(self, n: int = -1) -> bytes:
+        """Read up to n decrypted bytes; fewer only at the end.
+
+        Raises:
+            RuntimeError: At the end, if gpg failed
+            Exception: At the end, whatever stopped the download
+        """
+        data = self.proc.stdout.read(n)
+        if n < 0 or len(data) < n:
+            # the pipe reads short only at the end
+            self.finish()
+        self.bytes_out += len(data)
+        return data
+
+    def finish(self) -> None:
+        self.feeder.join()
+        returncode = self.proc.wait()
+        self.drainer.join()
+        if self.error is not None:
+            raise self.error
+        if returncode != 0:
+            message = b"".join(self.stderr).decode(errors="replace").strip()
+            raise RuntimeError(f"gpg exited with {returncode}: {message}")
+
+    def close(self) -> None:
+        """Stop gpg and the threads, whether or not the output was all read."""
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.feeder.join()
+        self.proc.wait()
+        self.drainer.join()
+        self.proc.stdout.close()
@@ -1,14 +1,18 @@
 import logging
 import os
-import subprocess
 import sys
 from datetime import datetime, timezone
 from pathlib import Path
 
-from pipeline.plumbing import Filter, Pipe, Token
+from clients.digests import Digests, mismatches
+from pipeline.decryption import Decryption
+from pipeline.plumbing import Filter, Pipe, Token, default_worker_id
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+# Bytes read from the encrypted file at a time
+CHUNK_SIZE = 1 << 20
+
 
 class Decryptor(Filter):
     """
@@ -17,6 +21,11 @@ class Decryptor(Filter):
     The Decryptor filter uses GPG to decrypt encrypted tarball files downloaded
     from GRIN. It requires the DECRYPTION_PASSPHRASE environment variable to be set.
 
+    The file is fed to gpg, and gpg's output written to the tarball, by the
+    Decryptor itself, so both can be digested on the way through: the
+    encrypted file is checked against the digests the Downloader recorded
+    on the token, and the tarball's are recorded for the Uploader.
+
     Attributes:
         passphrase (str): GPG decryption passphrase from environment
     """
@@ -75,8 +84,10 @@ class Decryptor(Filter):
     def process_token(self, token: Token) -> bool:
         """Decrypt the encrypted tarball file using GPG.
 
-        Runs the gpg command to decrypt the .tar.gz.gpg file and save it as
-        a .tgz file. Updates the token with decryption status.
+        Pipes the .tar.gz.gpg file through gpg into a .tgz file, checking
+        the encrypted file against the digests taken when it was downloaded
+        and recording the digests of the tarball. Updates the token with
+        decryption status.
 
         Args:
             token (Token): Token containing file paths and metadata
@@ -86,29 +97,36 @@ class Decryptor(Filter):
         """
         logger.info(f"processing token {token.content['barcode']}")
         successflg = False
-        result = subprocess.run(
-            [
-                "gpg",
-                "--batch",
-                "--yes",
-                "--passphrase",
-                os.environ["DECRYPTION_PASSPHRASE"],
-                "--decrypt",
-                "--output",
-                str(self.outfile(token)),
-                str(self.infile(token)),
-            ],
-            capture_output=True,
-            text=True,
-        )
-
-        if result.returncode != 0:
+        encrypted, decrypted = Digests(), Digests()
+        failure = None
+        try:
+            with self.infile(token).open("rb") as src, self.outfile(token).open("wb") as out:
+                chunks = encrypted.tee(iter(lambda: src.read(CHUNK_SIZE), b""))
+                decryption = Decryption(chunks, self.passphrase)
+                try:
+                    while chunk := decryption.read(CHUNK_SIZE):
+                        decrypted.update(chunk)
+                        out.write(chunk)
+                finally:
+                    decryption.close()
+        except RuntimeError as e:  # gpg failed
+            failure = "Decryption failed"
+            logging.error(f"decryption of {token.name} failed: {e}")
+
+        expected = token.content.get("digests", {}).get("encrypted")
+        if failure is None and (differ := mismatches(expected, encrypted.hexdigests())):
+            failure = f"Encrypted file does not match its download: {', '.join(differ)} differ"
+            logging.error(f"{token.name}: {failure}")
+
+        if failure is not None:
             successflg = False
             token.content["decryption_status"] = "fail"
-            self.log_to_token(token, "WARNING", "Decryption failed")
+            self.outfile(token).unlink(missing_ok=True)
+            self.log_to_token(token, "WARNING", failure)
         else:
             successflg = True
             token.content["decryption_status"] = "success"
+            token.content.setdefault("digests", {})["decrypted"] = decrypted.hexdigests()
             self.infile(token).unlink()
             token.put_prop("when_decrypted", str(datetime.now(timezone.utc)))
             self.log_to_token(token, "INFO", "Decryption successful")
@@ -129,7 +147,7 @@ if __name__ == "__main__":
     parser.add_argument("--output", required=True)
     args = parser.parse_args()
 
-    pipe: Pipe = Pipe(Path(args.input), Path(args.output))
+    pipe: Pipe = Pipe(Path(args.input), Path(args.output), worker_id=default_worker_id())
     logger.info("starting decryptor")
     decryptor = Decryptor(pipe)
     decryptor.run_forever()
@@ -3,11 +3,12 @@
 # Use to download files from GRIN.
 
 import logging
+import os
 from datetime import datetime, timezone
 from pathlib import Path
 
-from clients import GrinClient
-from pipeline.plumbing import Filter, Pipe, Token
+from clients import GrinClient, shared_grin_client
+from pipeline.plumbing import AsyncFilter, Filter, Pipe, Token, default_worker_id
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
@@ -20,7 +21,8 @@ class Downloader(Filter):
 
     The Downloader filter retrieves converted book files from GRIN after
     conversion requests have been processed. It downloads files to the
-    processing bucket specified in the token.
+    processing bucket specified in the token, and records the digests of
+    each file on its token.
     """
 
     def __init__(self, pipe: Pipe):
@@ -52,13 +54,48 @@ class Downloader(Filter):
         completed: bool = False
         barcode = token.content["barcode"]
         dest = str(Path(token.content["processing_bucket"]))
-        grin_client = GrinClient()
-        grin_client.download_book(barcode, dest)
+        digests = shared_grin_client().download_book(barcode, dest)
+        token.content.setdefault("digests", {})["encrypted"] = digests
         token.put_prop("when_downloaded", str(datetime.now(timezone.utc)))
         completed = True
         return completed
 
 
+class AsyncDownloader(AsyncFilter):
+    """
+    Downloader that keeps many downloads in flight on one event loop.
+
+    Downloads spend nearly all their time waiting on GRIN, so a single
+    process can drive as many of them as the concurrency setting allows.
+    """
+
+    def __init__(self, pipe: Pipe):
+        super().__init__(pipe)
+
+    @property
+    def grin_client(self) -> GrinClient:
+        return shared_grin_client()
+
+    def validate_token(self, token: Token) -> bool:
+        return True
+
+    async def process_token(self, token: Token) -> bool:
+        """Download the converted book file from GRIN.
+
+        Args:
+            token (Token): Token containing barcode and processing bucket info
+
+        Returns:
+            bool: True if download completed successfully
+        """
+        barcode = token.content["barcode"]
+        dest = str(Path(token.content["processing_bucket"]))
+        digests = await self.grin_client.adownload_book(barcode, dest)
+        token.content.setdefault("digests", {})["encrypted"] = digests
+        token.put_prop("when_downloaded", str(datetime.now(timezone.utc)))
+        return True
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -67,8 +104,12 @@ if __name__ == "__main__":
     parser.add_argument("--output", required=True)
     args = parser.parse_args()
 
-    pipe: Pipe = Pipe(Path(args.input), Path(args.output))
+    pipe: Pipe = Pipe(Path(args.input), Path(args.output), worker_id=default_worker_id())
 
-    downloader: Downloader = Downloader(pipe)
+    # ASYNC=true runs the downloads on an event loop
+    if os.environ.get("ASYNC", "").lower() == "true":
+        downloader: Filter = AsyncDownloader(pipe)
+    else:
+        downloader = Downloader(pipe)
     logger.info("starting downloader")
     downloader.run_forever()
@@ -3,7 +3,7 @@ import os
 import sys
 from pathlib import Path
 
-from clients import GrinClient
+from clients import shared_grin_client
 from pipeline.plumbing import Filter, Pipe, Token
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -17,10 +17,15 @@ class Monitor(Filter):
     bucket is empty; Monitors check for some condition, and if
     the condition is not met, they put the token back, so the
     wait interval has to occur after a run through all the tokens.
+    Putting tokens back would wake an inotify watcher immediately,
+    so Monitors always poll. For the same reason a Monitor runs in
+    one thread, whatever its concurrency.
     """
 
+    per_token = False
+
     def __init__(self, pipe: Pipe, poll_interval: int = 60) -> None:
-        super().__init__(pipe, poll_interval)
+        super().__init__(pipe, poll_interval, wakeup="poll")
 
     def set_up_run(self):
         pass  # implemented by subclasses
@@ -34,9 +39,10 @@ class Monitor(Filter):
         # First set up the run: class-specific actions
         self.set_up_run()
 
-        # Then, get a list of all the tokens in the input pipe.
-
-        barcodes = [tok.name for tok in self.pipe.list_input_tokens()]
+        # Then, list the barcodes in the input pipe. Only the directory is
+        # read, and the listing is taken up front because putting tokens
+        # back adds files to the bucket.
+        barcodes = list(self.pipe.list_input_barcodes())
         for barcode in barcodes:
             token: Token | None = self.pipe.take_token(barcode)
             if token and self.validate_token(token):
@@ -90,14 +96,14 @@ class RequestMonitor(Monitor):
     @property
     def converted_barcodes(self):
         if self._converted_barcodes is None:
-            client = GrinClient()
+            client = shared_grin_client()
             self._converted_barcodes = [rec["barcode"] for rec in client.converted_books]
         return self._converted_barcodes
 
     @property
     def in_process_barcodes(self):
         if self._in_process_barcodes is None:
-            client = GrinClient()
+            client = shared_grin_client()
             self._in_process_barcodes = [rec["barcode"] for rec in client.in_process_books]
         return self._in_process_barcodes
 
@@ -111,8 +117,10 @@ class RequestMonitor(Monitor):
         # First, set up the run
         self.set_up_run()
 
-        # Then, get a list of all the tokens in the input pipe.
-        barcodes = [tok.name for tok in self.pipe.list_input_tokens()]
+        # Then, list the barcodes in the input pipe. Only the directory is
+        # read, and the listing is taken up front because putting tokens
+        # back adds files to the bucket.
+        barcodes = list(self.pipe.list_input_barcodes())
 
         # Iterate over the list of barcodes. If the barcode is in the
         # in_process list from GRIN, leave it where it is.  If it is
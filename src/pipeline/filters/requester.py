@@ -3,7 +3,7 @@ from datetime import datetime, timezone
 from enum import StrEnum
 from pathlib import Path
 
-from clients import GrinClient
+from clients import shared_grin_client
 from pipeline.plumbing import Filter, Pipe, Token
 
 
@@ -46,24 +46,54 @@ class Requester(Filter):
         Returns:
             bool: True if the conversion request was successful, False otherwise
         """
-        successflg = False
         barcode = token.content["barcode"]
-        response = GrinClient().convert_book(barcode)
-        if response is not None:
-            status = response[barcode]
-            if status in self.ERRORS:
-                logging.error(f"request error for {barcode}: {status}")
-                self.log_to_token(token, "ERROR", status)
-                successflg = False
-            else:
-                self.log_to_token(token, "INFO", status)
-                token.put_prop("when_requested", str(datetime.now(timezone.utc)))
-                successflg = True
-        else:
+        response = shared_grin_client().convert_book(barcode)
+        if response is None:
             logging.error(f"submission of barcode for conversion failed: {barcode}")
-            successflg = False
+            return False
+        return self.record_status(token, response[barcode])
+
+    def process_batch(self, tokens: list[Token]) -> list[bool]:
+        """Submit conversion requests for a batch of books in one GRIN request.
+
+        Args:
+            tokens (list[Token]): Tokens containing the book barcodes to convert
+
+        Returns:
+            list[bool]: Whether each conversion request was successful
+        """
+        barcodes = [token.content["barcode"] for token in tokens]
+        response = shared_grin_client().convert(barcodes)
+        results = []
+        for token in tokens:
+            status = response.get(token.content["barcode"])
+            if status is None:
+                logging.error(f"no conversion status returned for {token.name}")
+                self.log_to_token(token, "ERROR", "No status returned by GRIN")
+                results.append(False)
+            else:
+                results.append(self.record_status(token, status))
+        return results
+
+    def record_status(self, token: Token, status: str) -> bool:
+        """Log GRIN's response to a conversion request to the token.
+
+        Args:
+            token (Token): Token whose book was submitted
+            status (str): Status GRIN returned for the book
 
-        return successflg
+        Returns:
+            bool: True if the request was accepted, False if GRIN refused it
+        """
+        # before Python 3.12 a plain string can't be looked up in an enum
+        if status in {error.value for error in self.ERRORS}:
+            logging.error(f"request error for {token.name}: {status}")
+            self.log_to_token(token, "ERROR", status)
+            return False
+
+        self.log_to_token(token, "INFO", status)
+        token.put_prop("when_requested", str(datetime.now(timezone.utc)))
+        return True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+# streamer.py
+
+# Downloads, decrypts and uploads a book in one pass, without writing it
+# to disk.  The Downloader, Decryptor and AWSUploader between them write
+# each book to the processing bucket twice and read it back twice; the
+# Streamer pipes the GRIN response into gpg's stdin and gpg's stdout
+# into an S3 multipart upload, so only a few parts of the book are ever
+# held in memory and none of it touches the disk.
+#
+# It takes the place of those three stages and the Cleaner, so its pipe
+# runs from the converted bucket to the done bucket.  The separate
+# stages are still there for when a book needs to be looked at on disk.
+#
+# The book's digests, encrypted and decrypted, are computed on the way
+# through and recorded on the token.  They are not known until the end,
+# too late to hand to S3 for a whole-object check, so S3 checks each
+# part of the upload by its own CRC32 instead.
+#
+# If the download breaks off or gpg fails (a truncated or corrupted
+# file fails gpg's integrity check), reading the decrypted stream
+# raises before its end, the multipart upload is aborted, and no object
+# is left in S3.
+#
+# Both the download and the upload draw from the host's shared bandwidth
+# budget, if it has one (see clients.bandwidth).
+
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+from clients import GrinClient, S3Client, shared_grin_client
+from clients.bandwidth import Bandwidth
+from clients.digests import Digests, DigestingReader
+from pipeline.decryption import Decryption
+from pipeline.plumbing import Filter, Pipe, Token, default_worker_id
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Bytes read from GRIN at a time
+CHUNK_SIZE = 1 << 20
+
+
+class Streamer(Filter):
+    """
+    Pipeline filter that streams a converted book from GRIN, through gpg,
+    into S3.
+
+    It requires the DECRYPTION_PASSPHRASE environment variable to be set.
+
+    Attributes:
+        client (S3Client): S3 client for storage operations
+        grin_client (GrinClient): GRIN client the books are read from
+        passphrase (str): GPG decryption passphrase from environment
+        bandwidth (Bandwidth): The budget the download draws from; the
+                               S3 client draws the upload from its own
+        part_size (int): Bytes per part of the multipart upload
+        parts_in_memory (int): Parts that may wait to be uploaded; the
+                               stage holds at most part_size times this
+    """
+
+    def __init__(
+        self,
+        pipe: Pipe,
+        s3_client: S3Client,
+        grin_client: GrinClient | None = None,
+        part_size: int = 8 * 1024 * 1024,
+        parts_in_memory: int = 4,
+    ) -> None:
+        passphrase = os.environ.get("DECRYPTION_PASSPHRASE")
+        if not passphrase:
+            raise RuntimeError("DECRYPTION_PASSPHRASE not set in environment")
+        super().__init__(pipe)
+        self.client = s3_client
+        self._grin_client = grin_client
+        self.passphrase = passphrase
+        self.part_size = part_size
+        self.parts_in_memory = parts_in_memory
+        self.bandwidth = Bandwidth.from_env()
+
+    @property
+    def grin_client(self) -> GrinClient:
+        return self._grin_client or shared_grin_client()
+
+    def validate_token(self, token: Token) -> bool:
+        """Flag books that are already stored, so they are not streamed again.
+
+        Args:
+            token (Token): Token to validate
+
+        Returns:
+            bool: Always True; duplicates get an upload_status of "duplicate"
+        """
+        barcode = token.get_prop("barcode")
+        if barcode is not None and self.client.object_exists(barcode):
+            token.put_prop("upload_status", "duplicate")
+        return True
+
+    def process_token(self, token: Token) -> bool:
+        """Stream the book from GRIN, through gpg, into S3.
+
+        Args:
+            token (Token): Token containing the book's barcode
+
+        Returns:
+            bool: True if the book was stored, or already had been
+        """
+        barcode = token.get_prop("barcode")
+        if token.get_prop("upload_status") == "duplicate":
+            self.log_to_token(token, "INFO", "Object already stored.")
+            return True
+
+        logger.info(f"streaming {barcode}")
+        encrypted = Digests()
+        with self.grin_client.stream_book(barcode) as response:
+            chunks = encrypted.tee(self.bandwidth.throttle(response.iter_bytes(CHUNK_SIZE)))
+            decryption = Decryption(chunks, self.passphrase)
+            decrypted = DigestingReader(decryption)
+            try:
+                stored = self.client.store_stream(
+                    decrypted, barcode, self.part_size, self.parts_in_memory
+                )
+            finally:
+                decryption.close()
+
+        if not stored:
+            logging.error(f"Object not stored: {barcode}")
+            self.log_to_token(token, "ERROR", "Object not stored")
+            token.put_prop("upload_status", "fail")
+            return False
+
+        now = str(datetime.now(timezone.utc))
+        token.content["digests"] = {
+            "encrypted": encrypted.hexdigests(),
+            "decrypted": decrypted.digests.hexdigests(),
+        }
+        token.content["decryption_status"] = "success"
+        token.put_prop("upload_status", "success")
+        token.put_prop("when_downloaded", now)
+        token.put_prop("when_decrypted", now)
+        token.put_prop("when_uploaded", now)
+        self.log_to_token(
+            token,
+            "INFO",
+            f"Streamed {decryption.bytes_in} bytes from GRIN and stored"
+            f" {decryption.bytes_out} decrypted bytes",
+        )
+        return True
+
+
+if __name__ == "__main__":
+    for variable in ["DECRYPTION_PASSPHRASE", "OBJECT_STORE"]:
+        if variable not in os.environ:
+            print(f"Please set the {variable} environment variable.")
+            sys.exit(1)
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    pipe: Pipe = Pipe(Path(args.input), Path(args.output), worker_id=default_worker_id())
+    s3_client = S3Client(Path("/dev/null"), os.environ.get("OBJECT_STORE"))
+
+    streamer: Streamer = Streamer(pipe, s3_client)
+    logger.info("starting streamer")
+    streamer.run_forever()
@@ -1,6 +1,7 @@
 import logging
 import os
 import sys
+import time
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -53,13 +54,30 @@ class AWSUploader(Uploader):
     Handles uploading processed book files to S3, including duplicate
     detection to avoid re-uploading existing objects.
 
+    Batches look for duplicates in a listing of the bucket, which is kept
+    for inventory_ttl seconds and added to as objects are stored, so it is
+    not fetched again for every batch. A batch smaller than small_batch
+    asks after each of its objects instead, as single tokens do.
+
     Attributes:
         client (S3Client): S3 client for storage operations
+        inventory_ttl (float): Seconds a listing of the bucket is reused
+        small_batch (int): Batches smaller than this skip the listing
     """
 
-    def __init__(self, pipe: Pipe, s3_client: S3Client) -> None:
+    def __init__(
+        self,
+        pipe: Pipe,
+        s3_client: S3Client,
+        inventory_ttl: float = 300,
+        small_batch: int = 10,
+    ) -> None:
         super().__init__(pipe)
         self.client = s3_client
+        self.inventory_ttl = inventory_ttl
+        self.small_batch = small_batch
+        self._inventory: set[str] | None = None
+        self._inventory_listed = 0.0
 
     def validate_token(self, token: Token) -> bool:
         status: bool = True
@@ -69,6 +87,34 @@ class AWSUploader(Uploader):
                 token.put_prop("upload_status", "duplicate")
         return status
 
+    def validate_batch(self, tokens: list[Token]) -> list[bool]:
+        """Check a batch of tokens for duplicates with one inventory lookup.
+
+        Args:
+            tokens (list[Token]): Tokens to validate
+
+        Returns:
+            list[bool]: Always True for each token; duplicates are flagged
+                        with an upload_status of "duplicate"
+        """
+        if len(tokens) < self.small_batch:
+            return [self.validate_token(token) for token in tokens]
+        stored = self.inventory()
+        for token in tokens:
+            if token.get_prop("barcode") in stored:
+                token.put_prop("upload_status", "duplicate")
+        return [True for _ in tokens]
+
+    def inventory(self) -> set[str]:
+        """The keys in the bucket, listed afresh once inventory_ttl has passed."""
+        if (
+            self._inventory is None
+            or time.monotonic() - self._inventory_listed > self.inventory_ttl
+        ):
+            self._inventory = {obj.Key for obj in self.client.list_objects()}
+            self._inventory_listed = time.monotonic()
+        return self._inventory
+
     def process_token(self, token: Token) -> bool:
         """Upload the processed file to S3 storage.
 
@@ -90,10 +136,17 @@ class AWSUploader(Uploader):
             successflg = True
 
         else:
-            status = self.client.store_object(barcode)
+            # S3 checks the upload against the digests the Decryptor took
+            digests = token.content.get("digests", {}).get("decrypted")
+            if digests:
+                status = self.client.store_object(barcode, digests=digests)
+            else:
+                status = self.client.store_object(barcode)
 
             logging.debug(f"Store operation complete: {barcode}")
             if status is True:
+                if self._inventory is not None:
+                    self._inventory.add(barcode)
                 self.log_to_token(token, "INFO", "Object stored")
                 token.put_prop("upload_status", "success")
                 token.put_prop("when_uploaded", str(datetime.now(timezone.utc)))
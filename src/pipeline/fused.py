@@ -0,0 +1,286 @@
+# fused.py
+
+# Runs a chain of filters in one process, handing tokens from stage to
+# stage through bounded in-memory queues instead of through the buckets
+# between them.  Only the buckets named as checkpoints (and the chain's
+# last bucket) are written to, so a token that passes several fused
+# stages costs one claim and one move instead of one of each per stage.
+#
+# Durability is kept by holding the claim: a token taken from the
+# bucket at the start of a segment (the chain's first bucket, or a
+# checkpoint) stays claimed there, as a .bak in the directory view,
+# until it reaches the next checkpoint, when it is moved there in one
+# step.  If the process dies, the claim's lease runs out and the token
+# is reclaimed and handled again from the start of its segment.  A
+# token that fails at any stage is written as .err to that stage's own
+# input bucket, exactly where an unfused filter would have left it.
+#
+#   pipeline = Pipeline(config)
+#   fused = FusedPipeline(
+#       [Requester(pipeline.pipe("start", "requested")),
+#        Downloader(pipeline.pipe("converted", ...)), ...],
+#       checkpoints=[pipeline.bucket("downloaded")],
+#   )
+#   fused.run_forever()
+
+import asyncio
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+
+from pipeline.plumbing import Filter, Pipe, Token, default_worker_id
+from pipeline.watcher import make_watcher
+
+
+class HandoffPipe:
+    """
+    The pipe a fused filter works through.
+
+    It takes tokens from the previous stage's queue, or claims them from
+    the segment's first bucket, and puts them on the next stage's queue,
+    or moves them to the checkpoint that ends the segment. It offers the
+    parts of Pipe that Filter uses.
+
+    Attributes:
+        segment (Pipe): Holds the claims on the segment's tokens; its
+                        input is the segment's first bucket and its
+                        output the checkpoint ending it
+        input (Path): The stage's own input bucket, where it leaves
+                      tokens that fail
+        output (Path): The stage's own output bucket
+        source (queue.Queue | None): The queue the stage takes tokens
+                                     from; None if it claims them from
+                                     the segment's first bucket
+        sink (queue.Queue | None): The queue the stage puts tokens on;
+                                   None if it moves them to the checkpoint
+        stop_event (threading.Event): Set when the chain is stopping
+    """
+
+    # How long an idle stage blocks on its queue before checking for a stop
+    QUEUE_TIMEOUT = 0.1
+
+    def __init__(
+        self,
+        segment: Pipe,
+        input: Path,
+        output: Path,
+        source: queue.Queue | None,
+        sink: queue.Queue | None,
+        stop_event: threading.Event,
+    ) -> None:
+        self.segment = segment
+        self.input = input
+        self.output = output
+        self.source = source
+        self.sink = sink
+        self.stop_event = stop_event
+
+    @property
+    def worker_id(self) -> str | None:
+        return self.segment.worker_id
+
+    def take_tokens(self, n: int) -> list[Token]:
+        if self.source is None:
+            seg = self.segment
+            claimed = seg.store.claim(seg.input, seg.worker_id, n=n, order=seg.order)
+            return [Token(content) for content in claimed]
+        tokens = []
+        try:
+            tokens.append(self.source.get(timeout=self.QUEUE_TIMEOUT))
+            while len(tokens) < n:
+                tokens.append(self.source.get_nowait())
+        except queue.Empty:
+            pass
+        return tokens
+
+    def take_token(self, barcode: str | None = None) -> Token | None:
+        tokens = self.take_tokens(1)
+        return tokens[0] if tokens else None
+
+    async def atake_token(self, barcode: str | None = None) -> Token | None:
+        return await asyncio.to_thread(self.take_token)
+
+    def waited(self, token: Token) -> float | None:
+        return self.segment.waited(token) if self.source is None else None
+
+    def put_token(self, errorFlg: bool = False, token: Token | None = None) -> None:
+        if token is None:
+            raise ValueError("a fused stage must say which token it is putting")
+        if errorFlg:
+            self.segment.move_token(token, self.input, "error")
+        elif self.sink is None:
+            self.segment.move_token(token, self.output)
+        else:
+            while True:
+                try:
+                    self.sink.put(token, timeout=self.QUEUE_TIMEOUT)
+                    return
+                except queue.Full:
+                    if self.stop_event.is_set():
+                        self.unclaim(token)
+                        return
+
+    async def aput_token(self, errorFlg: bool = False, token: Token | None = None) -> None:
+        await asyncio.to_thread(self.put_token, errorFlg, token)
+
+    def put_token_back(self, errorFlg: bool = False, token: Token | None = None) -> None:
+        """Return a token to the segment's first bucket, to go through the segment again."""
+        if token is None:
+            raise ValueError("a fused stage must say which token it is putting back")
+        if errorFlg:
+            self.segment.move_token(token, self.input, "error")
+        else:
+            self.segment.move_token(token, self.segment.input)
+
+    def unclaim(self, token: Token) -> None:
+        """Leave a token in the segment's first bucket just as it was claimed."""
+        self.segment.store.unclaim(self.segment.input, token.name, self.segment.worker_id)
+
+
+class FusedPipeline:
+    """
+    Runs a chain of filters in one process with in-memory handoff.
+
+    Attributes:
+        filters (list[Filter]): The chain; each filter's pipe's output
+                                bucket must be the next filter's input
+        checkpoints (set[Path]): Buckets between the filters that tokens
+                                 are written to; the chain's last bucket
+                                 always is
+        queue_size (int): How many tokens may wait between two fused
+                          stages before the upstream stage blocks
+        lease (float): Seconds a claim may go unrenewed; see Filter
+        stop_event (threading.Event): Set to stop the chain
+    """
+
+    def __init__(
+        self,
+        filters: list[Filter],
+        checkpoints: list[Path] | None = None,
+        queue_size: int = 64,
+        worker_id: str | None = None,
+        lease: float | None = None,
+    ) -> None:
+        if not filters:
+            raise ValueError("a fused pipeline needs at least one filter")
+        for filt in filters:
+            if not filt.per_token:
+                # a Monitor sweeps its own input bucket, and has no tokens handed to it
+                raise ValueError(f"{filt.stage_name} sweeps its input bucket; it cannot be fused")
+        for upstream, downstream in zip(filters, filters[1:]):
+            if Path(upstream.pipe.output) != Path(downstream.pipe.input):
+                raise ValueError(
+                    f"{upstream.stage_name} feeds {upstream.pipe.output},"
+                    f" not {downstream.stage_name}'s input {downstream.pipe.input}"
+                )
+        self.filters = filters
+        self.checkpoints = {Path(bucket) for bucket in checkpoints or []}
+        self.checkpoints.add(Path(filters[-1].pipe.output))
+        self.queue_size = queue_size
+        self.lease: float = lease or float(os.environ.get("LEASE", 300))
+        self.stop_event = threading.Event()
+        self.worker_id = worker_id or filters[0].pipe.worker_id or default_worker_id()
+        self.segments: list[Pipe] = []
+        self.pipes: list[HandoffPipe] = self._connect()
+
+    def _connect(self) -> list[HandoffPipe]:
+        pipes = []
+        source = None
+        segment = None
+        for filt in self.filters:
+            if source is None:
+                # this stage starts a segment: its tokens are claimed from
+                # its input bucket until they reach the next checkpoint
+                segment = filt.pipe.for_worker(f"{self.worker_id}-{len(self.segments)}")
+                self.segments.append(segment)
+            output = Path(filt.pipe.output)
+            if output in self.checkpoints:
+                segment.output = output
+                sink = None
+            else:
+                sink = queue.Queue(self.queue_size)
+            pipes.append(
+                HandoffPipe(segment, Path(filt.pipe.input), output, source, sink, self.stop_event)
+            )
+            source = sink
+        return pipes
+
+    def run_stage(self, filt: Filter, pipe: HandoffPipe) -> None:
+        watcher = make_watcher(pipe.segment.input, filt.wakeup) if pipe.source is None else None
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    if filt.batch_size > 1:
+                        processed = filt.run_batch(pipe=pipe)
+                    else:
+                        processed = filt.run_once(pipe)
+                except Exception as e:
+                    logging.exception(f"fused {filt.stage_name} failed: {e}")
+                    processed = False
+                if not processed and watcher is not None:
+                    watcher.wait(filt.poll_interval)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def keep_leases(self) -> None:
+        while not self.stop_event.wait(self.lease / 3):
+            for segment in self.segments:
+                try:
+                    segment.store.renew()
+                    segment.reclaim(self.lease)
+                except Exception as e:
+                    logging.exception(f"could not keep the leases in {segment.input}: {e}")
+
+    def run_forever(self) -> None:
+        """Run every stage until stop is called, then return unfinished tokens.
+
+        Each filter gets as many threads as its concurrency. Tokens still
+        on the queues when the chain stops are left waiting, unchanged, in
+        the first bucket of their segment.
+        """
+        for segment in self.segments:
+            segment.recover()
+            segment.reclaim(self.lease)
+        threads = [threading.Thread(target=self.keep_leases, name="fused-leases", daemon=True)]
+        for filt, pipe in zip(self.filters, self.pipes):
+            for n in range(filt.concurrency):
+                # each thread has a pipe of its own, as run_concurrent's workers do
+                worker_pipe = HandoffPipe(
+                    pipe.segment, pipe.input, pipe.output, pipe.source, pipe.sink, self.stop_event
+                )
+                threads.append(
+                    threading.Thread(
+                        target=self.run_stage,
+                        args=(filt, worker_pipe),
+                        name=f"fused-{filt.stage_name}-{n}",
+                    )
+                )
+        for thread in threads:
+            thread.start()
+        for thread in threads[1:]:
+            thread.join()
+        self.drain()
+
+    def drain(self) -> int:
+        """Unclaim the tokens left on the queues.
+
+        Returns:
+            int: Number of tokens returned to their segments' first buckets
+        """
+        drained = 0
+        for pipe in self.pipes:
+            while pipe.sink is not None:
+                try:
+                    token = pipe.sink.get_nowait()
+                except queue.Empty:
+                    break
+                pipe.unclaim(token)
+                drained += 1
+        return drained
+
+    def stop(self) -> None:
+        """Ask every stage to stop after the token it is handling."""
+        self.stop_event.set()
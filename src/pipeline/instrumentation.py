@@ -0,0 +1,158 @@
+# instrumentation.py
+
+# Hooks into the phases a Filter goes through for each token: claiming
+# it (take), validating it, processing it and moving it on (put).  A
+# filter with no hooks pays one empty-list test per phase; hooks are
+# added by passing them to the Filter, or, for the built-in
+# TimingRecorder, by setting TIMINGS to the file it should write.
+#
+# TimingRecorder writes one JSON line per token, giving for each phase
+# the wall-clock time, the CPU time of the thread that ran it, the CPU
+# time of child processes that finished during it (gpg, for the
+# Decryptor) and the process's resident set size at its end.  That is
+# enough to tell a stage that is slow in its own work from one that is
+# slow moving tokens:
+#
+#   {"stage": "decryptor", "worker": "host-123", "barcode": "3210...",
+#    "outcome": "success",
+#    "phases": {"take": {"wall": 0.0004, "cpu": 0.0003, "child_cpu": 0.0,
+#                        "rss": 48324608}, "validate": {...},
+#               "process": {...}, "put": {...}}}
+#
+# In an AsyncFilter the thread's CPU time includes whatever other
+# coroutines ran while a phase was waiting.
+
+import json
+import os
+import resource
+import threading
+import time
+from pathlib import Path
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss() -> int:
+    """The process's resident set size in bytes (its peak, off Linux)."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def child_cpu() -> float:
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class FilterHook:
+    """
+    Instrumentation called as a filter handles each token.
+
+    Each method is passed the filter and the pipe doing the work; in a
+    concurrent filter every worker has its own pipe. Subclasses override
+    the methods they need.
+    """
+
+    def pre_take(self, filter, pipe) -> None:
+        """Called before the filter claims a token (or a batch of them)."""
+
+    def post_take(self, filter, pipe, token) -> None:
+        """Called for each token claimed; token is None if there were none."""
+
+    def post_validate(self, filter, pipe, token, valid: bool) -> None:
+        """Called once a token has been validated."""
+
+    def post_process(self, filter, pipe, token, processed: bool) -> None:
+        """Called once a token has been processed; processed is False if it raised."""
+
+    def post_put(self, filter, pipe, token) -> None:
+        """Called once a token has been moved to the output bucket, or to error."""
+
+
+class TimingRecorder(FilterHook):
+    """
+    Times each phase of each token and appends the timings to a JSONL file.
+
+    Attributes:
+        path (Path): The file the records are appended to
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._started: dict[int, tuple] = {}  # pipe -> when its take began
+        self._records: dict[tuple, dict] = {}  # (pipe, barcode) -> record so far
+
+    @staticmethod
+    def now() -> tuple:
+        return (time.perf_counter(), time.thread_time(), child_cpu())
+
+    def phase(self, since: tuple) -> tuple[dict, tuple]:
+        now = self.now()
+        timing = {
+            "wall": round(now[0] - since[0], 6),
+            "cpu": round(now[1] - since[1], 6),
+            "child_cpu": round(now[2] - since[2], 6),
+            "rss": rss(),
+        }
+        return timing, now
+
+    def pre_take(self, filter, pipe) -> None:
+        with self._lock:
+            self._started[id(pipe)] = self.now()
+
+    def post_take(self, filter, pipe, token) -> None:
+        with self._lock:
+            started = self._started.get(id(pipe))
+        if token is None or started is None:
+            return
+        timing, mark = self.phase(started)
+        record = {
+            "stage": filter.stage_name,
+            "worker": pipe.worker_id,
+            "barcode": token.name,
+            "phases": {"take": timing},
+            "mark": mark,
+        }
+        with self._lock:
+            self._records[(id(pipe), token.name)] = record
+
+    def _end_phase(self, pipe, token, name: str) -> dict | None:
+        with self._lock:
+            record = self._records.get((id(pipe), token.name))
+        if record is not None:
+            record["phases"][name], record["mark"] = self.phase(record["mark"])
+        return record
+
+    def post_validate(self, filter, pipe, token, valid: bool) -> None:
+        record = self._end_phase(pipe, token, "validate")
+        if record is not None and not valid:
+            record["outcome"] = "rejected"
+
+    def post_process(self, filter, pipe, token, processed: bool) -> None:
+        record = self._end_phase(pipe, token, "process")
+        if record is not None:
+            record["outcome"] = "success" if processed else "error"
+
+    def post_put(self, filter, pipe, token) -> None:
+        record = self._end_phase(pipe, token, "put")
+        if record is None:
+            return
+        with self._lock:
+            self._records.pop((id(pipe), token.name), None)
+        del record["mark"]
+        self.write(record)
+
+    def write(self, record: dict) -> None:
+        # One write to a file opened for appending lands in one piece, so
+        # every filter process can share the file
+        line = (json.dumps(record) + "\n").encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
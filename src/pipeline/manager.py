@@ -48,14 +48,24 @@ class Manager:
                 0
             ]  # Take the first (and should be only) start bucket
         )
-        self.stager = Stager(self.secretary, processing_bucket, start_bucket)
         self.pipeline = Pipeline(config)
+        self.stager = Stager(
+            self.secretary,
+            processing_bucket,
+            start_bucket,
+            self.pipeline.store,
+            self.pipeline.codec,
+        )
         self.synchronizer = Synchronizer(config)
         self.processes = []
         self.commands = {
             "exit": {"help": "exit manager", "fn": self._exit_command},
             "pipeline status": {
-                "help": "print pipeline status",
+                "help": "print number of tokens in each bucket",
+                "fn": self._pipeline_status_command,
+            },
+            "pipeline tokens": {
+                "help": "print names of all tokens in each bucket",
                 "fn": lambda: print(self.pipeline_status),
             },
             "ledger status": {
@@ -89,6 +99,10 @@ class Manager:
     def pipeline_status(self):
         return self.pipeline.snapshot
 
+    @property
+    def pipeline_summary(self):
+        return self.pipeline.summary
+
     @property
     def ledger_status(self):
         return {
@@ -153,6 +167,14 @@ class Manager:
             print(f"{k}: {v.get('help')}")
         return False
 
+    def _pipeline_status_command(self):
+        rows = [
+            [name, counts["waiting_tokens"], counts["in_process_tokens"], counts["errored_tokens"]]
+            for name, counts in self.pipeline_summary.items()
+        ]
+        print(tabulate(rows, headers=["bucket", "waiting", "in process", "errored"]))
+        return False
+
     def _synchronize_command(self):
         synced = self.synchronizer.synchronize(stage=True)
         print(f"Number of files synchronized: {len(synced)}")
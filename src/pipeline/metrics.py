@@ -0,0 +1,263 @@
+# metrics.py
+
+# Counters and latency histograms for the pipeline's filters, exported in
+# the Prometheus text format.  Every filter process keeps its own
+# metrics and, when a metrics directory is configured, rewrites
+# <directory>/<stage>-<worker>.prom every few seconds; point
+# node_exporter's textfile collector (or anything else that reads the
+# format) at the directory.  From those series:
+#
+#   tokens/sec         rate(grin_tokens_total{outcome="success"}[5m])
+#   error rate         rate(grin_tokens_total{outcome!="success"}[5m])
+#                        / rate(grin_tokens_total[5m])
+#   processing time    histogram_quantile(0.95,
+#                        rate(grin_token_processing_seconds_bucket[5m]))
+#   queue wait         the same, over grin_token_queue_wait_seconds
+#   backlog            grin_bucket_tokens{state="waiting"}
+#
+# The stage whose backlog grows while its processing time dominates is
+# the bottleneck.
+
+import threading
+from pathlib import Path
+
+from pipeline.token_store import write_atomically
+
+# Histogram bounds, in seconds: stages take from milliseconds (moving a
+# token) to many minutes (downloading a large book)
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape(str(value))}"' for key, value in sorted(labels.items()))
+    return "{" + pairs + "}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values.
+
+    Attributes:
+        name (str): The metric's name
+        help (str): What it measures
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    @staticmethod
+    def key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        """The metric's samples, as (name, labels, value)."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self.key(labels), 0)
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            return [(self.name, dict(key), value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that is set to whatever it currently is."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self.key(labels)] = value
+
+    def value(self, **labels) -> float | None:
+        return self._values.get(self.key(labels))
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            return [(self.name, dict(key), value) for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """
+    Counts observations into buckets by size, so percentiles can be estimated.
+
+    Attributes:
+        buckets (tuple): Upper bounds of the buckets, in increasing order
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self.key(labels)) or ([0], 0.0)
+        return sum(counts)
+
+    def quantile(self, q: float, **labels) -> float | None:
+        """Estimate a quantile: the upper bound of the bucket it falls in."""
+        counts, _ = self._values.get(self.key(labels)) or ([], 0.0)
+        seen, rank = 0, q * sum(counts)
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            seen += n
+            if n and seen >= rank:
+                return bound
+        return None
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        samples = []
+        with self._lock:
+            values = [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+        for key, (counts, total) in values:
+            labels = dict(key)
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = format_value(bound)
+                samples.append((f"{self.name}_bucket", {**labels, "le": le}, cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    The metrics a process keeps, by name.
+
+    Asking for a metric that already exists returns it, so every part of a
+    process that records, say, tokens processed adds to the same counter.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls: type, name: str, help: str, **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already a {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        """Every metric, in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+    def write(self, path: Path) -> None:
+        """Replace a file with the rendered metrics; a collector never sees half a file."""
+        write_atomically(Path(path), self.render().encode())
+
+
+# The metrics of this process
+REGISTRY = Registry()
+
+
+class FilterMetrics:
+    """
+    What a filter records about the tokens it handles.
+
+    Every sample is labelled with the filter's stage and worker, so the
+    files written by several filter processes can be collected together.
+
+    Attributes:
+        labels (dict): The stage and worker labels
+    """
+
+    def __init__(self, stage: str, worker: str, registry: Registry = REGISTRY) -> None:
+        self.labels = {"stage": stage, "worker": worker}
+        self.registry = registry
+        self.tokens = registry.counter(
+            "grin_tokens_total", "Tokens handled, by outcome: success, error or rejected"
+        )
+        self.processing = registry.histogram(
+            "grin_token_processing_seconds", "Time spent processing each token"
+        )
+        self.queue_wait = registry.histogram(
+            "grin_token_queue_wait_seconds", "Time tokens waited in the input bucket"
+        )
+        self.bucket_tokens = registry.gauge(
+            "grin_bucket_tokens", "Tokens in the filter's input bucket, by state"
+        )
+        self.paused_gauge = registry.gauge(
+            "grin_filter_paused", "1 while backpressure keeps the filter from claiming tokens"
+        )
+
+    def handled(self, outcome: str, n: int = 1) -> None:
+        self.tokens.inc(n, outcome=outcome, **self.labels)
+
+    def processed(self, seconds: float) -> None:
+        self.processing.observe(seconds, **self.labels)
+
+    def waited(self, seconds: float | None) -> None:
+        if seconds is not None:
+            self.queue_wait.observe(seconds, **self.labels)
+
+    def paused(self, paused: bool) -> None:
+        self.paused_gauge.set(int(paused), **self.labels)
+
+    def bucket(self, counts: dict) -> None:
+        """Record the counts from a TokenStore's counts()."""
+        for key, n in counts.items():
+            state = key.removesuffix("_tokens")
+            self.bucket_tokens.set(n, state=state, **self.labels)
@@ -1,4 +1,5 @@
 import os
+import json
 import subprocess
 import yaml
 import signal
@@ -66,6 +67,81 @@ class Orchestrator:
             out_bucket,
         ]
 
+        # Tell the filter how to wait for new tokens (poll or inotify)
+        if wakeup := config.get("global", {}).get("wakeup"):
+            extra_env["WAKEUP"] = wakeup
+
+        # Tell the filter how to make token moves durable (none, fsync or group)
+        if durability := config.get("global", {}).get("durability"):
+            extra_env["DURABILITY"] = durability
+
+        # Keep token logs in append-only files rather than in the tokens
+        if token_log := config.get("global", {}).get("token_log"):
+            extra_env["TOKEN_LOG_DIR"] = token_log["path"]
+            extra_env["TOKEN_LOG_MODE"] = token_log.get("mode", "sidecar")
+
+        # Keep tokens in a SQLite database rather than in the bucket directories
+        if token_store := config.get("global", {}).get("token_store"):
+            extra_env["TOKEN_STORE"] = token_store
+
+        # Choose how tokens are serialized (json, compact, orjson or msgpack)
+        if codec := config.get("global", {}).get("token_codec"):
+            extra_env["TOKEN_CODEC"] = codec
+
+        # Seconds a claim may go unrenewed before other filters reclaim it
+        if lease := config.get("global", {}).get("lease"):
+            extra_env["LEASE"] = str(lease)
+
+        # Retry tokens that failed for transient reasons, with backoff, and
+        # set aside those that run out of retries in a dead-letter bucket
+        if retry := config.get("global", {}).get("retry"):
+            extra_env["RETRY_ATTEMPTS"] = str(retry.get("attempts", 5))
+            if "base_delay" in retry:
+                extra_env["RETRY_BASE_DELAY"] = str(retry["base_delay"])
+            if "max_delay" in retry:
+                extra_env["RETRY_MAX_DELAY"] = str(retry["max_delay"])
+            if dead_letter := retry.get("dead_letter"):
+                extra_env["DEAD_LETTER"] = str(self.pipeline.bucket(dead_letter))
+
+        # Export each filter's metrics to a directory, in the Prometheus text format
+        if metrics := config.get("global", {}).get("metrics"):
+            extra_env["METRICS_DIR"] = metrics["path"]
+            if "interval" in metrics:
+                extra_env["METRICS_INTERVAL"] = str(metrics["interval"])
+
+        # Record how long each phase of each token takes, as JSON lines
+        if timings := config.get("global", {}).get("timings"):
+            extra_env["TIMINGS"] = timings
+
+        # Share one bandwidth budget, which may vary with the time of day,
+        # among all the filters' downloads and uploads
+        if bandwidth := config.get("global", {}).get("bandwidth"):
+            extra_env["BANDWIDTH_FILE"] = bandwidth["path"]
+            extra_env["BANDWIDTH_RATE"] = str(bandwidth.get("rate", 0))
+            extra_env["BANDWIDTH_PROFILES"] = json.dumps(bandwidth.get("profiles", []))
+
+        # Pause the filter while its output bucket holds wip_limit tokens
+        for bucket in config.get("buckets", []):
+            if bucket.get("name") == filt["pipe"]["out"] and bucket.get("wip_limit"):
+                extra_env["WIP_LIMIT"] = str(bucket["wip_limit"])
+
+        # Pause the filter while the processing bucket's disk is nearly full
+        if filt.get("min_free_space"):
+            extra_env["MIN_FREE_SPACE"] = str(filt["min_free_space"])
+            extra_env["FREE_SPACE_PATH"] = config.get("global", {}).get("processing_bucket", "")
+
+        # Choose which waiting token the filter takes first (fifo or priority)
+        if filt.get("order"):
+            extra_env["TOKEN_ORDER"] = filt["order"]
+
+        # Let the filter take several tokens at a time
+        if filt.get("batch_size"):
+            extra_env["BATCH_SIZE"] = str(filt["batch_size"])
+
+        # Let the filter handle several tokens at once in worker threads
+        if filt.get("concurrency"):
+            extra_env["CONCURRENCY"] = str(filt["concurrency"])
+
         # Add any filter-specific environment variables
         if filt.get("args"):
             for k, v in filt.get("args").items():
@@ -1,9 +1,34 @@
-import json
+import asyncio
+import copy
+import functools
+import inspect
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
-from time import sleep
-from typing import Optional
+from typing import Iterator, Optional
+
+from pipeline import token_codecs
+from pipeline.backpressure import Backpressure
+from pipeline.instrumentation import FilterHook, TimingRecorder
+from pipeline.metrics import FilterMetrics
+from pipeline.retry import RetryPolicy, RetryScheduler, describe_error
+from pipeline.token_codecs import JsonCodec, MsgpackCodec, get_codec
+from pipeline.token_log import SidecarLog, open_token_log
+from pipeline.token_store import (
+    DURABILITY_MODES,
+    ORDERS,
+    GroupCommit,
+    TokenStore,
+    claim_suffix,
+    default_worker_id,
+    open_token_store,
+    write_atomically,
+)
+from pipeline.watcher import make_watcher
 
 logger: logging.Logger = logging.getLogger(__name__)
 
@@ -57,30 +82,48 @@ class Token:
 
 # Utilities for reading and writing Tokens
 
+DEFAULT_CODEC = JsonCodec()
+
 
 def load_token(token_file: Path) -> Token:
-    """Load a token from a JSON file.
+    """Load a token from a token file.
+
+    The file may have been written with any codec; see token_codecs.
 
     Args:
-        token_file (Path): Path to the JSON token file
+        token_file (Path): Path to the token file
 
     Returns:
         Token: The loaded token instance
     """
-    with token_file.open("r") as f:
-        token_info = json.load(f)
+    with token_file.open("rb") as f:
+        token_info = token_codecs.decode(f.read())
         return Token(token_info)
 
 
-def dump_token(token, destination: Path) -> None:
-    """Save a token to a JSON file.
+def dump_token(
+    token,
+    destination: Path,
+    fsync: bool = False,
+    codec: JsonCodec | MsgpackCodec | None = None,
+) -> None:
+    """Save a token to a token file.
+
+    The token is written to a temporary file beside the destination and
+    renamed into place, so a crash can never leave a truncated token behind
+    and readers never see a partly written one.
 
     Args:
         token (Token): The token to save
         destination (Path): Path where the token file should be written
+        fsync (bool): If True, flush the file to disk before renaming it,
+                      so the rename can never expose an empty file after a
+                      power loss. Defaults to False.
+        codec (JsonCodec | MsgpackCodec | None): How to serialize the token;
+                      defaults to indented JSON.
     """
-    with destination.open("w+") as f:
-        json.dump(token.content, fp=f, indent=2)
+    data = (codec or DEFAULT_CODEC).encode(token.content)
+    write_atomically(destination, data, fsync)
 
 
 class Pipe:
@@ -91,20 +134,106 @@ class Pipe:
     bucket, including token locking (marking) to prevent concurrent processing,
     error handling, and atomic operations.
 
+    The tokens themselves are kept by a TokenStore: by default, as files in
+    the bucket directories (see DirectoryTokenStore), or in a SQLite
+    database. Tokens are claimed before they are read, so several processes
+    may take tokens from the same bucket: each token can be claimed by only
+    one of them. Workers sharing a bucket should each be given a worker_id,
+    which marks their claims (in the directory store, the claim file is
+    named <barcode>.<worker_id>.bak) so that no worker can ever clobber or
+    delete another worker's claim.
+
     Attributes:
         input (Path): Input bucket directory path
         output (Path): Output bucket directory path
         token (Token | None): Currently held token being processed
+        batch (list[Token]): Tokens held from take_tokens
+        worker_id (str | None): Identifies this worker's claims; None gives
+                                plain <barcode>.bak claim files
+        durability (str): How token moves are made to survive a power loss:
+                          "none" relies on atomic renames alone, "fsync"
+                          flushes every move to disk, and "group" shares
+                          directory flushes among moves (see GroupCommit).
+                          Defaults to the DURABILITY environment variable,
+                          or "none".
+        token_log (SidecarLog | None): If set, each move takes the log
+                          entries out of the token and appends them to this
+                          log, keeping token files small. Defaults to the log
+                          in the TOKEN_LOG_DIR environment variable, kept in
+                          TOKEN_LOG_MODE ("sidecar" or "bucket"), if any.
+        codec (JsonCodec | MsgpackCodec): How tokens are written to the output
+                          bucket; see token_codecs. Defaults to the codec
+                          named by the TOKEN_CODEC environment variable, or
+                          indented JSON.
+        store (TokenStore): Where the buckets' tokens are kept. Defaults to
+                          the SQLite database named by the TOKEN_STORE
+                          environment variable, or the bucket directories.
+        order (str): Which waiting token take_token takes first: "fifo" for
+                          the one waiting longest, or "priority" for the one
+                          with the highest "priority" property, and among
+                          those the one waiting longest. Defaults to the
+                          TOKEN_ORDER environment variable, or "fifo".
     """
 
-    def __init__(self, in_path: Path, out_path: Path) -> None:
+    DURABILITY_MODES = DURABILITY_MODES
+
+    def __init__(
+        self,
+        in_path: Path,
+        out_path: Path,
+        worker_id: str | None = None,
+        durability: str | None = None,
+        token_log: SidecarLog | None = None,
+        codec: JsonCodec | MsgpackCodec | None = None,
+        store: TokenStore | None = None,
+        order: str | None = None,
+    ) -> None:
         self.input = in_path
         self.output = out_path
         self.token: Token | None = None
+        self.batch: list[Token] = []
+        if worker_id is not None and ("." in worker_id or "/" in worker_id):
+            raise ValueError(f"worker id may not contain '.' or '/': {worker_id}")
+        self.worker_id = worker_id
+        self.durability: str = durability or os.environ.get("DURABILITY", "none")
+        if self.durability not in self.DURABILITY_MODES:
+            raise ValueError(f"unknown durability mode: {self.durability}")
+        self.store = store or open_token_store(os.environ.get("TOKEN_STORE"), self.durability)
+        self.order: str = order or os.environ.get("TOKEN_ORDER", "fifo")
+        if self.order not in ORDERS:
+            raise ValueError(f"unknown token order: {self.order}")
+        self.token_log = token_log or open_token_log(
+            os.environ.get("TOKEN_LOG_DIR"), os.environ.get("TOKEN_LOG_MODE", "sidecar")
+        )
+        self.codec = codec or get_codec(os.environ.get("TOKEN_CODEC", "json"))
 
     def __repr__(self) -> str:
         return f"Pipe('{self.input}', '{self.output}')"
 
+    def for_worker(self, worker_id: str) -> "Pipe":
+        """Make a pipe between the same buckets for another worker.
+
+        Args:
+            worker_id (str): Identifies the new worker's claims
+
+        Returns:
+            Pipe: A copy of this pipe holding no tokens
+        """
+        pipe = copy.copy(self)
+        pipe.token = None
+        pipe.batch = []
+        pipe.worker_id = worker_id
+        return pipe
+
+    @property
+    def group_commit(self) -> GroupCommit | None:
+        """The GroupCommit making moves durable in "group" mode, if any."""
+        return getattr(self.store, "group_commit", None)
+
+    @group_commit.setter
+    def group_commit(self, group_commit: GroupCommit) -> None:
+        self.store.group_commit = group_commit
+
     def in_path(self, token) -> Path:
         if token is not None and token.name is not None:
             return self.input / Path(token.name).with_suffix(".json")
@@ -112,19 +241,23 @@ class Pipe:
             raise ValueError("no token or token name")
 
     def out_path(self, token) -> Path:
-        if self.token and self.token.name:
+        if token is not None and token.name is not None:
             return self.output / Path(token.name).with_suffix(".json")
         else:
             raise ValueError("no token or token name")
 
+    @property
+    def claim_suffix(self) -> str:
+        return claim_suffix(self.worker_id)
+
     def marked_path(self, token) -> Path:
-        if self.token and self.token.name:
-            return self.input / Path(token.name).with_suffix(".bak")
+        if token is not None and token.name is not None:
+            return self.input / f"{token.name}{self.claim_suffix}"
         else:
             raise ValueError("no token or token name")
 
     def error_path(self, token) -> Path:
-        if self.token and self.token.name:
+        if token is not None and token.name is not None:
             return self.input / Path(token.name).with_suffix(".err")
         else:
             raise ValueError("no token or token name")
@@ -158,18 +291,71 @@ class Pipe:
         else:
             raise ValueError("pipe doesn't contain a token")
 
-    def list_input_tokens(self) -> list[Token] | None:
-        all_tokens = []
-        for f in self.input.glob("*.json"):
-            all_tokens.append(load_token(f))
-        return all_tokens
+    def list_input_barcodes(self) -> Iterator[str]:
+        """Yield the barcodes of the tokens waiting in the input bucket.
+
+        Only the listing is read, never the tokens themselves; in the
+        directory store, token files are named after their barcodes.
+
+        Yields:
+            str: The barcode of each waiting token
+        """
+        return self.store.barcodes(self.input)
+
+    def list_input_tokens(self) -> Iterator[Token]:
+        """Yield the tokens waiting in the input bucket, loading each in turn.
+
+        Use list_input_barcodes when only the barcodes are needed.
+
+        Yields:
+            Token: Each waiting token
+        """
+        for barcode in self.list_input_barcodes():
+            content = self.store.load(self.input, barcode)
+            if content is not None:  # else claimed by another worker since the listing
+                yield Token(content)
+
+    def waited(self, token: Token) -> float | None:
+        """Seconds a token taken through this pipe waited in the input bucket."""
+        return self.store.waited(self.input, token.name, self.worker_id)
+
+    def list_errored_barcodes(self) -> Iterator[str]:
+        """Yield the barcodes of the errored tokens in the input bucket."""
+        return self.store.barcodes(self.input, "error")
+
+    def take_errored_token(self, barcode: str) -> Token | None:
+        """Claim an errored token in the input bucket, to retry or set it aside.
+
+        The token is not held by the pipe; move it on with move_token.
+
+        Args:
+            barcode (str): The token's barcode
+
+        Returns:
+            Token | None: The token, or None if it is no longer in error
+        """
+        claimed = self.store.claim(self.input, self.worker_id, barcode, state="error")
+        return Token(claimed[0]) if claimed else None
+
+    def claim(self, token_path: Path) -> Path | None:
+        """Atomically claim a token file by renaming it to a claim file.
+
+        Only meaningful for the directory store; see DirectoryTokenStore.claim_file.
+
+        Args:
+            token_path (Path): The .json token file to claim
+
+        Returns:
+            Path | None: The claim file, or None if another worker
+                         got there first
+        """
+        return self.store.claim_file(token_path, self.worker_id)
 
     def take_token(self, barcode: str | None = None):
         """Take the next available token from the input bucket.
 
-        Finds the first available JSON token file, loads it, and marks it
-        as being processed (renames to .bak extension) to prevent concurrent
-        access by other processes.
+        Claims the first available token, and only then loads it. If another
+        process claims a candidate first, the next candidate is tried.
 
         Returns:
             Token | None: The taken token, or None if no tokens are available
@@ -179,71 +365,125 @@ class Pipe:
             logging.error("there's already a current token")
             return None
 
-        if barcode is None:
-            try:
-                # Find the first available token file in the input bucket
-                token_path = next(self.input.glob("*.json"))
-                # Load the token and mark it as being processed
-                self.token = load_token(token_path)
-                self.mark_token()  # Rename to .bak to prevent concurrent access
-                return self.token
-
-            except StopIteration:
-                # No tokens available for processing
-                return None
-        else:
-            try:
-                token_path = self.input / Path(barcode).with_suffix(".json")
-                self.token = load_token(token_path)
-                self.mark_token()  # Rename to .bak to prevent concurrent access
-                return self.token
-            except FileNotFoundError:
-                logging.error(f"{token_path} does not exist")
-                return None
+        claimed = self.store.claim(self.input, self.worker_id, barcode, order=self.order)
+        if claimed:
+            self.token = Token(claimed[0])
+            return self.token
+
+        if barcode is not None:
+            logging.error(f"{self.input / Path(barcode).with_suffix('.json')} does not exist")
+        return None
+
+    def take_tokens(self, n: int) -> list[Token]:
+        """Take up to n tokens from the input bucket in a single scan.
+
+        Each token is claimed just as take_token claims one. The tokens are
+        held in the pipe's batch until each one is put with
+        put_token(token=...) or put_token_back(token=...).
+
+        Args:
+            n (int): Maximum number of tokens to take
+
+        Returns:
+            list[Token]: The taken tokens; empty if none are available
+        """
+        if self.batch:
+            logging.error("there's already a batch of tokens")
+            return []
+
+        claimed = self.store.claim(self.input, self.worker_id, n=n, order=self.order)
+        self.batch = [Token(content) for content in claimed]
+        return list(self.batch)
+
+    async def atake_token(self, barcode: str | None = None) -> Token | None:
+        """Take a token without blocking the event loop; see take_token."""
+        return await asyncio.to_thread(self.take_token, barcode)
 
     def mark_token(self):
-        """Mark the current token as being processed by renaming its file."""
+        """Mark the current token as being processed by claiming it."""
         if self.token and self.token.name:
-            unmarked_path: Path = self.in_path(self.token)
-            marked_path: Path = self.marked_path(self.token)
-            if unmarked_path.is_file():
-                # Rename .json to .bak to signal it's being processed
-                unmarked_path.rename(marked_path)
-            else:
-                FileNotFoundError(f"{unmarked_path} does not exist")
+            if not self.store.claim(self.input, self.worker_id, self.token.name):
+                raise FileNotFoundError(f"{self.in_path(self.token)} does not exist")
+
+    def delete_marked_token(self, token: Token | None = None):
+        token = token or self.token
+        if token is None or token.name is None:
+            raise ValueError("no token or token name")
+        self.store.release(self.input, token.name, self.worker_id)
 
-    def delete_marked_token(self):
-        marked_path: Path = self.marked_path(self.token)
-        marked_path.unlink()
+    def release(self, token: Token) -> None:
+        """Stop holding a token, whether it is the current token or in the batch."""
+        if token is self.token:
+            self.token = None
+        else:
+            self.batch.remove(token)
 
-    def put_token(self, errorFlg: bool = False) -> None:
+    def put_token(self, errorFlg: bool = False, token: Token | None = None) -> None:
         """Move the current token to the output bucket or error state.
 
         Args:
             errorFlg (bool): If True, save token with .err extension instead
                            of moving to output bucket. Defaults to False.
+            token (Token | None): A token held in the batch; defaults to
+                                  the current token.
         """
-        if self.token:
+        token = token or self.token
+        if token:
             if errorFlg:
-                error_path = self.error_path(self.token)
-                dump_token(self.token, error_path)
+                self.move_token(token, self.input, "error")
             else:
-                dump_token(self.token, self.out_path(self.token))
+                self.move_token(token, self.output)
+            self.release(token)
 
-            self.delete_marked_token()
-            self.token = None
+    async def aput_token(self, errorFlg: bool = False, token: Token | None = None) -> None:
+        """Put a token without blocking the event loop; see put_token."""
+        await asyncio.to_thread(self.put_token, errorFlg, token)
 
-    def put_token_back(self, errorFlg: bool = False) -> None:
-        if self.token:
-            if errorFlg:
-                put_back_path = self.error_path(self.token)
-            else:
-                put_back_path = self.in_path(self.token)
+    def put_token_back(self, errorFlg: bool = False, token: Token | None = None) -> None:
+        token = token or self.token
+        if token:
+            self.move_token(token, self.input, "error" if errorFlg else "waiting")
+            self.release(token)
 
-            dump_token(self.token, put_back_path)
+    def move_token(self, token: Token, bucket: Path, state: str = "waiting") -> None:
+        """Write a claimed token to a bucket and give up the claim.
 
-            self.delete_marked_token()
-            self.token = None
+        Args:
+            token (Token): A token claimed through this pipe
+            bucket (Path): The bucket the token should be written to
+            state (str): "waiting", or "error" to mark the token as failed
+        """
+        if token is None or token.name is None:
+            raise ValueError("no token or token name")
+        if self.token_log is not None and token.content.get("log"):
+            self.token_log.append(token.name, token.content.pop("log"), self.input.name)
+        data = self.codec.encode(token.content)
+        priority = int(token.get_prop("priority") or 0)
+        self.store.move(self.input, token.name, self.worker_id, bucket, data, state, priority)
+
+    def recover(self, stale_after: float = 60) -> int:
+        """Settle token moves that a crash left uncommitted.
+
+        Args:
+            stale_after (float): Ignore unfinished moves younger than this
+                                 many seconds, which may belong to live workers
+
+        Returns:
+            int: Number of tokens put back
+        """
+        return self.store.recover(self.input, self.output, stale_after)
+
+    def reclaim(self, lease: float) -> int:
+        """Return abandoned claims in the input bucket to the waiting tokens.
+
+        Args:
+            lease (float): Seconds a claim may go unrenewed before it is
+                           taken to be abandoned
+
+        Returns:
+            int: Number of tokens returned
+        """
+        return self.store.reclaim(self.input, lease)
 
 
 class Filter:
@@ -257,67 +497,418 @@ class Filter:
     Attributes:
         pipe (Pipe): The pipe for token input/output operations
         stage_name (str): Name of the processing stage for logging
+        poll_interval (int): Seconds to wait when no tokens are available
+        wakeup (str): How to wait for new tokens: "poll" sleeps for
+                      poll_interval, "inotify" wakes as soon as a token
+                      lands in the input bucket. Defaults to the WAKEUP
+                      environment variable, or "poll".
+        batch_size (int): Number of tokens run_forever takes at a time;
+                          above 1, tokens are handled with run_batch.
+                          Defaults to the BATCH_SIZE environment variable, or 1.
+        concurrency (int): Number of worker threads run_forever uses; above
+                           1, tokens are handled with run_concurrent.
+                           Defaults to the CONCURRENCY environment variable, or 1.
+        lease (float): Seconds a claim may go unrenewed before another
+                       process may reclaim it. run_forever renews this
+                       filter's claims and reclaims abandoned ones in its
+                       input bucket. Defaults to the LEASE environment
+                       variable, or 300.
+        retry (RetryPolicy): How run_forever retries the errored tokens in
+                             the input bucket; read from the environment
+                             by default, which leaves retries off
+        metrics (FilterMetrics): Counts and times the tokens the filter
+                                 handles. run_forever writes them to the
+                                 METRICS_DIR directory, if it is set.
+        hooks (list[FilterHook]): Called at each phase of handling a token;
+                                  see pipeline.instrumentation. If the
+                                  TIMINGS environment variable names a
+                                  file, a TimingRecorder writing to it is
+                                  added.
+        backpressure (Backpressure): When to stop claiming tokens: while
+                                     the output bucket is over its WIP
+                                     limit, or the disk is nearly full.
+                                     Read from the environment by
+                                     default, which sets no limits.
+        per_token (bool): Whether the filter handles tokens one at a time,
+                          through whatever pipe it is given, so that
+                          run_forever may hand them to worker threads.
+                          Filters that sweep the whole input bucket in
+                          each run_once (Monitors) set it False.
     """
 
-    def __init__(self, pipe: Pipe, poll_interval: int = 5):
+    per_token: bool = True
+
+    def __init__(
+        self,
+        pipe: Pipe,
+        poll_interval: int = 5,
+        wakeup: str | None = None,
+        batch_size: int | None = None,
+        concurrency: int | None = None,
+        lease: float | None = None,
+        retry: RetryPolicy | None = None,
+        hooks: list[FilterHook] | None = None,
+        backpressure: Backpressure | None = None,
+    ):
         self.pipe = pipe
         self.stage_name: str = self.__class__.__name__.lower()
         self.poll_interval = poll_interval
+        self.wakeup: str = wakeup or os.environ.get("WAKEUP", "poll")
+        self.batch_size: int = batch_size or int(os.environ.get("BATCH_SIZE", 1))
+        self.concurrency: int = concurrency or int(os.environ.get("CONCURRENCY", 1))
+        self.lease: float = lease or float(os.environ.get("LEASE", 300))
+        self.retry: RetryPolicy = retry or RetryPolicy.from_env()
+        self.metrics = FilterMetrics(self.stage_name, pipe.worker_id or default_worker_id())
+        self.hooks: list[FilterHook] = list(hooks or [])
+        if timings := os.environ.get("TIMINGS"):
+            self.hooks.append(TimingRecorder(Path(timings)))
+        self.backpressure: Backpressure = backpressure or Backpressure.from_env()
+        self.stop_event = threading.Event()
 
     def log_to_token(self, token, level, message):
         token.write_log(message, level, self.stage_name)
 
-    def run_once(self) -> bool:
+    def call_hooks(self, name: str, *args) -> None:
+        """Call a hook method on every hook.
+
+        Callers test self.hooks first, so a filter without hooks does no
+        more than that.
+        """
+        for hook in self.hooks:
+            try:
+                getattr(hook, name)(self, *args)
+            except Exception as e:
+                logging.exception(f"{self.stage_name} hook {name} failed: {e}")
+
+    def paused(self) -> bool:
+        """Whether backpressure says not to claim tokens just now.
+
+        Returns:
+            bool: True while the output bucket is over its WIP limit or
+                  free space is short
+        """
+        if not self.backpressure.enabled:
+            return False
+        paused = self.backpressure.check(self.pipe.store, self.pipe.output) is not None
+        self.metrics.paused(paused)
+        return paused
+
+    def run_once(self, pipe: Pipe | None = None) -> bool:
         """Process a single token if available.
 
         Takes a token from the input pipe, validates it, processes it,
         and moves it to the appropriate output location (success or error).
+        Nothing is taken while the filter is paused.
+
+        Args:
+            pipe (Pipe | None): The pipe to use; defaults to the filter's pipe.
+                                Worker threads each pass their own.
 
         Returns:
             bool: True if a token was processed (successfully or with error),
-                 False if no tokens were available
+                 False if no tokens were available or the filter is paused
         """
-        token: Token | None = self.pipe.take_token()
+        if self.paused():
+            return False
+        pipe = pipe or self.pipe
+        if self.hooks:
+            self.call_hooks("pre_take", pipe)
+        token: Token | None = pipe.take_token()
+        if self.hooks:
+            self.call_hooks("post_take", pipe, token)
         if not token:
             # logging.info("No tokens available")
             return False
+        self.metrics.waited(pipe.waited(token))
 
-        if self.validate_token(token) is False:
-            self.log_to_token(token, "ERROR", "Token did not validate")
-            logging.error("token did not validate")
-            self.pipe.put_token(errorFlg=True)
-
+        valid = self.validate_token(token) is not False
+        if self.hooks:
+            self.call_hooks("post_validate", pipe, token, valid)
+        if not valid:
+            self._reject_token(pipe, token)
             return False
 
+        started = time.perf_counter()
         try:
             processed: bool = self.process_token(token)
-            if processed:
-                logging.debug(f"Processed token: {token.name}")
-                self.log_to_token(token, "INFO", "Stage completed successfully")
-                self.pipe.put_token()
-            else:
-                logging.error(f"Did not proces token: {token.name}")
-                self.log_to_token(token, "ERROR", "Stage did not run successfully")
-                self.pipe.put_token(errorFlg=True)
-
+            self.metrics.processed(time.perf_counter() - started)
+            if self.hooks:
+                self.call_hooks("post_process", pipe, token, bool(processed))
+            self._route_token(pipe, token, processed)
             return True
 
         except Exception as e:
-            self.log_to_token(token, "ERROR", f"in {self.stage_name}: {str(e)}")
-            logging.error(f"Error processing {token.name}: {str(e)}")
-            self.pipe.put_token(errorFlg=True)
+            self.metrics.processed(time.perf_counter() - started)
+            if self.hooks:
+                self.call_hooks("post_process", pipe, token, False)
+            self._fail_token(pipe, token, e)
             return False
 
+    def run_batch(self, n: int | None = None, pipe: Pipe | None = None) -> bool:
+        """Process a batch of tokens if any are available.
+
+        Takes up to n tokens in one scan of the input bucket, validates them
+        with validate_batch and processes the valid ones with process_batch.
+        Each token is then moved to the output bucket or to .err on its own.
+
+        Args:
+            n (int | None): Maximum batch size; defaults to batch_size
+            pipe (Pipe | None): The pipe to use; defaults to the filter's pipe
+
+        Returns:
+            bool: True if a batch was processed, False if no tokens were
+                 available, none of them validated or the filter is paused
+        """
+        if self.paused():
+            return False
+        pipe = pipe or self.pipe
+        if self.hooks:
+            self.call_hooks("pre_take", pipe)
+        tokens: list[Token] = pipe.take_tokens(n or self.batch_size)
+        if self.hooks:
+            for token in tokens or [None]:
+                self.call_hooks("post_take", pipe, token)
+        if not tokens:
+            return False
+        for token in tokens:
+            self.metrics.waited(pipe.waited(token))
+
+        valid: list[Token] = []
+        for token, is_valid in zip(tokens, self.validate_batch(tokens)):
+            if self.hooks:
+                self.call_hooks("post_validate", pipe, token, is_valid is not False)
+            if is_valid is False:
+                self._reject_token(pipe, token)
+            else:
+                valid.append(token)
+        if not valid:
+            return False
+
+        started = time.perf_counter()
+        try:
+            results: list[bool] = self.process_batch(valid)
+        except Exception as e:
+            for token in valid:
+                if self.hooks:
+                    self.call_hooks("post_process", pipe, token, False)
+                self._fail_token(pipe, token, e)
+            return False
+        finally:
+            # the batch's time, shared among its tokens
+            elapsed = (time.perf_counter() - started) / len(valid)
+            for token in valid:
+                self.metrics.processed(elapsed)
+
+        for token, processed in zip(valid, results):
+            if self.hooks:
+                self.call_hooks("post_process", pipe, token, bool(processed))
+            self._route_token(pipe, token, processed)
+        return True
+
+    def record_error(self, token: Token, error: Exception | str) -> None:
+        """Note on the token how this stage failed, so it can be retried if
+        the failure was transient; see pipeline.retry."""
+        token.content["last_error"] = describe_error(self.stage_name, error)
+
+    def record_success(self, token: Token) -> None:
+        """Clear the token's record of failures at this stage."""
+        token.content.pop("last_error", None)
+        token.content.pop("retry_attempts", None)
+
+    def _reject_token(self, pipe: Pipe, token: Token) -> None:
+        self.metrics.handled("rejected")
+        self.log_to_token(token, "ERROR", "Token did not validate")
+        logging.error("token did not validate")
+        self.record_error(token, "Token did not validate")
+        pipe.put_token(errorFlg=True, token=token)
+        if self.hooks:
+            self.call_hooks("post_put", pipe, token)
+
+    def _route_token(self, pipe: Pipe, token: Token, processed: bool) -> None:
+        self.metrics.handled("success" if processed else "error")
+        if processed:
+            logging.debug(f"Processed token: {token.name}")
+            self.log_to_token(token, "INFO", "Stage completed successfully")
+            self.record_success(token)
+            pipe.put_token(token=token)
+        else:
+            logging.error(f"Did not proces token: {token.name}")
+            self.log_to_token(token, "ERROR", "Stage did not run successfully")
+            # keep the error process_batch recorded, which says whether to retry
+            if "last_error" not in token.content:
+                self.record_error(token, "Stage did not run successfully")
+            pipe.put_token(errorFlg=True, token=token)
+        if self.hooks:
+            self.call_hooks("post_put", pipe, token)
+
+    def _fail_token(self, pipe: Pipe, token: Token, e: Exception) -> None:
+        self.metrics.handled("error")
+        self.log_to_token(token, "ERROR", f"in {self.stage_name}: {str(e)}")
+        logging.error(f"Error processing {token.name}: {str(e)}")
+        self.record_error(token, e)
+        pipe.put_token(errorFlg=True, token=token)
+        if self.hooks:
+            self.call_hooks("post_put", pipe, token)
+
+    def _run_next(self, pipe: Pipe) -> bool:
+        if not self.per_token:
+            return self.run_once()  # sweeps the filter's own pipe
+        if self.batch_size > 1:
+            return self.run_batch(pipe=pipe)
+        return self.run_once(pipe)
+
     def run_forever(self):
-        """Continuously process tokens with polling.
+        """Continuously process tokens, waiting when none are available.
+
+        When the input bucket is empty the filter waits up to poll_interval
+        seconds; in "inotify" wakeup mode it resumes as soon as a token is
+        put into the bucket. If concurrency is above 1 the tokens are
+        handled by run_concurrent instead, unless the filter is not
+        per_token, which always runs in one thread.
+        """
+        self.pipe.recover()
+        self.keep_leases()
+        self.keep_retrying()
+        self.keep_metrics()
+        if self.concurrency > 1:
+            if self.per_token:
+                return self.run_concurrent(self.concurrency)
+            logging.warning(f"{self.stage_name} sweeps its input bucket; running it in one thread")
+
+        watcher = make_watcher(self.pipe.input, self.wakeup)
+        try:
+            while not self.stop_event.is_set():
+                processed = self._run_next(self.pipe)
+                if not processed:
+                    watcher.wait(self.poll_interval)
+        finally:
+            watcher.close()
+
+    def run_concurrent(self, workers: int):
+        """Continuously process tokens with a pool of worker threads.
+
+        Each worker takes tokens through its own copy of the pipe, with its
+        own worker id, so claims never collide and every token is still
+        logged and routed individually. Idle workers wait up to
+        poll_interval, and are woken early when the watcher sees a token
+        arrive in the input bucket.
 
         Args:
-            poll_interval (int): Seconds to wait between polls when no
-                               tokens are available. Defaults to 5.
+            workers (int): Number of worker threads
+
+        Raises:
+            TypeError: If the filter is not per_token
         """
-        while True:
-            if not self.run_once():
-                sleep(self.poll_interval)
+        if not self.per_token:
+            raise TypeError(f"{self.stage_name} sweeps its input bucket; it cannot run in workers")
+        base_id = self.pipe.worker_id or default_worker_id()
+        pipes = [self.pipe.for_worker(f"{base_id}-{n}") for n in range(workers)]
+        arrivals = threading.Condition()
+
+        def work(pipe: Pipe):
+            while not self.stop_event.is_set():
+                try:
+                    if self._run_next(pipe):
+                        continue
+                except Exception as e:
+                    logging.exception(f"{self.stage_name} worker {pipe.worker_id} failed: {e}")
+                with arrivals:
+                    arrivals.wait(self.poll_interval)
+
+        watcher = make_watcher(self.pipe.input, self.wakeup)
+        try:
+            with ThreadPoolExecutor(workers, thread_name_prefix=self.stage_name) as pool:
+                for pipe in pipes:
+                    pool.submit(work, pipe)
+                while not self.stop_event.is_set():
+                    if watcher.wait(self.poll_interval):
+                        with arrivals:
+                            arrivals.notify_all()
+                with arrivals:
+                    arrivals.notify_all()
+        finally:
+            watcher.close()
+
+    def keep_leases(self) -> threading.Thread:
+        """Start a thread that looks after claims until the filter is stopped.
+
+        Every third of a lease it renews the claims this filter holds and
+        returns abandoned claims in the input bucket, left by workers that
+        died or hung, to the waiting tokens.
+
+        Returns:
+            threading.Thread: The (daemon) thread
+        """
+
+        def tend():
+            while True:
+                try:
+                    self.pipe.store.renew()
+                    reclaimed = self.pipe.reclaim(self.lease)
+                    if reclaimed:
+                        logging.info(f"{self.stage_name} reclaimed {reclaimed} tokens")
+                except Exception as e:
+                    logging.exception(f"{self.stage_name} could not keep its leases: {e}")
+                if self.stop_event.wait(self.lease / 3):
+                    return
+
+        thread = threading.Thread(target=tend, name=f"{self.stage_name}-leases", daemon=True)
+        thread.start()
+        return thread
+
+    def keep_retrying(self) -> threading.Thread | None:
+        """Start a thread that retries errored tokens until the filter is stopped.
+
+        Returns:
+            threading.Thread | None: The (daemon) thread, or None if retries are off
+        """
+        if self.retry.attempts <= 0:
+            return None
+        scheduler = RetryScheduler(self.pipe, self.retry)
+        thread = threading.Thread(
+            target=scheduler.run_forever,
+            args=(self.stop_event,),
+            name=f"{self.stage_name}-retries",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def keep_metrics(self) -> threading.Thread | None:
+        """Start a thread that exports the filter's metrics until it is stopped.
+
+        Every METRICS_INTERVAL seconds (15 by default) the thread counts
+        the tokens in the input bucket and rewrites
+        <METRICS_DIR>/<stage>-<worker>.prom in the Prometheus text format.
+
+        Returns:
+            threading.Thread | None: The (daemon) thread, or None if
+                                     METRICS_DIR is not set
+        """
+        directory = os.environ.get("METRICS_DIR")
+        if not directory:
+            return None
+        interval = float(os.environ.get("METRICS_INTERVAL", 15))
+        path = Path(directory) / f"{self.stage_name}-{self.metrics.labels['worker']}.prom"
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        def export():
+            while True:
+                try:
+                    self.metrics.bucket(self.pipe.store.counts(self.pipe.input))
+                    self.metrics.registry.write(path)
+                except Exception as e:
+                    logging.exception(f"{self.stage_name} could not export metrics: {e}")
+                if self.stop_event.wait(interval):
+                    return
+
+        thread = threading.Thread(target=export, name=f"{self.stage_name}-metrics", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Ask run_forever or run_concurrent to return after the current token."""
+        self.stop_event.set()
 
     def process_token(self, token: Token):
         """Process a token - must be implemented by subclasses.
@@ -333,6 +924,43 @@ class Filter:
         """
         raise NotImplementedError("Subclasses must implement this")
 
+    def process_batch(self, tokens: list[Token]) -> list[bool]:
+        """Process a batch of tokens.
+
+        By default each token is processed with process_token, and a token
+        whose processing raises is logged, has its error recorded (see
+        record_error) and is counted as failed without affecting the rest
+        of the batch. Subclasses that can amortise work
+        across tokens (one bulk request instead of many) override this.
+
+        Args:
+            tokens (list[Token]): The tokens to process
+
+        Returns:
+            list[bool]: Whether each token was processed, in the same order
+        """
+        results = []
+        for token in tokens:
+            try:
+                results.append(self.process_token(token))
+            except Exception as e:
+                self.log_to_token(token, "ERROR", f"in {self.stage_name}: {str(e)}")
+                logging.error(f"Error processing {token.name}: {str(e)}")
+                self.record_error(token, e)
+                results.append(False)
+        return results
+
+    def validate_batch(self, tokens: list[Token]) -> list[bool]:
+        """Validate a batch of tokens; by default with validate_token.
+
+        Args:
+            tokens (list[Token]): The tokens to validate
+
+        Returns:
+            list[bool]: Whether each token is valid, in the same order
+        """
+        return [self.validate_token(token) for token in tokens]
+
     def validate_token(self, token: Token) -> bool:
         """Validate a token before processing - must be implemented by subclasses.
 
@@ -348,6 +976,184 @@ class Filter:
         raise NotImplementedError("Subclasses must implement this")
 
 
+class AsyncFilter(Filter):
+    """
+    Base class for pipeline stages that spend most of their time waiting.
+
+    An AsyncFilter's process_token is a coroutine, and many tokens are in
+    flight at once on a single event loop: while one token waits on the
+    network the others keep going. The number of tokens in flight is
+    bounded by a semaphore of size concurrency, and each in-flight token is
+    claimed through its own copy of the pipe, as in Filter.run_concurrent.
+    validate_token may be either a plain method or a coroutine.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loops = threading.local()
+
+    def event_loop(self) -> asyncio.AbstractEventLoop:
+        """The calling thread's event loop for run_once.
+
+        Each thread keeps one loop for as long as the filter lives, so
+        connections pooled on it (see GrinClient.async_http) are reused
+        from one token to the next rather than opened afresh each time.
+        """
+        loop = getattr(self._loops, "loop", None)
+        if loop is None or loop.is_closed():
+            loop = self._loops.loop = asyncio.new_event_loop()
+        return loop
+
+    def run_once(self, pipe: Pipe | None = None) -> bool:
+        """Process a single token if available, on the thread's event loop.
+
+        Args:
+            pipe (Pipe | None): The pipe to use; defaults to the filter's pipe
+
+        Returns:
+            bool: True if a token was processed, False if no tokens were available
+        """
+        return self.event_loop().run_until_complete(self._run_one(pipe or self.pipe))
+
+    async def _run_one(self, pipe: Pipe) -> bool:
+        if self.paused():
+            return False
+        if self.hooks:
+            self.call_hooks("pre_take", pipe)
+        token: Token | None = await pipe.atake_token()
+        if self.hooks:
+            self.call_hooks("post_take", pipe, token)
+        if not token:
+            return False
+        return await self.handle_token(pipe, token)
+
+    async def handle_token(self, pipe: Pipe, token: Token) -> bool:
+        """Validate and process a claimed token, then move it on.
+
+        Args:
+            pipe (Pipe): The pipe holding the token
+            token (Token): The token to handle
+
+        Returns:
+            bool: False if the token did not validate or processing raised
+        """
+        self.metrics.waited(pipe.waited(token))
+        is_valid = self.validate_token(token)
+        if inspect.isawaitable(is_valid):
+            is_valid = await is_valid
+        if self.hooks:
+            self.call_hooks("post_validate", pipe, token, is_valid is not False)
+        if is_valid is False:
+            self.metrics.handled("rejected")
+            self.log_to_token(token, "ERROR", "Token did not validate")
+            logging.error("token did not validate")
+            self.record_error(token, "Token did not validate")
+            await pipe.aput_token(errorFlg=True, token=token)
+            if self.hooks:
+                self.call_hooks("post_put", pipe, token)
+            return False
+
+        started = time.perf_counter()
+        try:
+            processed: bool = await self.process_token(token)
+        except Exception as e:
+            self.metrics.processed(time.perf_counter() - started)
+            self.metrics.handled("error")
+            if self.hooks:
+                self.call_hooks("post_process", pipe, token, False)
+            self.log_to_token(token, "ERROR", f"in {self.stage_name}: {str(e)}")
+            logging.error(f"Error processing {token.name}: {str(e)}")
+            self.record_error(token, e)
+            await pipe.aput_token(errorFlg=True, token=token)
+            if self.hooks:
+                self.call_hooks("post_put", pipe, token)
+            return False
+
+        self.metrics.processed(time.perf_counter() - started)
+        self.metrics.handled("success" if processed else "error")
+        if self.hooks:
+            self.call_hooks("post_process", pipe, token, bool(processed))
+        if processed:
+            logging.debug(f"Processed token: {token.name}")
+            self.log_to_token(token, "INFO", "Stage completed successfully")
+            self.record_success(token)
+            await pipe.aput_token(token=token)
+        else:
+            logging.error(f"Did not proces token: {token.name}")
+            self.log_to_token(token, "ERROR", "Stage did not run successfully")
+            if "last_error" not in token.content:
+                self.record_error(token, "Stage did not run successfully")
+            await pipe.aput_token(errorFlg=True, token=token)
+        if self.hooks:
+            self.call_hooks("post_put", pipe, token)
+        return True
+
+    async def serve(self):
+        """Keep up to concurrency tokens in flight until stopped."""
+        in_flight = asyncio.Semaphore(self.concurrency)
+        base_id = self.pipe.worker_id or default_worker_id()
+        idle_pipes = [self.pipe.for_worker(f"{base_id}-{n}") for n in range(self.concurrency)]
+        tasks: set[asyncio.Task] = set()
+
+        def finished(task: asyncio.Task, pipe: Pipe):
+            tasks.discard(task)
+            idle_pipes.append(pipe)
+            in_flight.release()
+            if not task.cancelled() and task.exception() is not None:
+                logging.error(f"{self.stage_name} failed on a token: {task.exception()}")
+
+        watcher = make_watcher(self.pipe.input, self.wakeup)
+        try:
+            while not self.stop_event.is_set():
+                await in_flight.acquire()
+                if self.paused():
+                    in_flight.release()
+                    await asyncio.to_thread(self.stop_event.wait, self.poll_interval)
+                    continue
+                pipe = idle_pipes.pop()
+                if self.hooks:
+                    self.call_hooks("pre_take", pipe)
+                token = await pipe.atake_token()
+                if self.hooks:
+                    self.call_hooks("post_take", pipe, token)
+                if token is None:
+                    idle_pipes.append(pipe)
+                    in_flight.release()
+                    await asyncio.to_thread(watcher.wait, self.poll_interval)
+                    continue
+                task = asyncio.create_task(self.handle_token(pipe, token))
+                tasks.add(task)
+                task.add_done_callback(functools.partial(finished, pipe=pipe))
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            watcher.close()
+
+    def run_forever(self):
+        """Continuously process tokens on an event loop until stopped."""
+        self.pipe.recover()
+        self.keep_leases()
+        self.keep_retrying()
+        self.keep_metrics()
+        asyncio.run(self.serve())
+
+    def run_batch(self, n: int | None = None, pipe: Pipe | None = None) -> bool:
+        raise NotImplementedError("AsyncFilter processes tokens concurrently, not in batches")
+
+    async def process_token(self, token: Token) -> bool:
+        """Process a token - must be implemented by subclasses.
+
+        Args:
+            token (Token): The token to process
+
+        Returns:
+            bool: True if processing succeeded, False otherwise
+
+        Raises:
+            NotImplementedError: If not implemented by subclass
+        """
+        raise NotImplementedError("Subclasses must implement this")
+
+
 class Pipeline:
     """
     Manages bucket directories and token flow throughout the pipeline.
@@ -359,11 +1165,22 @@ class Pipeline:
     Attributes:
         config (dict): Pipeline configuration dictionary
         buckets (dict): Mapping of bucket names to Path objects
+        store (TokenStore): Where the buckets' tokens are kept: the SQLite
+                            database named by global.token_store in the
+                            configuration, or else the bucket directories
+        codec (JsonCodec | MsgpackCodec): How tokens are written, named by
+                            global.token_codec in the configuration, or
+                            else indented JSON
     """
 
     def __init__(self, config: dict | None = None):
         self.config = config
         self.buckets = {}
+        global_config = (config or {}).get("global", {})
+        self.store: TokenStore = open_token_store(
+            global_config.get("token_store"), global_config.get("durability", "none")
+        )
+        self.codec = get_codec(global_config.get("token_codec", "json"))
         if config is not None:
             for rec in self.config.get("buckets", {}):
                 name = rec.get("name", "")
@@ -389,11 +1206,27 @@ class Pipeline:
         Returns:
             Pipe: A pipe instance for moving tokens between the buckets
         """
-        return Pipe(self.bucket(in_bucket), self.bucket(out_bucket))
+        return Pipe(
+            self.bucket(in_bucket), self.bucket(out_bucket), codec=self.codec, store=self.store
+        )
 
-    @property
-    def snapshot(self):
-        """Get current status of all buckets in the pipeline.
+    def scan_bucket(self, location: Path) -> dict:
+        """List the tokens in a bucket.
+
+        Args:
+            location (Path): The bucket directory
+
+        Returns:
+            dict: Lists of waiting, errored and in-process token file names
+        """
+        return self.store.scan(location)
+
+    def status(self, counts_only: bool = False) -> dict:
+        """Get the current status of all buckets in the pipeline.
+
+        Args:
+            counts_only (bool): If True, give the number of tokens in each
+                                state rather than their file names
 
         Returns:
             dict: Dictionary mapping bucket names to status information including
@@ -402,10 +1235,29 @@ class Pipeline:
         """
         buckets = {}
         for name, location in self.buckets.items():
-            info = {
-                "waiting_tokens": [f.name for f in Path(location).glob("*.json")],
-                "errored_tokens": [f.name for f in Path(location).glob("*.err")],
-                "in_process_tokens": [f.name for f in Path(location).glob("*.bak")],
-            }
-            buckets[name] = info
+            if counts_only:
+                buckets[name] = self.store.counts(Path(location))
+            else:
+                info = self.scan_bucket(Path(location))
+                buckets[name] = {state: list(files) for state, files in info.items()}
         return buckets
+
+    @property
+    def snapshot(self):
+        """Get current status of all buckets in the pipeline.
+
+        Returns:
+            dict: Dictionary mapping bucket names to status information including
+                 waiting tokens (.json), errored tokens (.err), and tokens
+                 currently being processed (.bak)
+        """
+        return self.status()
+
+    @property
+    def summary(self):
+        """Get the number of tokens in each state in each bucket.
+
+        Returns:
+            dict: Dictionary mapping bucket names to token counts
+        """
+        return self.status(counts_only=True)
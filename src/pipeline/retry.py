@@ -0,0 +1,223 @@
+# retry.py
+
+# Puts errored tokens back in line.  Many of the failures that leave a
+# token as <barcode>.err are transient: GRIN answering 5xx, S3 asking us
+# to slow down, a connection dropped mid-download.  A filter records
+# what went wrong on the token, as its "last_error", and a
+# RetryScheduler running alongside the filter returns tokens whose last
+# error was transient to the waiting tokens, after an exponential
+# backoff with jitter.  A token's "retry_attempts" counts the retries at
+# its current stage; one that runs out of attempts is moved to a
+# dead-letter bucket, where it waits for a person.  Tokens whose errors
+# are not transient stay where they are, as they always have.
+
+import logging
+import os
+import random
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from time import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pipeline.plumbing import Pipe
+
+# HTTP statuses worth asking again about
+TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# Exceptions that mean the network or the service let us down, by class
+# name, so the HTTP and AWS libraries need not be imported here
+TRANSIENT_EXCEPTIONS = {
+    "TimeoutError",
+    "ConnectionError",
+    "TransportError",  # httpx: timeouts, connection and protocol errors
+    "EndpointConnectionError",  # botocore
+    "ConnectionClosedError",  # botocore
+    "ReadTimeoutError",  # botocore, urllib3
+}
+
+# Error messages that say the same, for errors that were wrapped or
+# recorded only in a token log. GrinClient reports a failed request as
+# "<METHOD> <url> -> <status>".
+TRANSIENT_MESSAGES = re.compile(
+    r"-> (408|425|429|5\d\d)\b|timed? ?out|throttl|slow ?down|too many requests"
+    r"|service unavailable|temporar(il)?y|connection (reset|refused|aborted)",
+    re.IGNORECASE,
+)
+
+
+def is_transient(error: BaseException | str) -> bool:
+    """Whether an error is likely to go away if the work is tried again.
+
+    Args:
+        error (BaseException | str): The exception, or its message
+
+    Returns:
+        bool: True for timeouts, dropped connections, throttling and
+              server errors
+    """
+    if isinstance(error, str):
+        return TRANSIENT_MESSAGES.search(error) is not None
+
+    if any(cls.__name__ in TRANSIENT_EXCEPTIONS for cls in type(error).__mro__):
+        return True
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)  # httpx, requests
+    if isinstance(response, dict):  # botocore's ClientError
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        code = response.get("Error", {}).get("Code", "")
+        if code in {"SlowDown", "Throttling", "RequestTimeout", "InternalError"}:
+            return True
+    if status in TRANSIENT_STATUSES:
+        return True
+    return is_transient(str(error))
+
+
+def describe_error(stage: str, error: BaseException | str) -> dict:
+    """Describe a failure, for a token's "last_error" property.
+
+    Args:
+        stage (str): The stage that failed
+        error (BaseException | str): What went wrong
+
+    Returns:
+        dict: The stage, the error's type and message, when it happened,
+              and whether it is transient
+    """
+    return {
+        "stage": stage,
+        "type": type(error).__name__ if isinstance(error, BaseException) else None,
+        "message": str(error),
+        "time": time(),
+        "transient": is_transient(error),
+    }
+
+
+def is_retryable(content: dict) -> bool:
+    """Whether an errored token failed in a way worth retrying.
+
+    Tokens errored before filters recorded a last_error are judged by the
+    last error in their log, if the log is still kept in the token.
+    """
+    if last_error := content.get("last_error"):
+        return bool(last_error.get("transient"))
+    errors = [entry for entry in content.get("log", []) if entry.get("level") == "ERROR"]
+    return bool(errors) and is_transient(errors[-1].get("message", ""))
+
+
+@dataclass
+class RetryPolicy:
+    """
+    How often, and how soon, errored tokens are retried.
+
+    The nth retry of a token waits a random time between zero and
+    base_delay * 2**n seconds after its failure, capped at max_delay: the
+    "full jitter" backoff, which spreads out tokens that failed together.
+
+    Attributes:
+        attempts (int): Retries allowed at each stage; 0 turns retries off
+        base_delay (float): Seconds the backoff starts from
+        max_delay (float): Longest the backoff may grow to, in seconds
+        dead_letter (Path | None): Bucket for tokens that use up their
+                                   retries; None leaves them as errors
+    """
+
+    attempts: int = 0
+    base_delay: float = 30
+    max_delay: float = 3600
+    dead_letter: Path | None = None
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """Read a policy from the environment.
+
+        Uses RETRY_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY and
+        DEAD_LETTER, which the orchestrator sets from the configuration.
+        """
+        dead_letter = os.environ.get("DEAD_LETTER")
+        return cls(
+            attempts=int(os.environ.get("RETRY_ATTEMPTS", 0)),
+            base_delay=float(os.environ.get("RETRY_BASE_DELAY", 30)),
+            max_delay=float(os.environ.get("RETRY_MAX_DELAY", 3600)),
+            dead_letter=Path(dead_letter) if dead_letter else None,
+        )
+
+    def delay(self, barcode: str, attempt: int) -> float:
+        """Seconds to wait after a failure before retry number attempt + 1.
+
+        The jitter is seeded by the token and attempt, so every process
+        (and every pass) agrees on when a token is due.
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2**attempt)
+        return random.Random(f"{barcode}:{attempt}").uniform(0, ceiling)
+
+
+class RetryScheduler:
+    """
+    Retries the errored tokens in a pipe's input bucket.
+
+    Attributes:
+        pipe (Pipe): The pipe whose input bucket's errors are retried
+        policy (RetryPolicy): When to retry, and when to give up
+    """
+
+    def __init__(self, pipe: "Pipe", policy: RetryPolicy) -> None:
+        self.pipe = pipe
+        self.policy = policy
+
+    def run_once(self) -> int:
+        """Requeue or dead-letter every errored token that is due.
+
+        Returns:
+            int: Number of tokens moved
+        """
+        moved = 0
+        now = time()
+        for barcode in list(self.pipe.list_errored_barcodes()):
+            content = self.pipe.store.load(self.pipe.input, barcode, "error")
+            if content is None or not is_retryable(content):
+                continue
+            attempts = int(content.get("retry_attempts", 0))
+            if attempts >= self.policy.attempts:
+                if self.policy.dead_letter is not None:
+                    moved += self.dead_letter(barcode)
+                continue
+            failed_at = content.get("last_error", {}).get("time", 0)
+            if now >= failed_at + self.policy.delay(barcode, attempts):
+                moved += self.requeue(barcode)
+        return moved
+
+    def requeue(self, barcode: str) -> int:
+        token = self.pipe.take_errored_token(barcode)
+        if token is None:
+            return 0  # another process got to it first
+        attempts = int(token.get_prop("retry_attempts") or 0) + 1
+        token.put_prop("retry_attempts", attempts)
+        # the next failure, if any, records its own error
+        token.content.pop("last_error", None)
+        token.write_log(f"retry {attempts} of {self.policy.attempts}", "INFO", "retry")
+        logging.info(f"retrying {barcode} (attempt {attempts} of {self.policy.attempts})")
+        self.pipe.move_token(token, self.pipe.input)
+        return 1
+
+    def dead_letter(self, barcode: str) -> int:
+        token = self.pipe.take_errored_token(barcode)
+        if token is None:
+            return 0
+        token.put_prop("dead_letter_from", str(self.pipe.input))
+        token.write_log("out of retries", "ERROR", "retry")
+        logging.warning(f"{barcode} is out of retries; moving it to {self.policy.dead_letter}")
+        self.pipe.move_token(token, self.policy.dead_letter, "error")
+        return 1
+
+    def run_forever(self, stop_event: threading.Event) -> None:
+        """Retry tokens as they come due until stop_event is set."""
+        interval = min(self.policy.base_delay, 60)
+        while not stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.exception(f"retrying errored tokens in {self.pipe.input} failed: {e}")
+            stop_event.wait(interval)
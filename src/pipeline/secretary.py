@@ -3,6 +3,8 @@ from pathlib import Path
 from pipeline.book_ledger import Book, BookLedger
 from pipeline.plumbing import Token
 from pipeline.token_bag import TokenBag
+from pipeline.token_codecs import JsonCodec, MsgpackCodec
+from pipeline.token_store import TokenStore
 
 
 class Secretary:
@@ -90,8 +92,13 @@ class Secretary:
             error_msg = f"{barcode} is not in ledger"
             raise KeyError(error_msg)
 
-    def pour_bag(self, bucket: Path):
-        self.bag.pour_into(bucket)
+    def pour_bag(
+        self,
+        bucket: Path,
+        store: TokenStore | None = None,
+        codec: JsonCodec | MsgpackCodec | None = None,
+    ):
+        self.bag.pour_into(bucket, store, codec)
 
     def commit(self) -> None:
         self.ledger.write_ledger()
@@ -2,6 +2,8 @@
 from pathlib import Path
 
 from pipeline.secretary import Secretary
+from pipeline.token_codecs import JsonCodec, MsgpackCodec
+from pipeline.token_store import TokenStore
 
 
 class Stager:
@@ -16,6 +18,12 @@ class Stager:
         secretary (Secretary): Secretary instance for accessing the token bag
         processing_bucket (Path): Directory where files will be processed
         start_bucket (Path): Pipeline start bucket where tokens begin processing
+        store (TokenStore | None): The pipeline's token store; by default
+                                   tokens are written to the start bucket
+                                   as files, following its shard layout
+        codec (JsonCodec | MsgpackCodec | None): How the tokens are written;
+                                   by default, as the TOKEN_CODEC
+                                   environment variable says
     """
 
     def __init__(
@@ -23,10 +31,14 @@ class Stager:
         secretary: Secretary,
         path_to_processing_bucket: Path,
         path_to_start_bucket: Path,
+        store: TokenStore | None = None,
+        codec: JsonCodec | MsgpackCodec | None = None,
     ) -> None:
         self.secretary = secretary
         self.processing_bucket = path_to_processing_bucket
         self.start_bucket = path_to_start_bucket
+        self.store = store
+        self.codec = codec
 
     def update_tokens(self):
         """
@@ -47,7 +59,7 @@ class Stager:
             commit (bool): Whether to persist changes to disk. Defaults to True.
         """
         # Transfer all tokens from the bag to the start bucket
-        self.secretary.pour_bag(self.start_bucket)
+        self.secretary.pour_bag(self.start_bucket, self.store, self.codec)
         if commit:
             # Persist ledger and bag state changes to disk
             self.secretary.commit()
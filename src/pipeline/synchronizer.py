@@ -30,8 +30,14 @@ class Synchronizer:
                 0
             ]
         )
-        self.stager = Stager(self.secretary, processing_bucket, pipeline_bucket)
         self.pipeline = Pipeline(config)
+        self.stager = Stager(
+            self.secretary,
+            processing_bucket,
+            pipeline_bucket,
+            self.pipeline.store,
+            self.pipeline.codec,
+        )
         self.client = GrinClient()
 
     @property
@@ -1,9 +1,12 @@
 # token_bag.py
 
 
+import os
 from pathlib import Path
 
 from pipeline.plumbing import Token, dump_token, load_token
+from pipeline.token_codecs import JsonCodec, MsgpackCodec, get_codec
+from pipeline.token_store import DirectoryTokenStore, TokenStore
 
 
 class TokenBag:
@@ -108,16 +111,31 @@ class TokenBag:
             for token in self.tokens:
                 token.put_prop("processing_bucket", directory)
 
-    def pour_into(self, bucket: Path) -> None:
+    def pour_into(
+        self,
+        bucket: Path,
+        store: TokenStore | None = None,
+        codec: JsonCodec | MsgpackCodec | None = None,
+    ) -> None:
         """Transfer all tokens from the bag to a pipeline bucket.
 
-        Removes all tokens from the bag and writes them as JSON files
-        in the specified bucket directory.
+        Removes all tokens from the bag and writes them as token files
+        in the specified bucket directory (or its shards), or adds them
+        to the bucket in a token store.
 
         Args:
             bucket (Path): Destination bucket directory path
+            store (TokenStore | None): The pipeline's token store; defaults
+                                       to token files in the bucket directory
+            codec (JsonCodec | MsgpackCodec | None): How to serialize the
+                                       tokens; defaults to the codec the
+                                       TOKEN_CODEC environment variable
+                                       names, as for Filter
         """
+        store = store or DirectoryTokenStore()
+        codec = codec or get_codec(os.environ.get("TOKEN_CODEC", "json"))
         barcodes = [tok.get_prop("barcode") for tok in self.tokens]
         for barcode in barcodes:
             token = self.take_token(barcode)
-            dump_token(token, bucket / Path(token.name).with_suffix(".json"))
+            priority = int(token.get_prop("priority") or 0)
+            store.add(bucket, token.name, codec.encode(token.content), priority)
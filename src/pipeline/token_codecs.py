@@ -0,0 +1,118 @@
+# token_codecs.py
+
+# Ways of serializing a token's content.  Tokens have always been
+# written as indented JSON, which is easy to read and edit by hand but
+# grows with every log entry; the other codecs trade readability for
+# speed and size.  Whatever the codec, token files keep their .json
+# suffix, and load_token recognizes the format from the file's first
+# byte, so buckets can hold a mixture of old and new tokens.
+
+import json
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON when installed
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional: needed only for the msgpack codec
+    msgpack = None
+
+
+class JsonCodec:
+    """Indented JSON, the pipeline's original token format."""
+
+    name = "json"
+
+    def encode(self, content: dict) -> bytes:
+        return json.dumps(content, indent=2).encode()
+
+    def decode(self, data: bytes) -> dict:
+        return decode_json(data)
+
+
+class CompactJsonCodec(JsonCodec):
+    """JSON without indentation or spaces between items."""
+
+    name = "compact"
+
+    def encode(self, content: dict) -> bytes:
+        return json.dumps(content, separators=(",", ":")).encode()
+
+
+class OrjsonCodec(JsonCodec):
+    """Compact JSON written with the orjson library."""
+
+    name = "orjson"
+
+    def __init__(self) -> None:
+        if orjson is None:
+            raise ImportError("the orjson codec needs the orjson package")
+
+    def encode(self, content: dict) -> bytes:
+        return orjson.dumps(content)
+
+
+class MsgpackCodec:
+    """Binary MessagePack, the smallest and fastest of the formats."""
+
+    name = "msgpack"
+
+    def __init__(self) -> None:
+        if msgpack is None:
+            raise ImportError("the msgpack codec needs the msgpack package")
+
+    def encode(self, content: dict) -> bytes:
+        return msgpack.packb(content)
+
+    def decode(self, data: bytes) -> dict:
+        return msgpack.unpackb(data)
+
+
+CODECS = {
+    codec.name: codec for codec in [JsonCodec, CompactJsonCodec, OrjsonCodec, MsgpackCodec]
+}
+
+
+def get_codec(name: str = "json") -> JsonCodec | MsgpackCodec:
+    """Look up a codec by name.
+
+    Args:
+        name (str): "json", "compact", "orjson" or "msgpack". Defaults to "json".
+
+    Returns:
+        JsonCodec | MsgpackCodec: The codec
+
+    Raises:
+        ValueError: If there is no such codec
+        ImportError: If the codec's library is not installed
+    """
+    if name not in CODECS:
+        raise ValueError(f"unknown token codec: {name}")
+    return CODECS[name]()
+
+
+def decode_json(data: bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode(data: bytes) -> dict:
+    """Decode a token written with any codec.
+
+    JSON tokens always begin with "{" (perhaps after whitespace); a
+    MessagePack map never does.
+
+    Args:
+        data (bytes): The contents of a token file
+
+    Returns:
+        dict: The token's content
+    """
+    if data.lstrip()[:1] == b"{":
+        return decode_json(data)
+    if msgpack is None:
+        raise ValueError("token is not JSON, and msgpack is not installed to read it")
+    return msgpack.unpackb(data)
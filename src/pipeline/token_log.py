@@ -0,0 +1,105 @@
+# token_log.py
+
+# Append-only stores for token log entries.  By default a token carries
+# its whole processing history in content["log"], and every stage
+# rewrites that history each time it moves the token.  With a token log
+# configured, a Pipe moves the entries written by each stage into an
+# append-only JSONL file instead, so the token file stays small and a
+# move costs the same however long the token's history has grown.
+
+import json
+import os
+from pathlib import Path
+
+
+class SidecarLog:
+    """
+    Keeps each token's log in its own file, <directory>/<barcode>.jsonl.
+
+    Attributes:
+        directory (Path): Directory holding the log files
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def log_path(self, barcode: str, bucket: str | None = None) -> Path:
+        return self.directory / f"{barcode}.jsonl"
+
+    def append(self, barcode: str, entries: list[dict], bucket: str | None = None) -> None:
+        """Append log entries for a token.
+
+        Args:
+            barcode (str): The token's barcode
+            entries (list[dict]): Log entries, oldest first
+            bucket (str | None): Name of the bucket the token is leaving
+        """
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+        # A single write to a file opened for appending lands in one piece,
+        # even with several writers
+        fd = os.open(self.log_path(barcode, bucket), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode())
+        finally:
+            os.close(fd)
+
+    def entries(self, barcode: str) -> list[dict]:
+        """Read back every log entry recorded for a token.
+
+        Args:
+            barcode (str): The token's barcode
+
+        Returns:
+            list[dict]: The token's log entries, oldest first
+        """
+        path = self.log_path(barcode)
+        if not path.exists():
+            return []
+        with path.open("r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+class BucketLog(SidecarLog):
+    """
+    Keeps the logs of every token leaving a bucket in one shared file,
+    <directory>/<bucket>.jsonl. Each entry records its token's barcode.
+    """
+
+    def log_path(self, barcode: str, bucket: str | None = None) -> Path:
+        return self.directory / f"{bucket}.jsonl"
+
+    def append(self, barcode: str, entries: list[dict], bucket: str | None = None) -> None:
+        super().append(barcode, [{"barcode": barcode, **entry} for entry in entries], bucket)
+
+    def entries(self, barcode: str) -> list[dict]:
+        found = []
+        for path in sorted(self.directory.glob("*.jsonl")):
+            with path.open("r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        if entry.pop("barcode", None) == barcode:
+                            found.append(entry)
+        return sorted(found, key=lambda entry: entry.get("timestamp", ""))
+
+
+def open_token_log(directory: str | Path | None, mode: str = "sidecar") -> SidecarLog | None:
+    """Open the token log kept in a directory.
+
+    Args:
+        directory (str | Path | None): Where the log files live; None means
+                                       logs stay in the tokens themselves
+        mode (str): "sidecar" for one file per token, or "bucket" for one
+                    shared file per bucket. Defaults to "sidecar".
+
+    Returns:
+        SidecarLog | None: The token log, or None if no directory is given
+    """
+    if directory is None:
+        return None
+    if mode == "sidecar":
+        return SidecarLog(Path(directory))
+    if mode == "bucket":
+        return BucketLog(Path(directory))
+    raise ValueError(f"unknown token log mode: {mode}")
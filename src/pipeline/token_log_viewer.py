@@ -1,9 +1,10 @@
-import json
+import os
 import sys
 from pathlib import Path
 from rich.console import Console
 from rich.table import Table
-from pipeline import logging_config
+from pipeline import logging_config, token_codecs
+from pipeline.token_log import open_token_log
 import logging
 
 logging_config.configure_logging()
@@ -11,8 +12,26 @@ logger: logging.Logger = logging.getLogger(__name__)
 
 
 def load_token(path):
-    with open(path, "r") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        return token_codecs.decode(f.read())
+
+
+def merge_log(token, log_dir=None, mode="sidecar"):
+    """Put the entries kept in a token log back into the token's own log.
+
+    Args:
+        token (dict): The token's content
+        log_dir (str | None): Directory of the token log, if one is kept
+        mode (str): "sidecar" or "bucket"
+
+    Returns:
+        dict: The token, with every log entry in timestamp order
+    """
+    token_log = open_token_log(log_dir, mode)
+    if token_log is not None:
+        entries = token_log.entries(token["barcode"]) + token.get("log", [])
+        token["log"] = sorted(entries, key=lambda entry: entry.get("timestamp", ""))
+    return token
 
 
 def display_log(token):
@@ -37,8 +56,8 @@ def display_log(token):
 
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python token_log_viewer.py <path-to-token.json>")
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python token_log_viewer.py <path-to-token.json> [token-log-dir]")
         sys.exit(1)
 
     token_path = Path(sys.argv[1])
@@ -46,7 +65,8 @@ def main():
         print(f"Token file not found: {token_path}")
         sys.exit(1)
 
-    token = load_token(token_path)
+    log_dir = sys.argv[2] if len(sys.argv) == 3 else os.environ.get("TOKEN_LOG_DIR")
+    token = merge_log(load_token(token_path), log_dir, os.environ.get("TOKEN_LOG_MODE", "sidecar"))
     display_log(token)
 
 
@@ -0,0 +1,1161 @@
+# token_store.py
+
+# Where a pipeline keeps its tokens.  A bucket has always been a
+# directory of token files, each file's suffix giving its token's state,
+# and that remains the default.  A TokenStore hides the layout from Pipe
+# and Pipeline, so the buckets can instead live in a SQLite database,
+# which claims tokens in transactions, finds them by index, and keeps
+# running counts instead of listing directories.  Either way a bucket is
+# named by its configured path, so filters and configuration are the
+# same whichever store is in use.
+#
+# Stores deal in token content: they are handed encoded token data to
+# write, and give back decoded dicts, which Pipe wraps in Tokens.
+
+import atexit
+import hashlib
+import heapq
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from time import time, time_ns
+from typing import Iterator
+
+from pipeline import token_codecs
+
+DURABILITY_MODES = ("none", "fsync", "group")
+
+# How a bucket's waiting tokens are ordered for claiming
+ORDERS = ("fifo", "priority")
+
+
+def default_worker_id() -> str:
+    """Identify this process for use in claim file names.
+
+    Returns:
+        str: "<host>-<pid>", with dots in the host name replaced so the
+             barcode can still be read off the front of a claim file name
+    """
+    return f"{socket.gethostname().replace('.', '-')}-{os.getpid()}"
+
+
+def owner_is_dead(owner: str | None) -> bool:
+    """Whether a claim's owner was a process on this host that has since exited.
+
+    Owners named by default_worker_id, perhaps with a worker number added
+    ("<host>-<pid>-<n>"), can be checked; any other owner, or one on
+    another host, is assumed to be alive.
+    """
+    prefix = f"{socket.gethostname().replace('.', '-')}-"
+    if not owner or not owner.startswith(prefix):
+        return False
+    pid = owner[len(prefix) :].split("-")[0]
+    if not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass  # alive, but someone else's
+    return False
+
+
+def boot_time() -> float | None:
+    """When this host last booted, from /proc/stat; None where unknown."""
+    try:
+        with open("/proc/stat") as f:
+            for line in f:
+                if line.startswith("btime "):
+                    return float(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def claim_suffix(owner: str | None) -> str:
+    """The suffix marking a token as claimed by owner."""
+    if owner is None:
+        return ".bak"
+    return f".{owner}.bak"
+
+
+def shard_path(barcode: str, levels: int) -> Path:
+    """The relative directory holding a barcode's token in a sharded bucket.
+
+    Args:
+        barcode (str): The token's barcode
+        levels (int): Number of levels of shard directories; 0 for none
+
+    Returns:
+        Path: Two hex digits of the barcode's hash per level, e.g. 3f/a2
+    """
+    digest = hashlib.md5(barcode.encode(), usedforsecurity=False).hexdigest()
+    return Path(*[digest[2 * level : 2 * level + 2] for level in range(levels)])
+
+
+def is_shard_name(name: str) -> bool:
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+
+def write_atomically(
+    destination: Path, data: bytes, fsync: bool = False, tmp_dir: Path | None = None
+) -> None:
+    """Write a file by way of a temporary file renamed into place.
+
+    A crash can never leave a truncated file behind, and readers never see
+    a partly written one.
+
+    Args:
+        destination (Path): The file to write
+        data (bytes): Its new contents
+        fsync (bool): If True, flush the file to disk before renaming it,
+                      so the rename can never expose an empty file after a
+                      power loss. Defaults to False.
+        tmp_dir (Path | None): Where to write the temporary file, on the
+                      same filesystem; defaults to the destination's directory
+    """
+    tmp_path = (tmp_dir or destination.parent) / (
+        f".{destination.name}.{os.getpid()}-{threading.get_ident()}.tmp"
+    )
+    try:
+        with tmp_path.open("wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, destination)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def fsync_directory(directory: Path) -> None:
+    """Flush a directory to disk, making renames into it durable."""
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommit:
+    """
+    Makes token moves durable in groups rather than one at a time.
+
+    In "group" durability mode each token file is still flushed to disk
+    before it is renamed into place, but the directory fsync that makes the
+    rename itself durable is shared by every move in the group. Until the
+    group is committed the token's old claim file is kept, renamed to a
+    hidden .put tombstone, so a token is never held only by a rename that
+    a power loss could undo; Pipe.recover settles tombstones left by a crash.
+
+    Attributes:
+        max_pending (int): Number of moves to collect before committing
+        max_delay (float): Seconds a move may wait to be committed
+    """
+
+    def __init__(self, max_pending: int = 64, max_delay: float = 0.5) -> None:
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.directories: set[Path] = set()
+        self.tombstones: list[Path] = []
+        self.timer: threading.Timer | None = None
+        atexit.register(self.commit)
+
+    def add(self, directory: Path, tombstone: Path) -> None:
+        """Record a move into directory whose old claim is now tombstone."""
+        with self.lock:
+            self.directories.add(directory)
+            self.tombstones.append(tombstone)
+            if len(self.tombstones) >= self.max_pending:
+                self._commit()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self.commit)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def commit(self) -> None:
+        """Make every pending move durable and delete its tombstone."""
+        with self.lock:
+            self._commit()
+
+    def _commit(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for directory in self.directories:
+            fsync_directory(directory)
+        for tombstone in self.tombstones:
+            tombstone.unlink(missing_ok=True)
+        self.directories.clear()
+        self.tombstones.clear()
+
+
+_group_commit: GroupCommit | None = None
+
+
+def shared_group_commit() -> GroupCommit:
+    """Get the GroupCommit shared by all of this process's pipes."""
+    global _group_commit
+    if _group_commit is None:
+        _group_commit = GroupCommit()
+    return _group_commit
+
+
+class TokenStore:
+    """
+    Keeps the tokens in a pipeline's buckets.
+
+    A token in a bucket is in one of three states: "waiting" to be taken,
+    "claimed" by a worker (its owner) while it is processed, or "error".
+    Buckets are named by their paths.
+    """
+
+    # Which list in a bucket's status each state belongs to
+    STATUS_KEYS = {
+        "waiting": "waiting_tokens",
+        "error": "errored_tokens",
+        "claimed": "in_process_tokens",
+    }
+
+    def add(self, bucket: Path, barcode: str, data: bytes, priority: int = 0) -> None:
+        """Put a waiting token in a bucket, replacing any waiting or in error there.
+
+        A worker holding a claim on the barcode in the bucket keeps working
+        on its copy, and the new token is handled as well.
+
+        The token's priority is only used by stores that cannot read it
+        from the token itself.
+        """
+        raise NotImplementedError
+
+    def barcodes(self, bucket: Path, state: str = "waiting") -> Iterator[str]:
+        """Yield the barcodes of the tokens in a bucket that are waiting (or in error)."""
+        raise NotImplementedError
+
+    def load(self, bucket: Path, barcode: str, state: str = "waiting") -> dict | None:
+        """Read a waiting (or errored) token without claiming it; None if there is none."""
+        raise NotImplementedError
+
+    def claim(
+        self,
+        bucket: Path,
+        owner: str | None,
+        barcode: str | None = None,
+        n: int = 1,
+        order: str | None = None,
+        state: str = "waiting",
+    ) -> list[dict]:
+        """Claim up to n waiting tokens, or the token with the given barcode.
+
+        Each token can be claimed by only one owner, however many workers
+        try at once.
+
+        Args:
+            bucket (Path): The bucket to claim from
+            owner (str | None): Who is claiming
+            barcode (str | None): The token to claim; None for any
+            n (int): How many tokens to claim at most. Defaults to 1.
+            order (str | None): "fifo" claims the longest waiting tokens
+                                first, "priority" the tokens with the
+                                highest "priority" property and then the
+                                longest waiting; None takes whatever comes
+                                to hand most cheaply.
+            state (str): "waiting", or "error" to claim an errored token,
+                         which must then be named by its barcode
+
+        Returns:
+            list[dict]: The content of each claimed token
+        """
+        raise NotImplementedError
+
+    def move(
+        self,
+        source: Path,
+        barcode: str,
+        owner: str | None,
+        destination: Path,
+        data: bytes,
+        state: str = "waiting",
+        priority: int = 0,
+    ) -> None:
+        """Replace a claimed token with new data in a destination bucket.
+
+        Args:
+            source (Path): The bucket holding the claim
+            barcode (str): The claimed token's barcode
+            owner (str | None): The claim's owner
+            destination (Path): The bucket the token is moving to, which
+                                may be the source bucket
+            data (bytes): The encoded token
+            state (str): "waiting" or "error". Defaults to "waiting".
+            priority (int): The token's priority; see add
+        """
+        raise NotImplementedError
+
+    def release(self, bucket: Path, barcode: str, owner: str | None) -> None:
+        """Drop a claimed token altogether."""
+        raise NotImplementedError
+
+    def unclaim(self, bucket: Path, barcode: str, owner: str | None) -> None:
+        """Give up a claim, leaving the token waiting just as it was claimed."""
+        raise NotImplementedError
+
+    def scan(self, bucket: Path) -> dict:
+        """List the tokens in a bucket, by state.
+
+        Returns:
+            dict: Lists of waiting, errored and in-process token file names
+        """
+        raise NotImplementedError
+
+    def counts(self, bucket: Path) -> dict:
+        """Count the tokens in a bucket, by state."""
+        return {key: len(names) for key, names in self.scan(bucket).items()}
+
+    def recover(self, source: Path, destination: Path, stale_after: float = 60) -> int:
+        """Settle moves out of source that a crash left unfinished.
+
+        Returns:
+            int: Number of tokens put back in the source bucket
+        """
+        return 0
+
+    def renew(self) -> None:
+        """Renew the leases on every claim made through this store and still held."""
+
+    def waited(self, bucket: Path, barcode: str, owner: str | None) -> float | None:
+        """How long a token claimed through this store had waited to be claimed.
+
+        Returns:
+            float | None: Seconds, or None if the claim is not held here
+        """
+        return None
+
+    def reclaim(self, bucket: Path, lease: float) -> int:
+        """Return abandoned claims in a bucket to the waiting tokens.
+
+        A claim is abandoned if its lease has not been renewed for lease
+        seconds, or if its owner was a process on this host that has exited.
+        Claims held through this store are never reclaimed.
+
+        Returns:
+            int: Number of tokens returned
+        """
+        return 0
+
+
+class DirectoryTokenStore(TokenStore):
+    """
+    Keeps each bucket's tokens as files in the bucket's directory:
+    <barcode>.json while waiting, <barcode>.err after an error, and
+    <barcode>.bak or <barcode>.<owner>.bak while claimed.
+
+    Tokens are claimed by renaming them before they are read: exactly one
+    rename of a given token file can succeed, so the losers simply move on
+    to the next candidate. A claim file's mtime is its lease: it is set
+    when the token is claimed and again each time the claim is renewed.
+
+    A bucket expected to hold a very large number of tokens can be sharded
+    (see utils/shard_buckets.py): its token files are then spread over
+    levels of subdirectories named by hex digits of a hash of the barcode,
+    <bucket>/3f/a2/<barcode>.json for two levels, and the number of levels
+    is recorded in the bucket's SHARDS_FILE. The store reads each bucket's
+    layout once, so a bucket must not be resharded while filters are using
+    it. New token files are staged in the bucket directory itself and then
+    renamed into their shard, so a watcher on the bucket still sees them
+    arrive.
+
+    Attributes:
+        durability (str): How token moves are made to survive a power loss:
+                          "none" relies on atomic renames alone, "fsync"
+                          flushes every move to disk, and "group" shares
+                          directory flushes among moves (see GroupCommit).
+        group_commit (GroupCommit | None): Commits moves in "group" mode
+    """
+
+    SUFFIXES = {"waiting": ".json", "error": ".err"}
+
+    # Which list in a bucket's status each kind of token file belongs to
+    TOKEN_STATES = {
+        ".json": "waiting_tokens",
+        ".err": "errored_tokens",
+        ".bak": "in_process_tokens",
+    }
+
+    SHARDS_FILE = ".shards"
+
+    def __init__(self, durability: str = "none") -> None:
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"unknown durability mode: {durability}")
+        self.durability = durability
+        self.group_commit = shared_group_commit() if durability == "group" else None
+        self._scans: dict[Path, tuple[int, dict]] = {}
+        self._shard_levels: dict[Path, int] = {}
+        self._shard_dirs: dict[Path, list[Path]] = {}
+        self._queues: dict[tuple[Path, str], TokenQueue] = {}
+        self._queues_lock = threading.Lock()
+        # claims held through this store, and how long each token waited
+        self._held: dict[Path, float] = {}
+        self._held_lock = threading.Lock()
+
+    def shard_levels(self, bucket: Path) -> int:
+        """The number of levels of shard directories in a bucket; 0 if it is flat."""
+        if bucket not in self._shard_levels:
+            try:
+                levels = int((bucket / self.SHARDS_FILE).read_text())
+            except FileNotFoundError:
+                levels = 0
+            self._shard_levels[bucket] = levels
+        return self._shard_levels[bucket]
+
+    def token_dir(self, bucket: Path, barcode: str) -> Path:
+        """The directory in a bucket that holds a token's files."""
+        return bucket / shard_path(barcode, self.shard_levels(bucket))
+
+    def shard_dirs(self, bucket: Path, refresh: bool = False) -> list[Path]:
+        """List the directories holding a bucket's token files.
+
+        A flat bucket is its own only shard. The shards of a sharded bucket
+        are listed once and remembered, since they are only ever added;
+        pass refresh=True to look for new ones.
+        """
+        levels = self.shard_levels(bucket)
+        if levels == 0:
+            return [bucket]
+        if refresh or bucket not in self._shard_dirs:
+            dirs = [bucket]
+            for _ in range(levels):
+                dirs = [
+                    Path(entry.path)
+                    for directory in dirs
+                    for entry in os.scandir(directory)
+                    if entry.is_dir() and is_shard_name(entry.name)
+                ]
+            self._shard_dirs[bucket] = dirs
+        return self._shard_dirs[bucket]
+
+    def path(self, bucket: Path, barcode: str, state: str = "waiting") -> Path:
+        return self.token_dir(bucket, barcode) / f"{barcode}{self.SUFFIXES[state]}"
+
+    def claim_path(self, bucket: Path, barcode: str, owner: str | None) -> Path:
+        return self.token_dir(bucket, barcode) / f"{barcode}{claim_suffix(owner)}"
+
+    def claim_file(self, token_path: Path, owner: str | None) -> Path | None:
+        """Atomically claim a token file by renaming it to a claim file.
+
+        Args:
+            token_path (Path): The .json token file to claim
+            owner (str | None): Who is claiming it
+
+        Returns:
+            Path | None: The claim file, or None if another worker
+                         got there first
+        """
+        barcode = token_path.name.split(".")[0]
+        marked_path = token_path.parent / f"{barcode}{claim_suffix(owner)}"
+        try:
+            token_path.rename(marked_path)
+        except FileNotFoundError:
+            return None
+        # a rename keeps the token file's mtime, which is when the token
+        # arrived; start the lease now
+        arrived = os.stat(marked_path).st_mtime
+        os.utime(marked_path)
+        with self._held_lock:
+            self._held[marked_path] = max(0.0, time() - arrived)
+        return marked_path
+
+    def read(self, path: Path) -> dict:
+        with path.open("rb") as f:
+            return token_codecs.decode(f.read())
+
+    def write(self, bucket: Path, barcode: str, data: bytes, state: str = "waiting") -> Path:
+        """Write a token file into its place in a bucket.
+
+        Returns:
+            Path: The token file
+        """
+        destination = self.path(bucket, barcode, state)
+        if destination.parent != bucket and not destination.parent.is_dir():
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            if self.durability != "none":
+                for directory in [destination.parent, *destination.parent.parents]:
+                    fsync_directory(directory)
+                    if directory == bucket:
+                        break
+        write_atomically(destination, data, fsync=self.durability != "none", tmp_dir=bucket)
+        return destination
+
+    def add(self, bucket: Path, barcode: str, data: bytes, priority: int = 0) -> None:
+        self.write(bucket, barcode, data)
+        self.path(bucket, barcode, "error").unlink(missing_ok=True)
+
+    def barcodes(self, bucket: Path, state: str = "waiting") -> Iterator[str]:
+        suffix = self.SUFFIXES[state]
+        for directory in self.shard_dirs(bucket):
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(suffix) and not entry.name.startswith("."):
+                        yield entry.name[: -len(suffix)]
+
+    def load(self, bucket: Path, barcode: str, state: str = "waiting") -> dict | None:
+        try:
+            return self.read(self.path(bucket, barcode, state))
+        except FileNotFoundError:
+            return None  # claimed by another worker since it was listed
+
+    def claim(
+        self,
+        bucket: Path,
+        owner: str | None,
+        barcode: str | None = None,
+        n: int = 1,
+        order: str | None = None,
+        state: str = "waiting",
+    ) -> list[dict]:
+        if barcode is not None:
+            marked_path = self.claim_file(self.path(bucket, barcode, state), owner)
+            return [] if marked_path is None else [self.read(marked_path)]
+        if state != "waiting":
+            raise ValueError(f"{state} tokens can only be claimed by barcode")
+
+        if order is not None:
+            return self._claim_in_order(bucket, owner, n, order)
+
+        claimed = self._claim_from(self.shard_dirs(bucket), owner, n)
+        if not claimed and self.shard_levels(bucket) > 0:
+            # tokens may have landed in shards made since they were listed
+            claimed = self._claim_from(self.shard_dirs(bucket, refresh=True), owner, n)
+        return claimed
+
+    def _claim_from(self, directories: list[Path], owner: str | None, n: int) -> list[dict]:
+        # Workers start at different shards, so they seldom race for a token
+        start = random.randrange(len(directories)) if len(directories) > 1 else 0
+        claimed = []
+        for directory in directories[start:] + directories[:start]:
+            for name in self.scan_dir(directory)["waiting_tokens"]:
+                if len(claimed) >= n:
+                    return claimed
+                marked_path = self.claim_file(directory / name, owner)
+                if marked_path is not None:
+                    claimed.append(self.read(marked_path))
+        return claimed
+
+    def _claim_in_order(self, bucket: Path, owner: str | None, n: int, order: str) -> list[dict]:
+        with self._queues_lock:
+            queue = self._queues.get((bucket, order))
+            if queue is None:
+                queue = self._queues[(bucket, order)] = TokenQueue(self, bucket, order)
+        claimed = []
+        while len(claimed) < n and (token_path := queue.pop()) is not None:
+            marked_path = self.claim_file(token_path, owner)
+            if marked_path is not None:
+                claimed.append(self.read(marked_path))
+        return claimed
+
+    def move(
+        self,
+        source: Path,
+        barcode: str,
+        owner: str | None,
+        destination: Path,
+        data: bytes,
+        state: str = "waiting",
+        priority: int = 0,
+    ) -> None:
+        # The claim file is only removed once the new file is in place, and,
+        # depending on the durability mode, once the move is on disk.
+        written = self.write(destination, barcode, data, state)
+        if self.durability == "fsync":
+            fsync_directory(written.parent)
+        marked_path = self.claim_path(source, barcode, owner)
+        try:
+            if self.durability == "group":
+                tombstone = marked_path.parent / f".{barcode}.{uuid.uuid4().hex}.put"
+                marked_path.rename(tombstone)
+                self.group_commit.add(written.parent, tombstone)
+            else:
+                marked_path.unlink()
+        except FileNotFoundError:
+            logging.warning(f"the claim on {barcode} expired; it may be processed twice")
+        with self._held_lock:
+            self._held.pop(marked_path, None)
+
+    def release(self, bucket: Path, barcode: str, owner: str | None) -> None:
+        marked_path = self.claim_path(bucket, barcode, owner)
+        with self._held_lock:
+            self._held.pop(marked_path, None)
+        marked_path.unlink()
+
+    def unclaim(self, bucket: Path, barcode: str, owner: str | None) -> None:
+        marked_path = self.claim_path(bucket, barcode, owner)
+        with self._held_lock:
+            self._held.pop(marked_path, None)
+        marked_path.rename(self.path(bucket, barcode))
+
+    def waited(self, bucket: Path, barcode: str, owner: str | None) -> float | None:
+        with self._held_lock:
+            return self._held.get(self.claim_path(bucket, barcode, owner))
+
+    def renew(self) -> None:
+        with self._held_lock:
+            held = list(self._held)
+        for marked_path in held:
+            try:
+                os.utime(marked_path)
+            except FileNotFoundError:
+                pass  # moved since the list was taken
+
+    def reclaim(self, bucket: Path, lease: float) -> int:
+        reclaimed = 0
+        with self._held_lock:
+            held = set(self._held)
+        for directory in self.shard_dirs(bucket, refresh=True):
+            with os.scandir(directory) as entries:
+                claims = [entry for entry in entries if entry.name.endswith(".bak")]
+            for entry in claims:
+                if Path(entry.path) in held:
+                    continue
+                barcode, _, owner = entry.name[: -len(".bak")].partition(".")
+                try:
+                    expired = time() - entry.stat().st_mtime > lease
+                except FileNotFoundError:
+                    continue
+                if expired or owner_is_dead(owner):
+                    reason = "expired" if expired else f"held by {owner}, which has exited"
+                    logging.warning(f"reclaiming {barcode}: its claim {reason}")
+                    try:
+                        os.rename(entry.path, self.path(bucket, barcode))
+                    except FileNotFoundError:
+                        continue
+                    reclaimed += 1
+        return reclaimed
+
+    def scan_dir(self, directory: Path) -> dict:
+        """List the token files in one directory in a single pass.
+
+        Scans are cached on the directory's modification time, so looking at
+        an unchanged directory again costs a single stat. A directory modified
+        within the last second is not cached, since a second change in the
+        same clock tick would not alter its mtime.
+
+        Args:
+            directory (Path): A flat bucket, or one shard of a sharded bucket
+
+        Returns:
+            dict: Lists of waiting, errored and in-process token file names
+        """
+        info: dict = {state: [] for state in self.TOKEN_STATES.values()}
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return info
+
+        cached = self._scans.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                suffix = os.path.splitext(entry.name)[1]
+                if state := self.TOKEN_STATES.get(suffix):
+                    info[state].append(entry.name)
+
+        if time_ns() - mtime > 1_000_000_000:
+            self._scans[directory] = (mtime, info)
+        return info
+
+    def scan(self, bucket: Path) -> dict:
+        if not bucket.is_dir():
+            return self.scan_dir(bucket)
+        shards = self.shard_dirs(bucket, refresh=True)
+        if len(shards) == 1:
+            return self.scan_dir(shards[0])
+        info: dict = {state: [] for state in self.TOKEN_STATES.values()}
+        for directory in shards:
+            for state, names in self.scan_dir(directory).items():
+                info[state].extend(names)
+        return info
+
+    def recover(self, source: Path, destination: Path, stale_after: float = 60) -> int:
+        """Settle token moves that a crash left uncommitted.
+
+        A move can only be lost to a power loss, which may undo the rename
+        into the destination but leave the tombstone. So a tombstone made
+        since the host last booted is simply deleted: its token went on,
+        and may have gone further since. One from before is deleted if its
+        token is to be found in the destination, waiting, claimed or
+        errored, or back in the source; otherwise the token is put back in
+        the source bucket, to be processed again rather than lost.
+
+        Args:
+            source (Path): The bucket the tokens were moving out of
+            destination (Path): The bucket they were moving to
+            stale_after (float): Ignore tombstones younger than this many
+                                 seconds, which may belong to live workers
+
+        Returns:
+            int: Number of tokens put back
+        """
+        restored = 0
+        booted = boot_time()
+        for directory in self.shard_dirs(source, refresh=True):
+            for tombstone in directory.glob(".*.put"):
+                try:
+                    made = tombstone.stat().st_ctime
+                except FileNotFoundError:
+                    continue
+                if time() - made < stale_after:
+                    continue
+                barcode = tombstone.name[1:].split(".")[0]
+                survived = booted is not None and made > booted
+                if survived or self.landed(barcode, source, destination):
+                    tombstone.unlink(missing_ok=True)
+                else:
+                    logging.warning(f"restoring {barcode} from an uncommitted move")
+                    tombstone.rename(self.path(source, barcode))
+                    restored += 1
+        return restored
+
+    def landed(self, barcode: str, source: Path, destination: Path) -> bool:
+        """Whether a token is in the destination in any state, or back in the source."""
+        directory = self.token_dir(destination, barcode)
+        if any(directory.glob(f"{barcode}.bak")) or any(directory.glob(f"{barcode}.*.bak")):
+            return True  # claimed by the next stage
+        candidates = [
+            self.path(destination, barcode),
+            self.path(destination, barcode, "error"),
+            self.path(source, barcode),
+            self.path(source, barcode, "error"),
+        ]
+        return any(path.exists() for path in candidates)
+
+
+class TokenQueue:
+    """
+    Orders the waiting tokens of one bucket in the directory store.
+
+    The queue is a heap of the bucket's waiting token files, keyed by
+    enqueue time (the token file's mtime) for "fifo", or by the token's
+    "priority" property, highest first and then oldest first, for
+    "priority". It is refreshed incrementally: a directory whose mtime has
+    not changed is not listed again, and only token files not seen before
+    are stat'ed, or read for their priority. Entries for tokens claimed
+    elsewhere are dropped lazily as they come to the top.
+
+    One queue serves every worker thread claiming from the bucket through
+    the same store, so refreshing and popping are done under a lock.
+
+    Attributes:
+        order (str): "fifo" or "priority"
+    """
+
+    # How often the shards of a sharded bucket are checked for changes
+    SHARD_REFRESH_SECONDS = 1.0
+
+    def __init__(self, store: "DirectoryTokenStore", bucket: Path, order: str) -> None:
+        if order not in ORDERS:
+            raise ValueError(f"unknown token order: {order}")
+        self.store = store
+        self.bucket = bucket
+        self.order = order
+        self.heap: list[tuple] = []
+        self.keys: dict[str, tuple] = {}  # waiting file name -> its heap key
+        self.names: dict[Path, set[str]] = {}  # directory -> waiting file names
+        self.mtimes: dict[Path, int] = {}
+        self.refreshed = 0.0
+        self.lock = threading.Lock()
+
+    def key(self, path: Path) -> tuple | None:
+        try:
+            if self.order == "priority":
+                content = self.store.read(path)
+                return (-int(content.get("priority") or 0), os.stat(path).st_mtime_ns)
+            return (os.stat(path).st_mtime_ns,)
+        except FileNotFoundError:
+            return None
+
+    def refresh(self) -> None:
+        """Bring the heap up to date with any directories that have changed."""
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        sharded = self.store.shard_levels(self.bucket) > 0
+        if sharded and self.heap and time() - self.refreshed < self.SHARD_REFRESH_SECONDS:
+            return
+        self.refreshed = time()
+        for directory in self.store.shard_dirs(self.bucket, refresh=sharded):
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            # as in scan_dir, a directory changed within the last second may
+            # have changed again without its mtime moving
+            if self.mtimes.get(directory) == mtime and time_ns() - mtime > 1_000_000_000:
+                continue
+            self.mtimes[directory] = mtime
+
+            with os.scandir(directory) as entries:
+                names = {
+                    entry.name
+                    for entry in entries
+                    if entry.name.endswith(".json") and not entry.name.startswith(".")
+                }
+            for name in self.names.get(directory, set()) - names:
+                self.keys.pop(name, None)
+            for name in names - self.names.get(directory, set()):
+                if (key := self.key(directory / name)) is not None:
+                    self.keys[name] = key
+                    heapq.heappush(self.heap, (*key, name, directory))
+            self.names[directory] = names
+
+    def pop(self) -> Path | None:
+        """Take the first waiting token file off the queue.
+
+        Returns:
+            Path | None: The token file, which another worker may yet claim
+                         first, or None if the bucket has no waiting tokens
+        """
+        with self.lock:
+            self._refresh()
+            while self.heap:
+                *key, name, directory = heapq.heappop(self.heap)
+                if self.keys.get(name) == tuple(key):
+                    del self.keys[name]
+                    self.names[directory].discard(name)
+                    return directory / name
+            return None
+
+
+class SqliteTokenStore(TokenStore):
+    """
+    Keeps every bucket's tokens in one SQLite database.
+
+    The database runs in WAL mode, so readers never block the writer, and
+    each claim or move is a single transaction, so a crash can never leave
+    a token half moved. A token is found by its bucket and barcode through
+    the primary key, or by its barcode alone through an index, and triggers
+    keep a running count of the tokens in each bucket and state.
+
+    Each thread opens its own connection. A claim's lease is its updated
+    time, set when the token is claimed and again each time it is renewed.
+
+    Attributes:
+        path (Path): The database file
+        durability (str): "fsync" waits for every transaction to reach the
+                          disk (synchronous=FULL); "none" and "group" let
+                          WAL checkpoints flush them (synchronous=NORMAL).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tokens (
+            bucket TEXT NOT NULL,
+            barcode TEXT NOT NULL,
+            state TEXT NOT NULL,
+            owner TEXT NOT NULL DEFAULT '',
+            content BLOB NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            updated REAL NOT NULL,
+            PRIMARY KEY (bucket, barcode)
+        );
+        CREATE INDEX IF NOT EXISTS tokens_by_state ON tokens (bucket, state, updated);
+        CREATE INDEX IF NOT EXISTS tokens_by_priority
+            ON tokens (bucket, state, priority DESC, updated);
+        CREATE INDEX IF NOT EXISTS tokens_by_barcode ON tokens (barcode);
+        CREATE TABLE IF NOT EXISTS counts (
+            bucket TEXT NOT NULL,
+            state TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (bucket, state)
+        );
+        CREATE TRIGGER IF NOT EXISTS count_insert AFTER INSERT ON tokens BEGIN
+            INSERT INTO counts VALUES (NEW.bucket, NEW.state, 1)
+                ON CONFLICT (bucket, state) DO UPDATE SET n = n + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS count_delete AFTER DELETE ON tokens BEGIN
+            UPDATE counts SET n = n - 1 WHERE bucket = OLD.bucket AND state = OLD.state;
+        END;
+        CREATE TRIGGER IF NOT EXISTS count_update AFTER UPDATE OF bucket, state ON tokens BEGIN
+            UPDATE counts SET n = n - 1 WHERE bucket = OLD.bucket AND state = OLD.state;
+            INSERT INTO counts VALUES (NEW.bucket, NEW.state, 1)
+                ON CONFLICT (bucket, state) DO UPDATE SET n = n + 1;
+        END;
+    """
+
+    def __init__(self, path: Path, durability: str = "none", timeout: float = 30) -> None:
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"unknown durability mode: {durability}")
+        self.path = Path(path)
+        self.durability = durability
+        self.timeout = timeout
+        self._local = threading.local()
+        # claims held through this store, and how long each token waited
+        self._held: dict[tuple[str, str, str], float] = {}
+        self._held_lock = threading.Lock()
+        self.connection.executescript(self.SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """This thread's connection to the database."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None leaves transactions to explicit BEGINs
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            synchronous = "FULL" if self.durability == "fsync" else "NORMAL"
+            conn.execute(f"PRAGMA synchronous = {synchronous}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run a block as one transaction, taking the write lock up front."""
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # How each token order sorts the waiting tokens
+    ORDER_BY = {
+        None: "updated",
+        "fifo": "updated",
+        "priority": "priority DESC, updated",
+    }
+
+    def add(self, bucket: Path, barcode: str, data: bytes, priority: int = 0) -> None:
+        # a claimed row becomes the new waiting token; its worker's move
+        # then finds the claim gone, as if it had expired
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO tokens (bucket, barcode, state, content, priority, updated)"
+                " VALUES (?, ?, 'waiting', ?, ?, ?)"
+                " ON CONFLICT (bucket, barcode) DO UPDATE SET state = 'waiting', owner = '',"
+                " content = excluded.content, priority = excluded.priority,"
+                " updated = excluded.updated",
+                (str(bucket), barcode, data, priority, time()),
+            )
+
+    def barcodes(self, bucket: Path, state: str = "waiting") -> Iterator[str]:
+        rows = self.connection.execute(
+            "SELECT barcode FROM tokens WHERE bucket = ? AND state = ? ORDER BY updated",
+            (str(bucket), state),
+        ).fetchall()
+        for (barcode,) in rows:
+            yield barcode
+
+    def load(self, bucket: Path, barcode: str, state: str = "waiting") -> dict | None:
+        row = self.connection.execute(
+            "SELECT content FROM tokens WHERE bucket = ? AND barcode = ? AND state = ?",
+            (str(bucket), barcode, state),
+        ).fetchone()
+        return token_codecs.decode(row[0]) if row else None
+
+    def locate(self, barcode: str) -> list[tuple[Path, str]]:
+        """Find which buckets hold a token, and in what state.
+
+        Args:
+            barcode (str): The token's barcode
+
+        Returns:
+            list[tuple[Path, str]]: Each bucket holding the token, with its state
+        """
+        rows = self.connection.execute(
+            "SELECT bucket, state FROM tokens WHERE barcode = ?", (barcode,)
+        ).fetchall()
+        return [(Path(bucket), state) for bucket, state in rows]
+
+    def claim(
+        self,
+        bucket: Path,
+        owner: str | None,
+        barcode: str | None = None,
+        n: int = 1,
+        order: str | None = None,
+        state: str = "waiting",
+    ) -> list[dict]:
+        if order not in self.ORDER_BY:
+            raise ValueError(f"unknown token order: {order}")
+        if barcode is None and state != "waiting":
+            raise ValueError(f"{state} tokens can only be claimed by barcode")
+        with self.transaction() as conn:
+            if barcode is None:
+                rows = conn.execute(
+                    "SELECT barcode, content, updated FROM tokens"
+                    " WHERE bucket = ? AND state = 'waiting'"
+                    f" ORDER BY {self.ORDER_BY[order]} LIMIT ?",
+                    (str(bucket), n),
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT barcode, content, updated FROM tokens"
+                    " WHERE bucket = ? AND barcode = ? AND state = ?",
+                    (str(bucket), barcode, state),
+                ).fetchall()
+            now = time()
+            conn.executemany(
+                "UPDATE tokens SET state = 'claimed', owner = ?, updated = ?"
+                " WHERE bucket = ? AND barcode = ?",
+                [(owner or "", now, str(bucket), row[0]) for row in rows],
+            )
+        with self._held_lock:
+            for row in rows:
+                self._held[(str(bucket), row[0], owner or "")] = max(0.0, now - row[2])
+        return [token_codecs.decode(content) for _, content, _ in rows]
+
+    def move(
+        self,
+        source: Path,
+        barcode: str,
+        owner: str | None,
+        destination: Path,
+        data: bytes,
+        state: str = "waiting",
+        priority: int = 0,
+    ) -> None:
+        with self.transaction() as conn:
+            if destination != source:
+                conn.execute(
+                    "DELETE FROM tokens WHERE bucket = ? AND barcode = ?",
+                    (str(destination), barcode),
+                )
+            moved = conn.execute(
+                "UPDATE tokens"
+                " SET bucket = ?, state = ?, owner = '', content = ?, priority = ?, updated = ?"
+                " WHERE bucket = ? AND barcode = ? AND state = 'claimed' AND owner = ?",
+                (
+                    str(destination),
+                    state,
+                    data,
+                    priority,
+                    time(),
+                    str(source),
+                    barcode,
+                    owner or "",
+                ),
+            )
+            if moved.rowcount == 0:
+                logging.warning(f"the claim on {barcode} expired; it may be processed twice")
+                if destination != source:
+                    conn.execute(
+                        "INSERT INTO tokens (bucket, barcode, state, content, priority, updated)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (str(destination), barcode, state, data, priority, time()),
+                    )
+        with self._held_lock:
+            self._held.pop((str(source), barcode, owner or ""), None)
+
+    def release(self, bucket: Path, barcode: str, owner: str | None) -> None:
+        with self._held_lock:
+            self._held.pop((str(bucket), barcode, owner or ""), None)
+        with self.transaction() as conn:
+            deleted = conn.execute(
+                "DELETE FROM tokens"
+                " WHERE bucket = ? AND barcode = ? AND state = 'claimed' AND owner = ?",
+                (str(bucket), barcode, owner or ""),
+            )
+            if deleted.rowcount == 0:
+                logging.warning(f"the claim on {barcode} expired before it was released")
+
+    def unclaim(self, bucket: Path, barcode: str, owner: str | None) -> None:
+        with self._held_lock:
+            self._held.pop((str(bucket), barcode, owner or ""), None)
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE tokens SET state = 'waiting', owner = '', updated = ?"
+                " WHERE bucket = ? AND barcode = ? AND state = 'claimed' AND owner = ?",
+                (time(), str(bucket), barcode, owner or ""),
+            )
+
+    def waited(self, bucket: Path, barcode: str, owner: str | None) -> float | None:
+        with self._held_lock:
+            return self._held.get((str(bucket), barcode, owner or ""))
+
+    def renew(self) -> None:
+        with self._held_lock:
+            held = list(self._held)
+        if not held:
+            return
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE tokens SET updated = ?"
+                " WHERE bucket = ? AND barcode = ? AND state = 'claimed' AND owner = ?",
+                [(time(), *claim) for claim in held],
+            )
+
+    def reclaim(self, bucket: Path, lease: float) -> int:
+        with self._held_lock:
+            held = set(self._held)
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT barcode, owner, updated FROM tokens"
+                " WHERE bucket = ? AND state = 'claimed'",
+                (str(bucket),),
+            ).fetchall()
+            abandoned = []
+            for barcode, owner, updated in rows:
+                if (str(bucket), barcode, owner) in held:
+                    continue
+                expired = time() - updated > lease
+                if expired or owner_is_dead(owner):
+                    reason = "expired" if expired else f"held by {owner}, which has exited"
+                    logging.warning(f"reclaiming {barcode}: its claim {reason}")
+                    abandoned.append((time(), str(bucket), barcode))
+            conn.executemany(
+                "UPDATE tokens SET state = 'waiting', owner = '', updated = ?"
+                " WHERE bucket = ? AND barcode = ?",
+                abandoned,
+            )
+        return len(abandoned)
+
+    def scan(self, bucket: Path) -> dict:
+        info: dict = {key: [] for key in self.STATUS_KEYS.values()}
+        rows = self.connection.execute(
+            "SELECT barcode, state, owner FROM tokens WHERE bucket = ?", (str(bucket),)
+        )
+        for barcode, state, owner in rows:
+            if state == "claimed":
+                name = f"{barcode}{claim_suffix(owner or None)}"
+            else:
+                name = f"{barcode}{DirectoryTokenStore.SUFFIXES[state]}"
+            info[self.STATUS_KEYS[state]].append(name)
+        return info
+
+    def counts(self, bucket: Path) -> dict:
+        info = {key: 0 for key in self.STATUS_KEYS.values()}
+        rows = self.connection.execute(
+            "SELECT state, n FROM counts WHERE bucket = ?", (str(bucket),)
+        )
+        for state, n in rows:
+            info[self.STATUS_KEYS[state]] = n
+        return info
+
+
+def open_token_store(database: str | Path | None = None, durability: str = "none") -> TokenStore:
+    """Open the store holding a pipeline's tokens.
+
+    Args:
+        database (str | Path | None): A SQLite database file, or None to
+                                      keep tokens as files in the bucket
+                                      directories
+        durability (str): "none", "fsync" or "group"; see the stores
+
+    Returns:
+        TokenStore: The token store
+    """
+    if database is None:
+        return DirectoryTokenStore(durability)
+    return SqliteTokenStore(Path(database), durability)
@@ -0,0 +1,140 @@
+# watcher.py
+
+# Wakes a filter up when a token lands in its input bucket.  On Linux
+# the bucket is watched with inotify, so a stage notices a token within
+# milliseconds of the upstream rename; everywhere else (or if inotify
+# cannot be set up) we fall back to sleeping for the poll interval, as
+# Filter.run_forever always has.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import sys
+from pathlib import Path
+from time import sleep
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Flags from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class PollingWatcher:
+    """
+    Waits a fixed interval between polls of a bucket.
+
+    This is the behavior Filter.run_forever has always had; it is used when
+    inotify is not requested or not available.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep for the full timeout.
+
+        Args:
+            timeout (float): Seconds to wait
+
+        Returns:
+            bool: Always False; a polling watcher never sees events
+        """
+        sleep(timeout)
+        return False
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """
+    Waits for files to be written to, or renamed into, a bucket.
+
+    Uses the Linux inotify API through ctypes, so no extra dependency is
+    needed. Events are only used as a wakeup signal: the filter still
+    scans the bucket itself after waking. File creation is deliberately
+    not watched, so a filter is not woken before the writer has finished.
+    Renames out of the bucket are watched because a token bound for a
+    sharded bucket is staged in the bucket and then renamed into its shard.
+
+    Attributes:
+        path (Path): The bucket directory being watched
+        fd (int): The inotify file descriptor
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        wd = libc.inotify_add_watch(fd, os.fsencode(str(path)), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno), str(path))
+        self.fd = fd
+
+    def wait(self, timeout: float) -> bool:
+        """Block until something arrives in the bucket or the timeout expires.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait
+
+        Returns:
+            bool: True if woken by an event, False on timeout
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        self._drain()
+        return True
+
+    def _drain(self) -> None:
+        # Coalesce any burst of events into a single wakeup
+        while True:
+            try:
+                if not os.read(self.fd, 4096):
+                    return
+            except BlockingIOError:
+                return
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def make_watcher(path: Path, mode: str = "poll") -> PollingWatcher | InotifyWatcher:
+    """Create a watcher for a bucket.
+
+    Args:
+        path (Path): The bucket directory to watch
+        mode (str): "inotify" to wait on filesystem events, or "poll"
+                    to sleep between scans. Defaults to "poll".
+
+    Returns:
+        PollingWatcher | InotifyWatcher: The watcher; inotify falls back to
+            polling if it is not supported on this platform.
+    """
+    if mode == "inotify":
+        if sys.platform.startswith("linux"):
+            try:
+                return InotifyWatcher(path)
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify unavailable for {path}, polling instead: {e}")
+        else:
+            logger.warning(f"inotify is not supported on {sys.platform}, polling instead")
+    elif mode != "poll":
+        raise ValueError(f"unknown wakeup mode: {mode}")
+
+    return PollingWatcher(path)
@@ -6,7 +6,7 @@ from pathlib import Path
 
 from tabulate import tabulate
 
-from clients import GrinClient, S3Client
+from clients import GrinClient, S3Client, shared_grin_client
 from pipeline.book_ledger import Book, BookLedger
 from pipeline.config_loader import load_config
 from pipeline.plumbing import Pipeline
@@ -103,35 +103,35 @@ class StatusReporter(Reporter):
     @property
     def all_grin_books(self):
         if self._all_grin_books is None:
-            grin = GrinClient()
+            grin = shared_grin_client()
             self._all_grin_books = grin.all_books
         return self._all_grin_books
 
     @property
     def failed_grin_books(self):
         if self._failed_grin_books is None:
-            grin = GrinClient()
+            grin = shared_grin_client()
             self._failed_grin_books = grin.failed_books
         return self._failed_grin_books
 
     @property
     def available_grin_books(self):
         if self._available_grin_books is None:
-            grin = GrinClient()
+            grin = shared_grin_client()
             self._available_grin_books = grin.available_books
         return self._available_grin_books
 
     @property
     def in_process_grin_books(self):
         if self._in_process_grin_books is None:
-            grin = GrinClient()
+            grin = shared_grin_client()
             self._in_process_grin_books = grin.in_process_books
         return self._in_process_grin_books
 
     @property
     def converted_grin_books(self):
         if self._converted_grin_books is None:
-            grin = GrinClient()
+            grin = shared_grin_client()
             self._converted_grin_books = grin.converted_books
         return self._converted_grin_books
 
@@ -0,0 +1,91 @@
+# shard_buckets.py
+
+# Moves the token files of existing buckets into a sharded layout, or
+# back to a flat one.  Stop the pipeline first: filters read a bucket's
+# layout once, when they first use it.
+#
+# Usage: python src/utils/shard_buckets.py --levels 2 /var/tmp/grin/pipeline/done ...
+#        python src/utils/shard_buckets.py --config config.yml --levels 2 done stored
+#
+# The tool can be run again safely: it gathers token files from the flat
+# bucket and from every shard, whatever the bucket's recorded layout, so
+# a run that was interrupted is finished by the next one.
+
+import os
+from pathlib import Path
+
+from pipeline.token_store import DirectoryTokenStore, is_shard_name, shard_path
+
+# Token files and claims; tombstones and temporary files are left alone
+TOKEN_SUFFIXES = (".json", ".err", ".bak")
+
+
+def token_files(directory: Path):
+    """Yield every token file in a bucket, flat or sharded, at any depth."""
+    with os.scandir(directory) as entries:
+        for entry in list(entries):
+            if entry.is_dir() and is_shard_name(entry.name):
+                yield from token_files(Path(entry.path))
+            elif entry.name.endswith(TOKEN_SUFFIXES) and not entry.name.startswith("."):
+                yield Path(entry.path)
+
+
+def remove_empty_shards(directory: Path) -> None:
+    with os.scandir(directory) as entries:
+        shards = [entry for entry in entries if entry.is_dir() and is_shard_name(entry.name)]
+    for entry in shards:
+        remove_empty_shards(Path(entry.path))
+        try:
+            os.rmdir(entry.path)
+        except OSError:
+            pass  # still holds tokens
+
+
+def reshard(bucket: Path, levels: int) -> int:
+    """Give a bucket a new shard layout.
+
+    Args:
+        bucket (Path): The bucket directory
+        levels (int): Levels of shard directories; 0 for a flat bucket
+
+    Returns:
+        int: Number of token files moved
+    """
+    moved = 0
+    for path in list(token_files(bucket)):
+        barcode = path.name.split(".")[0]
+        destination = bucket / shard_path(barcode, levels) / path.name
+        if destination != path:
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            path.rename(destination)
+            moved += 1
+
+    shards_file = bucket / DirectoryTokenStore.SHARDS_FILE
+    if levels:
+        shards_file.write_text(f"{levels}\n")
+    else:
+        shards_file.unlink(missing_ok=True)
+    remove_empty_shards(bucket)
+    return moved
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from pipeline.config_loader import load_config
+
+    parser = argparse.ArgumentParser(description="Shard or unshard pipeline buckets")
+    parser.add_argument("--levels", type=int, required=True, help="0 makes the buckets flat")
+    parser.add_argument("--config", help="config file; buckets are then given by name")
+    parser.add_argument("buckets", nargs="+")
+    args = parser.parse_args()
+
+    if args.config:
+        paths = {rec["name"]: rec["path"] for rec in load_config(args.config)["buckets"]}
+        buckets = [Path(paths[name]) for name in args.buckets]
+    else:
+        buckets = [Path(bucket) for bucket in args.buckets]
+
+    for bucket in buckets:
+        moved = reshard(bucket, args.levels)
+        print(f"{bucket}: moved {moved} token files")
@@ -0,0 +1,32 @@
+# sizes.py
+
+# Reading sizes and rates written for people, like "50G" or "20M", in
+# the configuration.  Shared by the clients (bandwidth budgets) and the
+# pipeline (free-space thresholds).
+
+import re
+
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def parse_size(size: int | float | str) -> int:
+    """Read a size in bytes, as a number or as a string like "50G" or "500 MB".
+
+    Units are binary: "1K" and "1KB" are both 1024 bytes.
+
+    Args:
+        size (int | float | str): The size
+
+    Returns:
+        int: The size in bytes
+
+    Raises:
+        ValueError: If the size cannot be read
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?)(i?b)?\s*", size, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"not a size: {size!r}")
+    number, unit = match.group(1), match.group(2).lower()
+    return int(float(number) * SIZE_UNITS[unit])
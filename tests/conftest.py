@@ -0,0 +1,25 @@
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import Pipe, Token, dump_token
+
+
+@pytest.fixture
+def make_pipe():
+    """Make a pipe between two buckets, "in" and "out", in a directory.
+
+    The factory takes the directory, the barcodes of tokens to leave
+    waiting in the input bucket, and any keyword arguments for Pipe.
+    """
+
+    def make(tmpdir: str, barcodes=(), **kwargs) -> Pipe:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir(exist_ok=True)
+        pipe_out.mkdir(exist_ok=True)
+        for barcode in barcodes:
+            dump_token(Token({"barcode": barcode}), pipe_in / f"{barcode}.json")
+        return Pipe(pipe_in, pipe_out, **kwargs)
+
+    return make
@@ -0,0 +1,80 @@
+import asyncio
+import tempfile
+import threading
+import time
+
+from pipeline.plumbing import AsyncFilter, load_token
+
+NUM_TOKENS = 30
+DELAY = 0.1
+
+
+class AsyncNoOp(AsyncFilter):
+    """Stands in for a network-bound stage: each token waits DELAY seconds."""
+
+    def validate_token(self, token) -> bool:
+        return token.name != "bad"
+
+    async def process_token(self, token) -> bool:
+        await asyncio.sleep(DELAY)
+        if token.name == "boom":
+            raise RuntimeError("lost connection")
+        return True
+
+
+def test_run_once_routes_tokens(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["bad"], worker_id="test")
+        filter = AsyncNoOp(pipe)
+        assert filter.run_once() is False
+        assert load_token(pipe.input / "bad.err").content["log"][0]["message"] == (
+            "Token did not validate"
+        )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["boom"], worker_id="test")
+        assert AsyncNoOp(pipe).run_once() is False
+        assert "lost connection" in load_token(pipe.input / "boom.err").content["log"][0]["message"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["good"], worker_id="test")
+        assert AsyncNoOp(pipe).run_once() is True
+        assert (pipe.output / "good.json").exists()
+        assert AsyncNoOp(pipe).run_once() is False
+
+
+def test_serve_keeps_many_tokens_in_flight(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        barcodes = {str(n) for n in range(NUM_TOKENS)}
+        pipe = make_pipe(tmpdir, barcodes, worker_id="test")
+        filter = AsyncNoOp(pipe, poll_interval=1, concurrency=NUM_TOKENS)
+
+        runner = threading.Thread(target=filter.run_forever)
+        start = time.monotonic()
+        runner.start()
+        deadline = start + 10
+        while len(list(pipe.output.glob("*.json"))) < NUM_TOKENS and time.monotonic() < deadline:
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        filter.stop()
+        runner.join(timeout=5)
+
+        assert not runner.is_alive()
+        assert {f.stem for f in pipe.output.glob("*.json")} == barcodes
+        assert list(pipe.input.iterdir()) == []
+        # one at a time this would take NUM_TOKENS * DELAY seconds
+        assert elapsed < NUM_TOKENS * DELAY / 2
+
+
+def test_run_once_keeps_the_thread_loop(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["a", "b"], worker_id="test")
+        filter = AsyncNoOp(pipe)
+        loop = filter.event_loop()
+        assert filter.run_once() and filter.run_once()
+        assert filter.event_loop() is loop
+        other = []
+        thread = threading.Thread(target=lambda: other.append(filter.event_loop()))
+        thread.start()
+        thread.join()
+        assert other[0] is not loop
@@ -0,0 +1,71 @@
+import shutil
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+
+from pipeline.backpressure import Backpressure
+from pipeline.plumbing import Filter, Pipe
+
+
+class Pass(Filter):
+    def validate_token(self, token) -> bool:
+        return True
+
+    def process_token(self, token) -> bool:
+        return True
+
+
+def test_filter_pauses_at_the_wip_limit(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1", "2", "3"])
+        filt = Pass(pipe, backpressure=Backpressure(wip_limit=2, interval=0))
+        assert filt.run_once() and filt.run_once()
+        assert filt.run_once() is False
+        assert (pipe.input / "3.json").exists()
+
+        # the next stage drains the output bucket, and the filter resumes
+        (pipe.output / "1.json").unlink()
+        assert filt.run_once()
+        assert (pipe.output / "3.json").exists()
+
+
+def test_tokens_in_process_downstream_count(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1", "2"])
+        filt = Pass(pipe, backpressure=Backpressure(wip_limit=1, interval=0))
+        filt.run_once()
+        Pipe(pipe.output, Path(tmpdir), worker_id="next").take_token()
+        assert filt.run_batch(2) is False
+
+
+def test_filter_pauses_when_disk_is_short(monkeypatch, make_pipe):
+    usage = namedtuple("usage", "total used free")
+    free = {"bytes": 10}
+    monkeypatch.setattr(
+        shutil, "disk_usage", lambda path: usage(100, 100 - free["bytes"], free["bytes"])
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1"])
+        backpressure = Backpressure(min_free_space=50, path=Path(tmpdir), interval=0)
+        filt = Pass(pipe, backpressure=backpressure)
+        assert filt.run_once() is False
+        free["bytes"] = 60
+        assert filt.run_once()
+
+
+def test_checks_are_cached(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1", "2"])
+        filt = Pass(pipe, backpressure=Backpressure(wip_limit=1, interval=60))
+        assert filt.run_once()
+        # the output bucket is now full, but the last check still stands
+        assert filt.run_once()
+
+
+def test_no_limits_by_default(monkeypatch):
+    monkeypatch.delenv("WIP_LIMIT", raising=False)
+    monkeypatch.delenv("MIN_FREE_SPACE", raising=False)
+    assert not Backpressure.from_env().enabled
+    monkeypatch.setenv("MIN_FREE_SPACE", "1G")
+    monkeypatch.setenv("FREE_SPACE_PATH", "/tmp")
+    assert Backpressure.from_env().min_free_space == 1024**3
@@ -0,0 +1,77 @@
+import json
+import multiprocessing
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from clients.bandwidth import Bandwidth, Profile
+
+# 2026-10-12 was a Monday
+MONDAY_NOON = datetime(2026, 10, 12, 12, 0)
+MONDAY_NIGHT = datetime(2026, 10, 12, 23, 0)
+TUESDAY_DAWN = datetime(2026, 10, 13, 5, 0)
+SATURDAY_NOON = datetime(2026, 10, 17, 12, 0)
+SATURDAY_DAWN = datetime(2026, 10, 17, 5, 0)
+
+
+def test_rate_follows_the_profiles():
+    business_hours = Profile("08:00", 18 * 60, "20M", ["mon", "tue", "wed", "thu", "fri"])
+    weeknights = Profile("22:00", "06:00", "50M", ["Monday", "Friday"])
+    bandwidth = Bandwidth("state", rate=0, profiles=[business_hours, weeknights])
+
+    assert bandwidth.rate_at(MONDAY_NOON) == 20 * 1024**2
+    assert bandwidth.rate_at(SATURDAY_NOON) == 0
+    assert bandwidth.rate_at(MONDAY_NIGHT) == 50 * 1024**2
+    assert bandwidth.rate_at(TUESDAY_DAWN) == 50 * 1024**2  # Monday night's window
+    assert bandwidth.rate_at(SATURDAY_DAWN) == 50 * 1024**2  # Friday night's window
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("BANDWIDTH_FILE", "/tmp/state")
+    monkeypatch.setenv("BANDWIDTH_RATE", "1M")
+    monkeypatch.setenv(
+        "BANDWIDTH_PROFILES", json.dumps([{"from": "00:00", "to": "00:00", "rate": 0}])
+    )
+    bandwidth = Bandwidth.from_env()
+    assert bandwidth.enabled
+    assert bandwidth.rate == 1024**2
+    assert bandwidth.profiles[0].applies(SATURDAY_NOON) is False
+
+
+def test_no_limit_without_a_file(monkeypatch):
+    monkeypatch.delenv("BANDWIDTH_FILE", raising=False)
+    bandwidth = Bandwidth.from_env()
+    assert not bandwidth.enabled
+    assert bandwidth.reserve(10**12) == 0
+
+
+def test_budget_is_shared_through_the_file():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        state = Path(tmpdir) / "bandwidth"
+        first = Bandwidth(state, rate=1000)
+        second = Bandwidth(state, rate=1000)
+        assert first.reserve(1000) == 0  # a full bucket
+        assert 0.9 < second.reserve(1000) <= 1.0
+        assert 1.9 < first.reserve(1000) <= 2.0
+
+
+def draw(state: Path, chunks: int) -> None:
+    bandwidth = Bandwidth(state, rate=100_000, burst=0.1)
+    for _ in range(chunks):
+        bandwidth.take(5_000)
+
+
+def test_processes_share_one_rate():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        state = Path(tmpdir) / "bandwidth"
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=draw, args=(state, 10)) for _ in range(3)]
+        started = time.monotonic()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # 150 KB at 100 KB/s, less the 10 KB the bucket starts with
+        assert time.monotonic() - started >= 1.3
+        assert all(process.exitcode == 0 for process in processes)
@@ -0,0 +1,130 @@
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from pipeline.filters.uploader import AWSUploader
+from pipeline.plumbing import Filter, Token, dump_token, load_token
+
+Obj = namedtuple("Obj", ["Key"])
+
+
+class EvenOnly(Filter):
+    """Processes tokens with even barcodes; refuses odd ones."""
+
+    def validate_token(self, token) -> bool:
+        return token.name != "99"
+
+    def process_token(self, token) -> bool:
+        return int(token.name) % 2 == 0
+
+
+class Exploding(EvenOnly):
+    def process_batch(self, tokens):
+        raise RuntimeError("bulk request failed")
+
+
+def test_take_tokens(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1", "2", "3", "4", "5"])
+        tokens = pipe.take_tokens(3)
+        assert len(tokens) == 3
+        assert len(list(pipe.input.glob("*.bak"))) == 3
+        assert len(list(pipe.input.glob("*.json"))) == 2
+
+        # a second batch can't be taken while one is held
+        assert pipe.take_tokens(3) == []
+
+        for token in tokens:
+            pipe.put_token(token=token)
+        assert pipe.batch == []
+        assert len(list(pipe.input.glob("*.bak"))) == 0
+        assert len(list(pipe.output.glob("*.json"))) == 3
+
+
+def test_run_batch_routes_each_token(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1", "2", "3", "4", "99"])
+        assert EvenOnly(pipe).run_batch(10) is True
+
+        assert {f.stem for f in pipe.output.glob("*.json")} == {"2", "4"}
+        assert {f.stem for f in pipe.input.glob("*.err")} == {"1", "3", "99"}
+        assert list(pipe.input.glob("*.bak")) == []
+        assert load_token(pipe.input / "99.err").content["log"][0]["message"] == (
+            "Token did not validate"
+        )
+        assert EvenOnly(pipe).run_batch(10) is False
+
+
+def test_run_batch_failure(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["2", "4"])
+        assert Exploding(pipe).run_batch(10) is False
+        assert {f.stem for f in pipe.input.glob("*.err")} == {"2", "4"}
+        token = load_token(pipe.input / "2.err")
+        assert "bulk request failed" in token.content["log"][0]["message"]
+
+
+def add_books(tmpdir: str, pipe, barcodes) -> None:
+    processing_bucket = Path(tmpdir) / "processing"
+    processing_bucket.mkdir(exist_ok=True)
+    for barcode in barcodes:
+        token = Token({"barcode": barcode, "processing_bucket": str(processing_bucket)})
+        dump_token(token, pipe.input / f"{barcode}.json")
+        (processing_bucket / f"{barcode}.tgz").write_text("test data")
+
+
+def test_uploader_validates_batch_with_one_lookup(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, [])
+        add_books(tmpdir, pipe, ["1", "2"])
+
+        mock_s3 = MagicMock()
+        mock_s3.list_objects.return_value = [Obj("1")]
+        mock_s3.store_object.return_value = True
+
+        uploader = AWSUploader(pipe, mock_s3, small_batch=1)
+        assert uploader.run_batch(10) is True
+
+        mock_s3.list_objects.assert_called_once()
+        mock_s3.object_exists.assert_not_called()
+        mock_s3.store_object.assert_called_once_with("2")
+        assert load_token(pipe.output / "1.json").get_prop("upload_status") == "duplicate"
+        assert load_token(pipe.output / "2.json").get_prop("upload_status") == "success"
+
+
+def test_uploader_reuses_the_listing_until_it_expires(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, [])
+        mock_s3 = MagicMock()
+        mock_s3.list_objects.return_value = [Obj("1")]
+        mock_s3.store_object.return_value = True
+        uploader = AWSUploader(pipe, mock_s3, small_batch=1)
+
+        add_books(tmpdir, pipe, ["1", "2"])
+        uploader.run_batch(10)
+        # the second batch finds 2, stored by the first, without a new listing
+        add_books(tmpdir, pipe, ["2", "3"])
+        uploader.run_batch(10)
+        mock_s3.list_objects.assert_called_once()
+        assert mock_s3.store_object.call_count == 2
+        assert load_token(pipe.output / "2.json").get_prop("upload_status") == "duplicate"
+
+        uploader.inventory_ttl = 0
+        add_books(tmpdir, pipe, ["4"])
+        uploader.run_batch(10)
+        assert mock_s3.list_objects.call_count == 2
+
+
+def test_uploader_asks_after_each_object_of_a_small_batch(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, [])
+        add_books(tmpdir, pipe, ["1", "2"])
+        mock_s3 = MagicMock()
+        mock_s3.object_exists.side_effect = lambda key: key == "1"
+        mock_s3.store_object.return_value = True
+
+        assert AWSUploader(pipe, mock_s3, small_batch=3).run_batch(10) is True
+        mock_s3.list_objects.assert_not_called()
+        assert mock_s3.object_exists.call_count == 2
+        mock_s3.store_object.assert_called_once_with("2")
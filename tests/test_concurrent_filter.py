@@ -0,0 +1,95 @@
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from pipeline.filters.monitors import Monitor
+from pipeline.plumbing import Filter, Pipe, Token, dump_token, load_token
+
+NUM_TOKENS = 20
+WORKERS = 5
+DELAY = 0.05
+
+
+class SlowNoOp(Filter):
+    """Stands in for an I/O-bound stage: each token takes DELAY seconds."""
+
+    def validate_token(self, token) -> bool:
+        return True
+
+    def process_token(self, token) -> bool:
+        time.sleep(DELAY)
+        self.log_to_token(token, "INFO", threading.current_thread().name)
+        return True
+
+
+def test_run_concurrent():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        barcodes = {str(n) for n in range(NUM_TOKENS)}
+        for barcode in barcodes:
+            dump_token(Token({"barcode": barcode}), pipe_in / f"{barcode}.json")
+
+        filter = SlowNoOp(Pipe(pipe_in, pipe_out, worker_id="test"), poll_interval=1)
+        runner = threading.Thread(target=filter.run_concurrent, args=(WORKERS,))
+        start = time.monotonic()
+        runner.start()
+
+        deadline = start + 10
+        while len(list(pipe_out.glob("*.json"))) < NUM_TOKENS and time.monotonic() < deadline:
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        filter.stop()
+        runner.join(timeout=5)
+
+        assert not runner.is_alive()
+        assert {f.stem for f in pipe_out.glob("*.json")} == barcodes
+        assert list(pipe_in.iterdir()) == []
+        # serially this would take NUM_TOKENS * DELAY seconds
+        assert elapsed < NUM_TOKENS * DELAY
+        threads = {load_token(f).content["log"][0]["message"] for f in pipe_out.glob("*.json")}
+        assert len(threads) > 1
+
+
+def test_for_worker():
+    pipe = Pipe(Path("/tmp/in"), Path("/tmp/out"))
+    worker_pipe = pipe.for_worker("w1")
+    assert worker_pipe.input == pipe.input
+    assert worker_pipe.output == pipe.output
+    assert worker_pipe.worker_id == "w1"
+    assert pipe.worker_id is None
+    assert worker_pipe.token is None
+
+
+class PassingMonitor(Monitor):
+    def process_token(self, token) -> bool:
+        return True
+
+
+def test_monitors_run_in_one_thread_whatever_their_concurrency():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        dump_token(Token({"barcode": "1"}), pipe_in / "1.json")
+
+        monitor = PassingMonitor(Pipe(pipe_in, pipe_out, worker_id="test"), poll_interval=1)
+        monitor.concurrency = WORKERS
+        with pytest.raises(TypeError):
+            monitor.run_concurrent(WORKERS)
+
+        runner = threading.Thread(target=monitor.run_forever)
+        runner.start()
+        deadline = time.monotonic() + 5
+        while not (pipe_out / "1.json").exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        monitor.stop()
+        runner.join(timeout=5)
+        assert not runner.is_alive()
+        assert (pipe_out / "1.json").exists()
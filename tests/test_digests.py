@@ -0,0 +1,123 @@
+import hashlib
+import random
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+
+from clients.digests import Digests, DigestingReader, mismatches, s3_checksum_args
+from pipeline.filters.decryptor import Decryptor
+from pipeline.filters.uploader import AWSUploader
+from pipeline.plumbing import Pipe, Token, dump_token, load_token
+
+BOOK = random.Random(1).randbytes(200_000)
+
+
+def test_digests():
+    digests = Digests()
+    for chunk in [b"a", b"bc"]:
+        digests.update(chunk)
+    assert digests.hexdigests() == {
+        "sha256": hashlib.sha256(b"abc").hexdigest(),
+        "md5": hashlib.md5(b"abc").hexdigest(),
+        "crc32": "352441c2",
+        "size": 3,
+    }
+
+
+def test_digests_of_a_stream_match_the_file():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "book"
+        path.write_bytes(BOOK)
+        streamed = Digests()
+        assert b"".join(streamed.tee([BOOK[:1000], BOOK[1000:]])) == BOOK
+        with path.open("rb") as f:
+            reader = DigestingReader(f)
+            while reader.read(4096):
+                pass
+        assert streamed.hexdigests() == Digests.of_file(path).hexdigests()
+        assert reader.digests.hexdigests() == streamed.hexdigests()
+
+
+def test_s3_checksum_args():
+    digests = Digests()
+    digests.update(b"abc")
+    args = s3_checksum_args(digests.hexdigests())
+    assert args["ChecksumCRC32"] == "NSRBwg=="
+    assert args["Metadata"]["sha256"] == hashlib.sha256(b"abc").hexdigest()
+
+
+def test_mismatches():
+    assert mismatches(None, {"sha256": "a"}) == []
+    assert mismatches({"sha256": "a", "size": 1}, {"sha256": "b", "size": 1}) == ["sha256"]
+
+
+@pytest.fixture
+def decrypting(monkeypatch):
+    if shutil.which("gpg") is None:
+        pytest.skip("needs gpg")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        monkeypatch.setenv("GNUPGHOME", tmpdir)
+        monkeypatch.setenv("DECRYPTION_PASSPHRASE", "phrase")
+        processing = Path(tmpdir) / "processing"
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        for d in [processing, pipe_in, pipe_out]:
+            d.mkdir()
+        encrypted = subprocess.run(
+            ["gpg", "--batch", "--yes", "--passphrase", "phrase", "--symmetric"],
+            input=BOOK,
+            capture_output=True,
+            check=True,
+        ).stdout
+        (processing / "1234567.tar.gz.gpg").write_bytes(encrypted)
+        downloaded = Digests()
+        downloaded.update(encrypted)
+        yield Pipe(pipe_in, pipe_out), processing, downloaded.hexdigests()
+
+
+def test_decryptor_checks_and_records_digests(decrypting):
+    pipe, processing, downloaded = decrypting
+    token = Token({"barcode": "1234567", "processing_bucket": str(processing)})
+    token.content["digests"] = {"encrypted": downloaded}
+    dump_token(token, pipe.input / "1234567.json")
+
+    assert Decryptor(pipe).run_once()
+    assert (processing / "1234567.tgz").read_bytes() == BOOK
+    digests = load_token(pipe.output / "1234567.json").get_prop("digests")
+    assert digests["encrypted"] == downloaded
+    assert digests["decrypted"]["sha256"] == hashlib.sha256(BOOK).hexdigest()
+
+
+def test_decryptor_rejects_a_changed_file(decrypting):
+    pipe, processing, downloaded = decrypting
+    token = Token({"barcode": "1234567", "processing_bucket": str(processing)})
+    token.content["digests"] = {"encrypted": {**downloaded, "sha256": "0" * 64}}
+    dump_token(token, pipe.input / "1234567.json")
+
+    Decryptor(pipe).run_once()
+    token = load_token(pipe.input / "1234567.err")
+    assert token.get_prop("decryption_status") == "fail"
+    assert not (processing / "1234567.tgz").exists()
+    assert (processing / "1234567.tar.gz.gpg").exists()
+
+
+def test_uploader_hands_digests_to_s3():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        decrypted = {"sha256": "ab", "md5": "cd", "crc32": "352441c2", "size": 3}
+        token = Token({"barcode": "1234567"})
+        token.content["digests"] = {"decrypted": decrypted}
+        dump_token(token, pipe_in / "1234567.json")
+
+        s3 = MagicMock()
+        s3.object_exists.return_value = False
+        s3.store_object.return_value = True
+        AWSUploader(Pipe(pipe_in, pipe_out), s3).run_once()
+        s3.store_object.assert_called_once_with("1234567", digests=decrypted)
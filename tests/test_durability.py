@@ -0,0 +1,106 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+from pipeline import token_store
+from pipeline.plumbing import GroupCommit, Pipe, Token, dump_token, load_token
+
+
+def test_dump_token_is_atomic():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        destination = Path(tmpdir) / "1234.json"
+        dump_token(Token({"barcode": "1234"}), destination)
+
+        # a failed write leaves the old token intact and no temp file behind
+        with pytest.raises(TypeError):
+            dump_token(Token({"barcode": "1234", "bad": object()}), destination)
+        assert load_token(destination).content == {"barcode": "1234"}
+        assert os.listdir(tmpdir) == ["1234.json"]
+
+
+def test_unknown_durability():
+    with pytest.raises(ValueError):
+        Pipe(Path("/tmp"), Path("/tmp"), durability="sometimes")
+
+
+def test_fsync_mode(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1234"], durability="fsync")
+        pipe.take_token()
+        pipe.put_token()
+        assert list(pipe.input.iterdir()) == []
+        assert load_token(pipe.output / "1234.json").name == "1234"
+
+
+def test_group_mode_keeps_tombstone_until_commit(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1234"], durability="group")
+        pipe.group_commit = GroupCommit(max_pending=10, max_delay=60)
+        pipe.take_token()
+        pipe.put_token()
+
+        assert (pipe.output / "1234.json").exists()
+        assert len(list(pipe.input.glob(".1234.*.put"))) == 1
+        assert list(pipe.input.glob("*.bak")) == []
+
+        pipe.group_commit.commit()
+        assert list(pipe.input.iterdir()) == []
+
+
+def test_group_commit_when_full(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1234"], durability="group")
+        pipe.group_commit = GroupCommit(max_pending=2, max_delay=60)
+        dump_token(Token({"barcode": "5678"}), pipe.input / "5678.json")
+        pipe.take_token()
+        pipe.put_token()
+        assert len(list(pipe.input.glob(".*.put"))) == 1
+        pipe.take_token()
+        pipe.put_token()
+        assert list(pipe.input.iterdir()) == []
+
+
+@pytest.fixture
+def power_loss(monkeypatch):
+    """Make every tombstone look older than the host's last boot."""
+    monkeypatch.setattr(token_store, "boot_time", lambda: time.time() + 60)
+
+
+def test_recover(make_pipe, power_loss):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1234"], durability="none")
+        # a crash after the move reached the output bucket
+        (pipe.input / "1234.json").rename(pipe.input / ".1234.aaaa.put")
+        dump_token(Token({"barcode": "1234"}), pipe.output / "1234.json")
+        # a crash that lost the move
+        dump_token(Token({"barcode": "5678"}), pipe.input / ".5678.bbbb.put")
+
+        assert pipe.recover(stale_after=60) == 0
+        assert pipe.recover(stale_after=0) == 1
+        assert sorted(f.name for f in pipe.input.iterdir()) == ["5678.json"]
+        assert (pipe.output / "1234.json").exists()
+
+
+def test_recover_leaves_a_token_that_moved_on(make_pipe, power_loss):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1234"], durability="none")
+        (pipe.input / "1234.json").rename(pipe.input / ".1234.aaaa.put")
+        # the next stage has already claimed the token
+        dump_token(Token({"barcode": "1234"}), pipe.output / "1234.next-worker.bak")
+
+        assert pipe.recover(stale_after=0) == 0
+        assert list(pipe.input.iterdir()) == []
+
+
+def test_recover_trusts_tombstones_made_since_boot(make_pipe, monkeypatch):
+    monkeypatch.setattr(token_store, "boot_time", lambda: time.time() - 60)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1234"], durability="none")
+        # the token has gone on past the output bucket
+        (pipe.input / "1234.json").rename(pipe.input / ".1234.aaaa.put")
+
+        assert pipe.recover(stale_after=0) == 0
+        assert list(pipe.input.iterdir()) == []
@@ -0,0 +1,132 @@
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from pipeline.filters.monitors import Monitor
+from pipeline.fused import FusedPipeline
+from pipeline.plumbing import Filter, Pipeline, load_token
+from pipeline.token_bag import TokenBag
+
+BUCKETS = ["start", "one", "two", "done"]
+
+
+class Stamp(Filter):
+    """Stamps each token with its stage name; fails tokens named after itself."""
+
+    def validate_token(self, token) -> bool:
+        return True
+
+    def process_token(self, token) -> bool:
+        if token.name == f"fail-{self.name}":
+            raise RuntimeError("failed on purpose")
+        token.put_prop(self.name, True)
+        return True
+
+
+def make_pipeline(tmpdir: str) -> Pipeline:
+    pipeline = Pipeline({"buckets": [{"name": b, "path": str(Path(tmpdir) / b)} for b in BUCKETS]})
+    for bucket in BUCKETS:
+        pipeline.bucket(bucket).mkdir()
+    return pipeline
+
+
+def make_chain(pipeline: Pipeline) -> list[Filter]:
+    stages = []
+    for i, name in enumerate(["a", "b", "c"]):
+        stage = Stamp(pipeline.pipe(BUCKETS[i], BUCKETS[i + 1]), poll_interval=0.05)
+        stage.name = name
+        stages.append(stage)
+    return stages
+
+
+def run_until(fused: FusedPipeline, done: callable, timeout: float = 10) -> None:
+    runner = threading.Thread(target=fused.run_forever)
+    runner.start()
+    try:
+        deadline = time.monotonic() + timeout
+        while not done() and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        fused.stop()
+        runner.join()
+
+
+def test_tokens_skip_unchecked_buckets():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipeline = make_pipeline(tmpdir)
+        bag = TokenBag()
+        bag.add_books([str(n) for n in range(20)] + ["fail-b"])
+        bag.pour_into(pipeline.bucket("start"))
+        fused = FusedPipeline(make_chain(pipeline), checkpoints=[pipeline.bucket("two")])
+
+        seen_in_one = set()
+
+        def done():
+            seen_in_one.update(p.name for p in pipeline.bucket("one").iterdir())
+            return pipeline.summary["done"]["waiting_tokens"] == 20
+
+        run_until(fused, done)
+        assert pipeline.summary["done"]["waiting_tokens"] == 20
+        token = load_token(pipeline.bucket("done") / "7.json")
+        assert token.get_prop("a") and token.get_prop("b") and token.get_prop("c")
+
+        # only the failed token was ever written to the unchecked bucket
+        assert seen_in_one <= {"fail-b.err"}
+        assert load_token(pipeline.bucket("one") / "fail-b.err").get_prop("a") is True
+        assert pipeline.summary["start"] == {
+            "waiting_tokens": 0,
+            "errored_tokens": 0,
+            "in_process_tokens": 0,
+        }
+
+
+def test_stopping_returns_queued_tokens_unchanged():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipeline = make_pipeline(tmpdir)
+        bag = TokenBag()
+        bag.add_books([str(n) for n in range(10)])
+        bag.pour_into(pipeline.bucket("start"))
+        stages = make_chain(pipeline)
+
+        # the second stage never takes anything, so tokens pile up on its queue
+        stages[1].run_once = lambda pipe=None: False
+        fused = FusedPipeline(stages, queue_size=4)
+        run_until(fused, lambda: fused.pipes[0].sink.full(), timeout=5)
+
+        assert pipeline.summary["start"]["in_process_tokens"] == 0
+        returned = [load_token(path) for path in pipeline.bucket("start").glob("*.json")]
+        assert len(returned) == 10
+        assert not any(token.get_prop("a") for token in returned)
+
+
+def test_chain_must_connect():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipeline = make_pipeline(tmpdir)
+        stages = make_chain(pipeline)
+        with pytest.raises(ValueError):
+            FusedPipeline([stages[0], stages[2]])
+
+
+def test_monitors_cannot_be_fused():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipeline = make_pipeline(tmpdir)
+        stages = make_chain(pipeline)
+        stages[1] = Monitor(pipeline.pipe("one", "two"))
+        with pytest.raises(ValueError, match="cannot be fused"):
+            FusedPipeline(stages)
+
+
+def test_segments():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipeline = make_pipeline(tmpdir)
+        fused = FusedPipeline(make_chain(pipeline), checkpoints=[pipeline.bucket("one")])
+        assert [(s.input.name, s.output.name) for s in fused.segments] == [
+            ("start", "one"),
+            ("one", "done"),
+        ]
+        assert [p.sink is None for p in fused.pipes] == [True, False, True]
+        with pytest.raises(ValueError):
+            fused.pipes[0].put_token()
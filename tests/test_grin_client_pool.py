@@ -0,0 +1,153 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from clients import grin_client
+from clients.grin_client import GrinClient, client_settings, http2_available, shared_grin_client
+
+
+class GrinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections open between requests
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.peers.append(self.client_address[1])
+        self.server.auth.append(self.headers.get("Authorization"))
+        if self.headers.get("Authorization") in self.server.revoked:
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"3210100000001\t2024-01-01\n"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GrinHandler)
+    server.daemon_threads = True
+    server.peers, server.auth, server.revoked = [], [], set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(monkeypatch, server):
+    monkeypatch.setenv("GOOGLE_SECRETS_FILE", "secrets")
+    monkeypatch.setenv("GOOGLE_TOKEN_FILE", "token")
+    monkeypatch.setattr(grin_client, "load_creds_or_die", lambda secrets, token: None)
+    monkeypatch.setattr(
+        grin_client, "build_auth_header", lambda creds: {"Authorization": "Bearer TEST"}
+    )
+    client = GrinClient()
+    client.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield client
+    client.close()
+
+
+def test_requests_share_a_connection(client, server):
+    client.grin_data("in_process")
+    client.grin_data("converted")
+    client.grin_data("failed")
+    assert len(server.peers) == 3
+    assert len(set(server.peers)) == 1
+    assert server.auth == ["Bearer TEST"] * 3
+
+
+def test_closed_client_reconnects(client, server):
+    client.grin_data("in_process")
+    client.close()
+    client.grin_data("in_process")
+    assert len(set(server.peers)) == 2
+
+
+async def fetch(client):
+    http = await client.async_http()
+    await http.get(client.resource_url("_in_process"))
+    return http
+
+
+def test_async_client_of_a_closed_loop_is_closed(client, server):
+    first = asyncio.run(fetch(client))
+    assert asyncio.run(fetch(client)) is not first
+    assert first.is_closed
+    assert len(set(server.peers)) == 2
+
+
+def test_async_client_is_kept_while_its_loop_lives(client, server):
+    loop = asyncio.new_event_loop()
+    try:
+        http = loop.run_until_complete(fetch(client))
+        assert loop.run_until_complete(fetch(client)) is http
+        assert len(set(server.peers)) == 1
+        client.close()
+        assert http.is_closed
+    finally:
+        loop.close()
+
+
+def test_shared_client_is_made_once(client, monkeypatch):
+    monkeypatch.setattr(grin_client, "_shared_client", None)
+    assert shared_grin_client() is shared_grin_client()
+    shared_grin_client().close()
+
+
+def test_client_settings(monkeypatch):
+    monkeypatch.setenv("GRIN_MAX_CONNECTIONS", "7")
+    monkeypatch.delenv("GRIN_HTTP2", raising=False)
+    settings = client_settings()
+    assert settings["limits"].max_connections == 7
+    assert settings["http2"] is http2_available()
+    monkeypatch.setenv("GRIN_HTTP2", "false")
+    assert client_settings()["http2"] is False
+
+
+class FakeCreds:
+    """Credentials whose token changes each time they are refreshed."""
+
+    def __init__(self) -> None:
+        self.token = "first"
+        self.valid = True
+        self.refresh_token = "refresh"
+        self.refreshed = 0
+
+    def refresh(self, request) -> None:
+        self.refreshed += 1
+        self.token = f"refreshed-{self.refreshed}"
+        self.valid = True
+
+
+@pytest.fixture
+def creds(monkeypatch, client):
+    creds = FakeCreds()
+    monkeypatch.setattr(
+        grin_client, "build_auth_header", lambda c: {"Authorization": f"Bearer {c.token}"}
+    )
+    monkeypatch.setattr(grin_client, "Request", lambda: None)
+    client.auth.creds = creds
+    return creds
+
+
+def test_expired_token_is_refreshed_on_a_pooled_client(client, server, creds):
+    client.grin_data("in_process")
+    creds.token, creds.valid = "second", False  # as google-auth leaves it on expiry
+    client.grin_data("in_process")
+    assert server.auth == ["Bearer first", "Bearer second"]
+    assert len(set(server.peers)) == 1
+
+
+def test_rejected_token_is_refreshed_and_the_request_retried(client, server, creds):
+    server.revoked.add("Bearer first")
+    assert client.grin_data("in_process")
+    assert server.auth == ["Bearer first", "Bearer refreshed-1"]
+    assert creds.refreshed == 1
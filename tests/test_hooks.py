@@ -0,0 +1,135 @@
+import asyncio
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from pipeline.instrumentation import FilterHook, TimingRecorder
+from pipeline.plumbing import AsyncFilter, Filter
+
+
+class Shell(Filter):
+    """Does its work in a child process, as the Decryptor runs gpg."""
+
+    def validate_token(self, token) -> bool:
+        return token.name != "bad"
+
+    def process_token(self, token) -> bool:
+        if token.name == "boom":
+            raise RuntimeError("lost connection")
+        subprocess.run([sys.executable, "-c", "sum(range(10**6))"], check=True)
+        return True
+
+
+class AsyncShell(AsyncFilter):
+    def validate_token(self, token) -> bool:
+        return True
+
+    async def process_token(self, token) -> bool:
+        await asyncio.sleep(0.01)
+        return True
+
+
+class Calls(FilterHook):
+    def __init__(self) -> None:
+        self.calls = []
+
+    def pre_take(self, filter, pipe):
+        self.calls.append(("pre_take",))
+
+    def post_take(self, filter, pipe, token):
+        self.calls.append(("post_take", token and token.name))
+
+    def post_validate(self, filter, pipe, token, valid):
+        self.calls.append(("post_validate", token.name, valid))
+
+    def post_process(self, filter, pipe, token, processed):
+        self.calls.append(("post_process", token.name, processed))
+
+    def post_put(self, filter, pipe, token):
+        self.calls.append(("post_put", token.name))
+
+
+@pytest.mark.parametrize(
+    "barcode, expected",
+    [
+        ("1", [("post_validate", "1", True), ("post_process", "1", True), ("post_put", "1")]),
+        ("bad", [("post_validate", "bad", False), ("post_put", "bad")]),
+        (
+            "boom",
+            [
+                ("post_validate", "boom", True),
+                ("post_process", "boom", False),
+                ("post_put", "boom"),
+            ],
+        ),
+    ],
+)
+def test_hooks_are_called_for_each_phase(barcode, expected, make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hook = Calls()
+        shell = Shell(make_pipe(tmpdir, [barcode], worker_id="w1"), hooks=[hook])
+        shell.run_once()
+        shell.run_once()
+        assert hook.calls == [("pre_take",), ("post_take", barcode), *expected] + [
+            ("pre_take",),
+            ("post_take", None),
+        ]
+
+
+def test_batches_call_hooks_per_token(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hook = Calls()
+        Shell(make_pipe(tmpdir, ["1", "2"], worker_id="w1"), hooks=[hook]).run_batch(2)
+        assert sorted(call for call in hook.calls if call[0] == "post_put") == [
+            ("post_put", "1"),
+            ("post_put", "2"),
+        ]
+
+
+def test_timing_recorder(monkeypatch, make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        timings = Path(tmpdir) / "timings.jsonl"
+        monkeypatch.setenv("TIMINGS", str(timings))
+        shell = Shell(make_pipe(tmpdir, ["1", "bad", "boom"], worker_id="w1"))
+        for _ in range(3):
+            shell.run_once()
+
+        records = {record["barcode"]: record for record in map(json.loads, timings.open())}
+        assert {barcode: record["outcome"] for barcode, record in records.items()} == {
+            "1": "success",
+            "bad": "rejected",
+            "boom": "error",
+        }
+        assert list(records["1"]["phases"]) == ["take", "validate", "process", "put"]
+        assert list(records["bad"]["phases"]) == ["take", "validate", "put"]
+        process = records["1"]["phases"]["process"]
+        assert process["child_cpu"] > 0
+        assert process["wall"] >= process["cpu"]
+        assert process["rss"] > 0
+        assert records["1"]["stage"] == "shell" and records["1"]["worker"] == "w1"
+
+
+def test_timing_recorder_with_async_filter(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        timings = Path(tmpdir) / "timings.jsonl"
+        filter = AsyncShell(
+            make_pipe(tmpdir, ["1"], worker_id="w1"), hooks=[TimingRecorder(timings)]
+        )
+        assert filter.run_once() is True
+        (record,) = map(json.loads, timings.open())
+        assert record["phases"]["process"]["wall"] >= 0.01
+
+
+def test_a_failing_hook_does_not_stop_the_filter(make_pipe):
+    class Broken(FilterHook):
+        def post_validate(self, filter, pipe, token, valid):
+            raise RuntimeError("oops")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1"], worker_id="w1")
+        Shell(pipe, hooks=[Broken()]).run_once()
+        assert (pipe.output / "1.json").exists()
@@ -0,0 +1,94 @@
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import DEFAULT_CODEC
+from pipeline.token_store import (
+    DirectoryTokenStore,
+    SqliteTokenStore,
+    default_worker_id,
+    owner_is_dead,
+)
+
+
+def make_store(tmpdir: str, backend: str):
+    if backend == "sqlite":
+        return SqliteTokenStore(Path(tmpdir) / "tokens.db")
+    return DirectoryTokenStore()
+
+
+def exited_worker_id() -> str:
+    """The worker id of a process on this host that has come and gone."""
+    child = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True
+    )
+    host_id = default_worker_id().rsplit("-", 1)[0]
+    return f"{host_id}-{child.stdout.strip()}"
+
+
+def test_owner_is_dead():
+    assert not owner_is_dead(default_worker_id())
+    assert not owner_is_dead(f"{default_worker_id()}-3")
+    assert owner_is_dead(exited_worker_id())
+    assert not owner_is_dead("elsewhere-1")
+    assert not owner_is_dead(None)
+
+
+@pytest.mark.parametrize("backend", ["directory", "sqlite"])
+def test_abandoned_claims_are_reclaimed(backend, make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # each worker is a separate process, with its own store
+        crashed = make_pipe(tmpdir, store=make_store(tmpdir, backend), worker_id="elsewhere-1")
+        dead = make_pipe(tmpdir, store=make_store(tmpdir, backend), worker_id=exited_worker_id())
+        live = make_pipe(tmpdir, store=make_store(tmpdir, backend), worker_id=default_worker_id())
+        for barcode in ["1", "2", "3"]:
+            live.store.add(live.input, barcode, DEFAULT_CODEC.encode({"barcode": barcode}))
+        crashed.take_token("1")
+        dead.take_token("2")
+        live.take_token("3")
+
+        # the claim held by a process that has exited is returned at once
+        assert live.reclaim(60) == 1
+        assert live.store.counts(live.input)["waiting_tokens"] == 1
+
+        # the remote worker's claim is returned once its lease runs out,
+        # but the claim this process holds is not
+        time.sleep(0.1)
+        live.store.renew()
+        assert live.reclaim(0.05) == 1
+        assert sorted(live.list_input_barcodes()) == ["1", "2"]
+        live.put_token()
+        assert live.store.counts(live.output)["waiting_tokens"] == 1
+
+
+def test_renewal_keeps_a_claim(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, store=DirectoryTokenStore(), worker_id="w1")
+        pipe.store.add(pipe.input, "1", DEFAULT_CODEC.encode({"barcode": "1"}))
+        pipe.take_token()
+        claim = pipe.input / "1.w1.bak"
+        os.utime(claim, (0, 0))
+        pipe.store.renew()
+        assert DirectoryTokenStore().reclaim(pipe.input, 60) == 0
+        assert claim.exists()
+
+
+@pytest.mark.parametrize("backend", ["directory", "sqlite"])
+def test_lost_claim_is_not_fatal(backend, caplog, make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, store=make_store(tmpdir, backend), worker_id="w1")
+        pipe.store.add(pipe.input, "1", DEFAULT_CODEC.encode({"barcode": "1"}))
+        pipe.take_token()
+        time.sleep(0.1)
+        assert make_store(tmpdir, backend).reclaim(pipe.input, 0.05) == 1
+
+        with caplog.at_level(logging.WARNING):
+            pipe.put_token()
+        assert "processed twice" in caplog.text
+        assert pipe.store.load(pipe.output, "1") == {"barcode": "1"}
@@ -0,0 +1,79 @@
+import tempfile
+import time
+from pathlib import Path
+
+from pipeline.metrics import FilterMetrics, Histogram, Registry
+from pipeline.plumbing import Filter, Pipe, Token, dump_token
+
+
+class Sleepy(Filter):
+    """Takes a little time over each token, and fails the odd ones."""
+
+    def validate_token(self, token) -> bool:
+        return token.name != "bad"
+
+    def process_token(self, token) -> bool:
+        time.sleep(0.02)
+        return int(token.name) % 2 == 0
+
+
+def test_histogram():
+    histogram = Histogram("latency_seconds", "How long", buckets=(0.1, 1))
+    for value in [0.05, 0.5, 0.5, 5]:
+        histogram.observe(value, stage="s")
+    assert histogram.count(stage="s") == 4
+    assert histogram.quantile(0.5, stage="s") == 1
+    assert histogram.quantile(0.99, stage="s") == float("inf")
+    assert histogram.render().splitlines() == [
+        "# HELP latency_seconds How long",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1",stage="s"} 1',
+        'latency_seconds_bucket{le="1",stage="s"} 3',
+        'latency_seconds_bucket{le="+Inf",stage="s"} 4',
+        'latency_seconds_sum{stage="s"} 6.05',
+        'latency_seconds_count{stage="s"} 4',
+    ]
+
+
+def test_registry_shares_metrics_by_name():
+    registry = Registry()
+    registry.counter("tokens_total", "Tokens").inc(outcome="success")
+    registry.counter("tokens_total", "Tokens").inc(2, outcome="success")
+    assert registry.counter("tokens_total", "Tokens").value(outcome="success") == 3
+    assert 'tokens_total{outcome="success"} 3' in registry.render()
+
+
+def test_filter_metrics(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        for barcode in ["1", "2", "4", "bad"]:
+            dump_token(Token({"barcode": barcode}), pipe_in / f"{barcode}.json")
+        sleepy = Sleepy(Pipe(pipe_in, pipe_out, worker_id="w1"))
+        metrics = sleepy.metrics = FilterMetrics("sleepy", "w1", Registry())
+        for _ in range(4):
+            sleepy.run_once()
+
+        labels = {"stage": "sleepy", "worker": "w1"}
+        assert metrics.tokens.value(outcome="success", **labels) == 2
+        assert metrics.tokens.value(outcome="error", **labels) == 1
+        assert metrics.tokens.value(outcome="rejected", **labels) == 1
+        assert metrics.processing.count(**labels) == 3
+        assert metrics.processing.quantile(0.5, **labels) == 0.05
+        assert metrics.queue_wait.count(**labels) == 4
+
+        # run_forever exports them for a collector to read
+        monkeypatch.setenv("METRICS_DIR", str(Path(tmpdir) / "metrics"))
+        monkeypatch.setenv("METRICS_INTERVAL", "60")
+        sleepy.keep_metrics()
+        sleepy.stop()
+        exported = Path(tmpdir) / "metrics" / "sleepy-w1.prom"
+        for _ in range(100):
+            if exported.exists():
+                break
+            time.sleep(0.01)
+        text = exported.read_text()
+        assert 'grin_tokens_total{outcome="success",stage="sleepy",worker="w1"} 2' in text
+        assert 'grin_bucket_tokens{stage="sleepy",state="errored",worker="w1"} 2' in text
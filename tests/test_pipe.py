@@ -98,3 +98,11 @@ def test_put_token_with_errorFlg(test_pipe):
     out_files = list(dummy_in.glob("*.err"))
     error_filename = Path(f"{dummy_in}/{barcode}.err")
     assert error_filename in out_files
+
+
+def test_list_input(test_pipe):
+    reset_test_dirs()
+    dump_token(Token({"barcode": "87654321"}), dummy_in / "87654321.json")
+    (dummy_in / "87654321.json").rename(dummy_in / "87654321.bak")
+    assert list(test_pipe.list_input_barcodes()) == [barcode]
+    assert [token.name for token in test_pipe.list_input_tokens()] == [barcode]
@@ -0,0 +1,89 @@
+import json
+import multiprocessing
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import Pipe, Token, default_worker_id, dump_token
+
+NUM_TOKENS = 300
+NUM_WORKERS = 8
+
+
+def claimer(in_path: Path, out_path: Path, worker_id: str, log_path: Path):
+    """Take tokens until the bucket is empty, recording each barcode taken."""
+    pipe = Pipe(in_path, out_path, worker_id=worker_id)
+    taken = []
+    while (token := pipe.take_token()) is not None:
+        taken.append(token.name)
+        token.write_log(f"taken by {worker_id}")
+        pipe.put_token()
+    log_path.write_text(json.dumps(taken))
+
+
+def test_claim_file_carries_worker_id():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        dump_token(Token({"barcode": "1234"}), pipe_in / "1234.json")
+
+        pipe = Pipe(pipe_in, pipe_out, worker_id="w1")
+        pipe.take_token()
+        assert [f.name for f in pipe_in.iterdir()] == ["1234.w1.bak"]
+        pipe.put_token()
+        assert list(pipe_in.iterdir()) == []
+        assert (pipe_out / "1234.json").exists()
+
+
+def test_bad_worker_id():
+    with pytest.raises(ValueError):
+        Pipe(Path("/tmp"), Path("/tmp"), worker_id="host.example.edu")
+    assert "." not in default_worker_id()
+
+
+def test_claim_lost_to_another_worker():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        dump_token(Token({"barcode": "1234"}), pipe_in / "1234.json")
+
+        first = Pipe(pipe_in, pipe_out, worker_id="w1")
+        second = Pipe(pipe_in, pipe_out, worker_id="w2")
+        assert first.claim(pipe_in / "1234.json") is not None
+        assert second.claim(pipe_in / "1234.json") is None
+        assert second.take_token("1234") is None
+
+
+def test_concurrent_claimers():
+    ctx = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        barcodes = {f"{n:08d}" for n in range(NUM_TOKENS)}
+        for barcode in barcodes:
+            dump_token(Token({"barcode": barcode}), pipe_in / f"{barcode}.json")
+
+        logs = [Path(tmpdir) / f"worker{i}.log" for i in range(NUM_WORKERS)]
+        procs = [
+            ctx.Process(target=claimer, args=(pipe_in, pipe_out, f"w{i}", logs[i]))
+            for i in range(NUM_WORKERS)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        assert all(p.exitcode == 0 for p in procs)
+        taken = [barcode for log in logs for barcode in json.loads(log.read_text())]
+        # every token was processed exactly once
+        assert len(taken) == NUM_TOKENS
+        assert set(taken) == barcodes
+        assert list(pipe_in.iterdir()) == []
+        assert {f.stem for f in pipe_out.glob("*.json")} == barcodes
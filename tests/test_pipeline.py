@@ -1,3 +1,5 @@
+import os
+import tempfile
 from pathlib import Path
 import pytest
 from pipeline.plumbing import Pipeline
@@ -37,3 +39,55 @@ def test_getting_pipe(shared_datadir):
 
     assert test_pipe.input == start_path
     assert test_pipe.output == requested_path
+
+
+def test_snapshot_and_summary():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket = Path(tmpdir)
+        for name in ["1.json", "2.json", "3.err", "4.w1.bak", ".5.json.1-2.tmp"]:
+            (bucket / name).touch()
+
+        pipeline = Pipeline({})
+        pipeline.add_bucket("start", bucket)
+
+        snapshot = pipeline.snapshot["start"]
+        assert sorted(snapshot["waiting_tokens"]) == ["1.json", "2.json"]
+        assert snapshot["errored_tokens"] == ["3.err"]
+        assert snapshot["in_process_tokens"] == ["4.w1.bak"]
+        assert pipeline.summary["start"] == {
+            "waiting_tokens": 2,
+            "errored_tokens": 1,
+            "in_process_tokens": 1,
+        }
+
+
+def test_scans_are_cached_on_mtime(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket = Path(tmpdir)
+        (bucket / "1.json").touch()
+        os.utime(bucket, (1_000_000, 1_000_000))
+
+        pipeline = Pipeline({})
+        pipeline.add_bucket("start", bucket)
+
+        scans = []
+        real_scandir = os.scandir
+
+        def counting_scandir(path):
+            scans.append(path)
+            return real_scandir(path)
+
+        monkeypatch.setattr(os, "scandir", counting_scandir)
+        assert pipeline.summary["start"]["waiting_tokens"] == 1
+        assert pipeline.summary["start"]["waiting_tokens"] == 1
+        assert len(scans) == 1
+
+        (bucket / "2.json").touch()
+        assert pipeline.summary["start"]["waiting_tokens"] == 2
+        assert len(scans) == 2
+
+
+def test_missing_bucket():
+    pipeline = Pipeline({})
+    pipeline.add_bucket("nowhere", Path("/nonexistent/bucket"))
+    assert pipeline.summary["nowhere"]["waiting_tokens"] == 0
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import httpx
+import pytest
+
+from clients import ranged_download
+from clients.digests import Digests
+from clients.ranged_download import RangedDownload
+
+BOOK = bytes(range(256)) * 400  # 102400 bytes
+
+
+class BookServer(ThreadingHTTPServer):
+    """Serves BOOK at any path, honouring Range and If-Range like GRIN's CDN."""
+
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), BookHandler)
+        self.book = BOOK
+        self.etag = '"v1"'
+        self.ranges = True
+        self.drop_after: int | None = None  # bytes to send before hanging up, once
+        self.requests: list[str | None] = []
+        self.if_ranges: list[str | None] = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/book.tar.gz.gpg"
+
+
+class BookHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        server: BookServer = self.server
+        book = server.book
+        requested = self.headers.get("Range")
+        server.requests.append(requested)
+        if_range = self.headers.get("If-Range")
+        server.if_ranges.append(if_range)
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", requested or "")
+        if match and server.ranges and if_range in (None, server.etag):
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else len(book)
+            if start >= len(book):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(book)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(book)}")
+        else:
+            start, end = 0, len(book)
+            self.send_response(200)
+        if server.etag:
+            self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        body = book[start:end]
+        if server.drop_after is not None and len(body) > server.drop_after:
+            body, server.drop_after = body[: server.drop_after], None
+            self.wfile.write(body)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = BookServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(ranged_download, "CHUNK_SIZE", 1024)
+    monkeypatch.setattr(ranged_download, "SAVE_EVERY", 4)
+    monkeypatch.setattr(ranged_download, "MIN_PART_SIZE", 10_000)
+
+
+def download(server: BookServer, outpath: Path, parts: int = 1) -> Path:
+    with httpx.Client() as client:
+        return RangedDownload(server.url, outpath, parts).run(client)
+
+
+def test_download_in_one_stream(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        assert download(server, outpath) == outpath
+        assert outpath.read_bytes() == BOOK
+        assert sorted(p.name for p in Path(tmpdir).iterdir()) == ["book.tar.gz.gpg"]
+        assert server.requests == [None]
+
+
+def test_resume_after_a_dropped_connection(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        server.drop_after = 60000
+        with pytest.raises(httpx.HTTPError):
+            download(server, outpath)
+        assert not outpath.exists()
+        kept = Path(f"{outpath}.part").stat().st_size
+        assert 50000 < kept <= 60000
+
+        download(server, outpath)
+        assert outpath.read_bytes() == BOOK
+        assert server.requests[-1] == f"bytes={kept}-"
+
+
+def test_start_again_if_the_book_changed(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        server.drop_after = 60000
+        with pytest.raises(httpx.HTTPError):
+            download(server, outpath)
+        server.book, server.etag = BOOK[::-1], '"v2"'
+        download(server, outpath)
+        assert outpath.read_bytes() == BOOK[::-1]
+
+
+def test_start_again_if_ranges_are_ignored(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        Path(f"{outpath}.part").write_bytes(BOOK[:5000])
+        server.ranges = False
+        download(server, outpath, parts=4)
+        assert outpath.read_bytes() == BOOK
+
+
+def test_parallel_ranges(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        download(server, outpath, parts=4)
+        assert outpath.read_bytes() == BOOK
+        assert sorted(server.requests[1:]) == [
+            "bytes=0-25599",
+            "bytes=25600-51199",
+            "bytes=51200-76799",
+            "bytes=76800-102399",
+        ]
+
+
+def test_resume_parallel_ranges(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        server.drop_after = 10000
+        with pytest.raises(httpx.HTTPError):
+            download(server, outpath, parts=4)
+        progress = json.loads(Path(f"{outpath}.part.json").read_text())
+        unfinished = [r for r in progress["ranges"] if r[2] < r[1]]
+        assert len(unfinished) == 1 and unfinished[0][2] > unfinished[0][0]
+
+        server.requests.clear()
+        download(server, outpath, parts=4)
+        assert outpath.read_bytes() == BOOK
+        # one request to check the book is unchanged, one for the rest of the range
+        start, end, position = unfinished[0]
+        assert server.requests == ["bytes=0-0", f"bytes={position}-{end - 1}"]
+
+
+def test_resume_parallel_ranges_without_a_validator(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        server.etag = None
+        server.drop_after = 10000
+        with pytest.raises(httpx.HTTPError):
+            download(server, outpath, parts=4)
+
+        server.requests.clear()
+        server.if_ranges.clear()
+        download(server, outpath, parts=4)
+        assert outpath.read_bytes() == BOOK
+        assert server.requests[0] == "bytes=0-0"
+        assert server.if_ranges == [None, None]
+
+
+def test_async_download_resumes(server):
+    async def adownload(outpath: Path) -> Path:
+        async with httpx.AsyncClient() as client:
+            return await RangedDownload(server.url, outpath).astream(client)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        Path(f"{outpath}.part").write_bytes(BOOK[:5000])
+        asyncio.run(adownload(outpath))
+        assert outpath.read_bytes() == BOOK
+        assert server.requests == ["bytes=5000-"]
+
+
+def test_digests_of_a_resumed_download(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = Path(tmpdir) / "book.tar.gz.gpg"
+        Path(f"{outpath}.part").write_bytes(BOOK[:5000])
+        with httpx.Client() as client:
+            download = RangedDownload(server.url, outpath)
+            download.run(client)
+        assert download.digests.hexdigests() == Digests.of_file(outpath).hexdigests()
+        assert download.digests.size == len(BOOK)
+
+
+def test_download_draws_from_the_bandwidth_budget(server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bandwidth = MagicMock()
+        with httpx.Client() as client:
+            RangedDownload(server.url, Path(tmpdir) / "book", bandwidth=bandwidth).run(client)
+        assert sum(call.args[0] for call in bandwidth.take.call_args_list) == len(BOOK)
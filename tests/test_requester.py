@@ -1,8 +1,15 @@
 import tempfile
 from pathlib import Path
+from urllib.parse import parse_qs
 
+import httpx
+import pytest
+
+from clients import grin_client
+from clients.grin_client import GrinClient
+from pipeline.filters import requester as requester_module
 from pipeline.filters.requester import Requester
-from pipeline.plumbing import Pipe, Token, dump_token
+from pipeline.plumbing import Pipe, Token, dump_token, load_token
 
 # def test_request_success():
 #     with tempfile.TemporaryDirectory() as tmpdir:
@@ -49,3 +56,65 @@ def test_request_failure():
         assert len(list(pipe.input.glob("*.json"))) == 0
         assert len(list(pipe.input.glob("*.err"))) == 1
         assert len(list(pipe.output.glob("*.*"))) == 0
+
+
+@pytest.fixture
+def grin(monkeypatch):
+    """A GrinClient whose bulk _process requests are answered by grin.respond."""
+    monkeypatch.setenv("GOOGLE_SECRETS_FILE", "secrets")
+    monkeypatch.setenv("GOOGLE_TOKEN_FILE", "token")
+    monkeypatch.setattr(grin_client, "load_creds_or_die", lambda secrets, token: None)
+    client = GrinClient()
+    client.requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        client.requests.append(request)
+        return client.respond(parse_qs(request.content.decode())["barcodes"])
+
+    client._http = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(requester_module, "shared_grin_client", lambda: client)
+    yield client
+    client.close()
+
+
+def statuses(rows: dict) -> httpx.Response:
+    lines = ["Barcode\tStatus"] + [f"{barcode}\t{status}" for barcode, status in rows.items()]
+    return httpx.Response(200, text="\n".join(lines) + "\n")
+
+
+def test_process_batch(grin, make_pipe):
+    grin.respond = lambda barcodes: statuses({b: "Success" for b in barcodes})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1", "2", "3"])
+        assert Requester(pipe).run_batch(10) is True
+
+        assert len(grin.requests) == 1
+        assert grin.requests[0].url.path.endswith("/_process")
+        assert not grin.requests[0].url.query
+        assert {f.stem for f in pipe.output.glob("*.json")} == {"1", "2", "3"}
+        assert load_token(pipe.output / "1.json").get_prop("when_requested")
+
+
+def test_process_batch_with_missing_and_refused_statuses(grin, make_pipe):
+    grin.respond = lambda barcodes: statuses({"1": "Success", "2": Requester.ERRORS.NOTALLOWED})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1", "2", "3"])
+        Requester(pipe).run_batch(10)
+
+        assert {f.stem for f in pipe.output.glob("*.json")} == {"1"}
+        assert {f.stem for f in pipe.input.glob("*.err")} == {"2", "3"}
+        log = load_token(pipe.input / "3.err").content["log"]
+        assert log[0]["message"] == "No status returned by GRIN"
+
+
+def test_process_batch_server_error(grin, make_pipe):
+    grin.respond = lambda barcodes: httpx.Response(503, text="try later")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, ["1", "2"])
+        assert Requester(pipe).run_batch(10) is False
+
+        assert list(pipe.output.iterdir()) == []
+        for barcode in ["1", "2"]:
+            last_error = load_token(pipe.input / f"{barcode}.err").content["last_error"]
+            assert last_error["type"] == "HTTPStatusError"
+            assert last_error["transient"] is True
@@ -0,0 +1,140 @@
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import Filter, Pipe, Token, dump_token, load_token
+from pipeline.retry import RetryPolicy, RetryScheduler, is_retryable, is_transient
+from pipeline.token_store import SqliteTokenStore
+
+
+class Flaky(Filter):
+    """Fails with the given error until told to succeed."""
+
+    def __init__(self, pipe: Pipe, error: Exception) -> None:
+        super().__init__(pipe, retry=RetryPolicy(attempts=2, base_delay=0))
+        self.error: Exception | None = error
+
+    def validate_token(self, token) -> bool:
+        return True
+
+    def process_token(self, token) -> bool:
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int) -> None:
+        super().__init__(f"status {status}")
+        self.response = type("Response", (), {"status_code": status})()
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (TimeoutError("read timed out"), True),
+        (ConnectionResetError(), True),
+        (HTTPError(503), True),
+        (HTTPError(404), False),
+        (RuntimeError("GET https://books.google.com/x -> 502\n"), True),
+        (RuntimeError("GET https://books.google.com/x -> 403\n"), False),
+        (ValueError("no such book"), False),
+        ("An error occurred (SlowDown) when calling PutObject", True),
+    ],
+)
+def test_is_transient(error, expected):
+    assert is_transient(error) is expected
+
+
+def test_old_errors_are_judged_by_the_log():
+    log = [{"level": "ERROR", "message": "in downloader: GET x -> 500"}]
+    assert is_retryable({"barcode": "1", "log": log})
+    assert not is_retryable({"barcode": "1"})
+
+
+def test_backoff_grows_and_is_capped():
+    policy = RetryPolicy(attempts=10, base_delay=10, max_delay=100)
+    for attempt in range(10):
+        assert 0 <= policy.delay("1", attempt) <= min(100, 10 * 2**attempt)
+    assert policy.delay("1", 3) == policy.delay("1", 3)
+    assert policy.delay("1", 3) != policy.delay("2", 3)
+
+
+def test_transient_failures_are_retried_then_dead_lettered(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir)
+        dead_letter = Path(tmpdir) / "dead_letter"
+        dead_letter.mkdir()
+        flaky = Flaky(pipe, TimeoutError("read timed out"))
+        flaky.retry.dead_letter = dead_letter
+        scheduler = RetryScheduler(pipe, flaky.retry)
+        dump_token(Token({"barcode": "1"}), pipe.input / "1.json")
+
+        for attempt in [1, 2]:
+            flaky.run_once()
+            assert scheduler.run_once() == 1
+            assert load_token(pipe.input / "1.json").get_prop("retry_attempts") == attempt
+
+        flaky.run_once()
+        assert scheduler.run_once() == 1
+        token = load_token(dead_letter / "1.err")
+        assert token.get_prop("dead_letter_from") == str(pipe.input)
+        assert token.get_prop("last_error")["type"] == "TimeoutError"
+
+
+def test_success_clears_the_retry_record(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir)
+        flaky = Flaky(pipe, HTTPError(503))
+        scheduler = RetryScheduler(pipe, flaky.retry)
+        dump_token(Token({"barcode": "1"}), pipe.input / "1.json")
+
+        flaky.run_once()
+        scheduler.run_once()
+        flaky.error = None
+        flaky.run_once()
+        token = load_token(pipe.output / "1.json")
+        assert token.get_prop("retry_attempts") is None
+        assert token.get_prop("last_error") is None
+
+
+def test_permanent_failures_stay_put(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SqliteTokenStore(Path(tmpdir) / "tokens.db")
+        pipe = make_pipe(tmpdir, store=store)
+        flaky = Flaky(pipe, ValueError("no such book"))
+        store.add(pipe.input, "1", b'{"barcode": "1"}')
+
+        flaky.run_once()
+        assert RetryScheduler(pipe, flaky.retry).run_once() == 0
+        assert list(pipe.list_errored_barcodes()) == ["1"]
+
+
+def test_retries_wait_for_the_backoff(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir)
+        flaky = Flaky(pipe, TimeoutError())
+        dump_token(Token({"barcode": "1"}), pipe.input / "1.json")
+        flaky.run_once()
+
+        policy = RetryPolicy(attempts=2, base_delay=3600)
+        assert RetryScheduler(pipe, policy).run_once() == 0
+        assert (pipe.input / "1.err").exists()
+
+
+def test_batch_failures_are_retried(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir)
+        flaky = Flaky(pipe, TimeoutError("read timed out"))
+        dump_token(Token({"barcode": "1"}), pipe.input / "1.json")
+
+        flaky.run_batch()
+        error = load_token(pipe.input / "1.err").get_prop("last_error")
+        assert error["type"] == "TimeoutError"
+        assert error["transient"] is True
+
+        assert RetryScheduler(pipe, flaky.retry).run_once() == 1
+        token = load_token(pipe.input / "1.json")
+        assert token.get_prop("retry_attempts") == 1
+        assert token.get_prop("last_error") is None
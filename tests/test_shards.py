@@ -0,0 +1,96 @@
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import Pipe, Pipeline, Token, load_token
+from pipeline.token_bag import TokenBag
+from pipeline.token_store import shard_path
+from pipeline.watcher import make_watcher
+from utils.shard_buckets import reshard
+
+BARCODES = [f"3210107{n:07d}" for n in range(50)]
+
+
+def sharded_buckets(tmpdir: str, levels: int = 2) -> tuple[Path, Path]:
+    pipe_in = Path(tmpdir) / "in"
+    pipe_out = Path(tmpdir) / "out"
+    for bucket in [pipe_in, pipe_out]:
+        bucket.mkdir()
+        reshard(bucket, levels)
+    return pipe_in, pipe_out
+
+
+def test_shard_path():
+    assert shard_path("1234", 0) == Path(".")
+    assert len(shard_path("1234", 2).parts) == 2
+    assert shard_path("1234", 2).parts[0] == shard_path("1234", 1).name
+
+
+def test_tokens_flow_through_shards():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in, pipe_out = sharded_buckets(tmpdir)
+        bag = TokenBag()
+        bag.add_books(BARCODES)
+        bag.pour_into(pipe_in)
+
+        token_path = pipe_in / shard_path(BARCODES[0], 2) / f"{BARCODES[0]}.json"
+        assert load_token(token_path).name == BARCODES[0]
+        assert sorted(Pipe(pipe_in, pipe_out).list_input_barcodes()) == BARCODES
+
+        pipe = Pipe(pipe_in, pipe_out, worker_id="w1")
+        taken = pipe.take_tokens(10)
+        for token in taken:
+            pipe.put_token(token=token)
+        pipe.take_token(BARCODES[-1])
+        pipe.put_token(errorFlg=True)
+
+        pipeline = Pipeline({})
+        pipeline.add_bucket("in", pipe_in)
+        pipeline.add_bucket("out", pipe_out)
+        assert pipeline.summary == {
+            "in": {"waiting_tokens": 39, "errored_tokens": 1, "in_process_tokens": 0},
+            "out": {"waiting_tokens": 10, "errored_tokens": 0, "in_process_tokens": 0},
+        }
+        assert f"{BARCODES[-1]}.err" in pipeline.snapshot["in"]["errored_tokens"]
+
+
+def test_reshard_round_trip():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket = Path(tmpdir)
+        bag = TokenBag()
+        bag.add_books(BARCODES)
+        bag.pour_into(bucket)
+        (bucket / f"{BARCODES[0]}.json").rename(bucket / f"{BARCODES[0]}.err")
+
+        assert reshard(bucket, 1) == len(BARCODES)
+        assert not list(bucket.glob("*.json"))
+        assert reshard(bucket, 1) == 0
+        assert reshard(bucket, 0) == len(BARCODES)
+        assert sorted(f.name for f in bucket.iterdir()) == sorted(
+            [f"{BARCODES[0]}.err"] + [f"{barcode}.json" for barcode in BARCODES[1:]]
+        )
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux-only")
+def test_watcher_sees_tokens_land_in_shards():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in, pipe_out = sharded_buckets(tmpdir)
+        watcher = make_watcher(pipe_out, "inotify")
+
+        def put_later():
+            time.sleep(0.1)
+            bag = TokenBag()
+            bag.put_token(Token({"barcode": "1234"}))
+            bag.pour_into(pipe_out)
+
+        writer = threading.Thread(target=put_later)
+        writer.start()
+        try:
+            assert watcher.wait(5) is True
+        finally:
+            writer.join()
+            watcher.close()
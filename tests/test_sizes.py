@@ -0,0 +1,16 @@
+import pytest
+
+from utils.sizes import parse_size
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [(1024, 1024), ("2048", 2048), ("50G", 50 * 1024**3), ("1.5 MB", 1572864), ("1KiB", 1024)],
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_parse_size_rejects_nonsense():
+    with pytest.raises(ValueError):
+        parse_size("lots")
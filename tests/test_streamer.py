@@ -0,0 +1,112 @@
+import contextlib
+import random
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+
+from pipeline.filters.streamer import Streamer
+from pipeline.plumbing import Pipe, Token, dump_token, load_token
+
+pytestmark = pytest.mark.skipif(shutil.which("gpg") is None, reason="needs gpg")
+
+BOOK = random.Random(0).randbytes(300_000)  # incompressible, like a tarball of images
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, drop_at: int | None = None) -> None:
+        self.body = body
+        self.drop_at = drop_at
+
+    def iter_bytes(self, chunk_size: int):
+        for start in range(0, len(self.body), 4096):
+            if self.drop_at is not None and start >= self.drop_at:
+                raise ConnectionResetError("connection reset by peer")
+            yield self.body[start : start + 4096]
+
+
+class FakeGrin:
+    def __init__(self, body: bytes, drop_at: int | None = None) -> None:
+        self.response = FakeResponse(body, drop_at)
+
+    @contextlib.contextmanager
+    def stream_book(self, barcode):
+        yield self.response
+
+
+def encrypt(data: bytes, passphrase: str) -> bytes:
+    return subprocess.run(
+        ["gpg", "--batch", "--yes", "--passphrase", passphrase, "--symmetric"],
+        input=data,
+        capture_output=True,
+        check=True,
+    ).stdout
+
+
+def fake_s3(exists: bool = False) -> MagicMock:
+    """An S3 client that reads the stream as upload_fileobj would."""
+    s3 = MagicMock()
+    s3.object_exists.return_value = exists
+    s3.stored = {}
+
+    def store_stream(stream, key, part_size, parts_in_memory):
+        parts = []
+        while part := stream.read(part_size):
+            parts.append(part)
+        s3.stored[key] = b"".join(parts)
+        return True
+
+    s3.store_stream.side_effect = store_stream
+    return s3
+
+
+@pytest.fixture
+def pipe(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        monkeypatch.setenv("GNUPGHOME", tmpdir)
+        monkeypatch.setenv("DECRYPTION_PASSPHRASE", "phrase")
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        dump_token(Token({"barcode": "1234567"}), pipe_in / "1234567.json")
+        yield Pipe(pipe_in, pipe_out)
+
+
+def test_book_is_streamed_into_s3(pipe):
+    s3 = fake_s3()
+    streamer = Streamer(pipe, s3, FakeGrin(encrypt(BOOK, "phrase")), part_size=64 * 1024)
+    assert streamer.run_once()
+    assert s3.stored["1234567"] == BOOK
+    token = load_token(pipe.output / "1234567.json")
+    assert token.get_prop("upload_status") == "success"
+    assert token.get_prop("decryption_status") == "success"
+
+
+def test_wrong_passphrase_stores_nothing(pipe):
+    s3 = fake_s3()
+    streamer = Streamer(pipe, s3, FakeGrin(encrypt(BOOK, "another phrase")))
+    assert streamer.run_once() is False
+    assert s3.stored == {}
+    assert "gpg exited" in load_token(pipe.input / "1234567.err").get_prop("last_error")["message"]
+
+
+def test_broken_download_stores_nothing(pipe):
+    s3 = fake_s3()
+    encrypted = encrypt(BOOK, "phrase")
+    streamer = Streamer(pipe, s3, FakeGrin(encrypted, drop_at=len(encrypted) // 2))
+    assert streamer.run_once() is False
+    assert s3.stored == {}
+    error = load_token(pipe.input / "1234567.err").get_prop("last_error")
+    assert error["transient"] is True
+
+
+def test_stored_books_are_not_streamed_again(pipe):
+    s3 = fake_s3(exists=True)
+    grin = MagicMock()
+    Streamer(pipe, s3, grin).run_once()
+    grin.stream_book.assert_not_called()
+    assert load_token(pipe.output / "1234567.json").get_prop("upload_status") == "duplicate"
@@ -0,0 +1,71 @@
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from pipeline import token_codecs
+from pipeline.plumbing import Pipe, Pipeline, Token, dump_token, load_token
+from pipeline.token_bag import TokenBag
+
+CONTENT = {
+    "barcode": "1234",
+    "log": [{"message": f"step {n}", "level": "INFO", "stage": "test"} for n in range(3)],
+}
+
+
+@pytest.mark.parametrize("name", ["json", "compact", "orjson", "msgpack"])
+def test_round_trip(name):
+    if name in ("orjson", "msgpack"):
+        pytest.importorskip(name)
+    codec = token_codecs.get_codec(name)
+    data = codec.encode(CONTENT)
+    assert codec.decode(data) == CONTENT
+    assert token_codecs.decode(data) == CONTENT
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        destination = Path(tmpdir) / "1234.json"
+        dump_token(Token(CONTENT), destination, codec=codec)
+        assert load_token(destination).content == CONTENT
+
+
+def test_compact_is_smaller():
+    indented = token_codecs.get_codec("json").encode(CONTENT)
+    compact = token_codecs.get_codec("compact").encode(CONTENT)
+    assert len(compact) < len(indented)
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        token_codecs.get_codec("xml")
+
+
+def test_pipe_writes_with_its_codec(monkeypatch):
+    monkeypatch.setenv("TOKEN_CODEC", "compact")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe_in = Path(tmpdir) / "in"
+        pipe_out = Path(tmpdir) / "out"
+        pipe_in.mkdir()
+        pipe_out.mkdir()
+        # an old, indented token is still readable
+        dump_token(Token({"barcode": "1234"}), pipe_in / "1234.json")
+
+        pipe = Pipe(pipe_in, pipe_out)
+        assert pipe.codec.name == "compact"
+        pipe.take_token()
+        pipe.put_token()
+        assert (pipe_out / "1234.json").read_bytes() == b'{"barcode":"1234"}'
+
+
+def test_poured_tokens_use_the_configured_codec(monkeypatch):
+    monkeypatch.setenv("TOKEN_CODEC", "compact")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bag = TokenBag(Path(tmpdir) / "bag")
+        bag.add_book("1234")
+        bag.pour_into(Path(tmpdir))
+        assert (Path(tmpdir) / "1234.json").read_bytes().startswith(b'{"barcode":"1234"')
+
+
+def test_pipeline_codec_comes_from_the_configuration():
+    pipeline = Pipeline({"global": {"token_codec": "compact"}, "buckets": []})
+    assert pipeline.codec.name == "compact"
+    assert Pipeline({}).codec.name == "json"
@@ -0,0 +1,65 @@
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import Pipe, Token, dump_token, load_token
+from pipeline.token_log import BucketLog, SidecarLog, open_token_log
+from pipeline.token_log_viewer import merge_log
+
+
+def run_stages(tmpdir: str, token_log) -> Path:
+    """Move a token through two stages, logging in each; return the last bucket."""
+    buckets = [Path(tmpdir) / name for name in ["start", "middle", "end"]]
+    for bucket in buckets:
+        bucket.mkdir()
+    dump_token(Token({"barcode": "1234"}), buckets[0] / "1234.json")
+
+    for n, (in_bucket, out_bucket) in enumerate(zip(buckets, buckets[1:])):
+        pipe = Pipe(in_bucket, out_bucket, token_log=token_log)
+        token = pipe.take_token()
+        token.write_log(f"stage {n}", "INFO", f"stage{n}")
+        pipe.put_token()
+    return buckets[-1]
+
+
+@pytest.mark.parametrize("mode", ["sidecar", "bucket"])
+def test_log_moves_out_of_token(mode):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        token_log = open_token_log(Path(tmpdir) / "logs", mode)
+        end = run_stages(tmpdir, token_log)
+
+        token = load_token(end / "1234.json")
+        assert "log" not in token.content
+        messages = [entry["message"] for entry in token_log.entries("1234")]
+        assert messages == ["stage 0", "stage 1"]
+
+        merged = merge_log(token.content, Path(tmpdir) / "logs", mode)
+        assert [entry["message"] for entry in merged["log"]] == ["stage 0", "stage 1"]
+
+
+def test_log_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sidecar = SidecarLog(Path(tmpdir) / "sidecar")
+        run_stages(tmpdir, sidecar)
+        assert [f.name for f in sidecar.directory.iterdir()] == ["1234.jsonl"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shared = BucketLog(Path(tmpdir) / "shared")
+        run_stages(tmpdir, shared)
+        assert sorted(f.name for f in shared.directory.iterdir()) == [
+            "middle.jsonl",
+            "start.jsonl",
+        ]
+
+
+def test_without_token_log():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        end = run_stages(tmpdir, None)
+        token = load_token(end / "1234.json")
+        assert [entry["message"] for entry in token.content["log"]] == ["stage 0", "stage 1"]
+        assert merge_log(token.content) == token.content
+        assert open_token_log(None) is None
+
+    with pytest.raises(ValueError):
+        open_token_log("/tmp", "carbon-copy")
@@ -0,0 +1,134 @@
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import Pipe, Token, dump_token
+from pipeline.token_bag import TokenBag
+from pipeline.token_store import DirectoryTokenStore, SqliteTokenStore, TokenQueue
+
+# barcode -> (priority, age in seconds)
+TOKENS = {"a": (0, 30), "b": (5, 10), "c": (0, 40), "d": (5, 20)}
+
+
+def fill(bucket: Path) -> None:
+    now = os.stat(bucket).st_mtime
+    for barcode, (priority, age) in TOKENS.items():
+        path = bucket / f"{barcode}.json"
+        dump_token(Token({"barcode": barcode, "priority": priority}), path)
+        os.utime(path, (now - age, now - age))
+
+
+def drain(pipe: Pipe) -> list[str]:
+    taken = []
+    while (token := pipe.take_token()) is not None:
+        taken.append(token.name)
+        pipe.put_token()
+    return taken
+
+
+@pytest.mark.parametrize(
+    "order, expected", [("fifo", ["c", "a", "d", "b"]), ("priority", ["d", "b", "c", "a"])]
+)
+def test_order(order, expected, make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pipe = make_pipe(tmpdir, order=order)
+        fill(pipe.input)
+        assert drain(pipe) == expected
+
+
+def test_queue_is_refreshed_incrementally(monkeypatch, make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = DirectoryTokenStore()
+        pipe = make_pipe(tmpdir, order="priority", store=store)
+        fill(pipe.input)
+
+        reads = []
+        real_read = store.read
+
+        def counting_read(path):
+            reads.append(path.name)
+            return real_read(path)
+
+        monkeypatch.setattr(store, "read", counting_read)
+        assert pipe.take_token().name == "d"
+        pipe.put_token()
+        # each token was read once to learn its priority, and d again to claim it
+        assert sorted(reads) == ["a.json", "b.json", "c.json", "d.bak", "d.json"]
+
+        # an urgent token jumps the queue; only it is read to place it
+        reads.clear()
+        dump_token(Token({"barcode": "e", "priority": 9}), pipe.input / "e.json")
+        assert pipe.take_token().name == "e"
+        assert reads == ["e.json", "e.bak"]
+
+
+@pytest.fixture
+def eager_switching():
+    """Switch threads as often as possible, to give any race its chance."""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+@pytest.mark.parametrize("order", ["fifo", "priority"])
+def test_threads_share_a_queue(order, eager_switching):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket = Path(tmpdir)
+        for n in range(500):
+            dump_token(Token({"barcode": str(n), "priority": n % 3}), bucket / f"{n}.json")
+        store = DirectoryTokenStore()
+        queue = TokenQueue(store, bucket, order)
+        claimed: list[str] = []
+        errors: list[Exception] = []
+
+        # note any two threads refreshing the queue at once
+        inside, overlaps = [], []
+        real_key = queue.key
+
+        def key(path):
+            inside.append(path)
+            overlaps.append(len(inside) > 1)
+            try:
+                return real_key(path)
+            finally:
+                inside.remove(path)
+
+        queue.key = key
+
+        def worker(owner: str):
+            try:
+                while (path := queue.pop()) is not None:
+                    if store.claim_file(path, owner) is not None:
+                        claimed.append(path.stem)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(f"w{n}",)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert not any(overlaps)
+        assert sorted(claimed) == sorted(str(n) for n in range(500))
+
+
+def test_sqlite_order(make_pipe):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SqliteTokenStore(Path(tmpdir) / "tokens.db")
+        pipe = make_pipe(tmpdir, order="priority", store=store)
+        bag = TokenBag()
+        for barcode in ["a", "b", "c"]:
+            bag.put_token(Token({"barcode": barcode, "priority": 1 if barcode == "b" else 0}))
+        bag.pour_into(pipe.input, store)
+        assert drain(pipe) == ["b", "a", "c"]
+
+
+def test_unknown_order():
+    with pytest.raises(ValueError):
+        Pipe(Path("/tmp"), Path("/tmp"), order="lifo")
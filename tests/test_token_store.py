@@ -0,0 +1,155 @@
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import DEFAULT_CODEC, Pipe, Pipeline
+from pipeline.token_bag import TokenBag
+from pipeline.token_store import DirectoryTokenStore, SqliteTokenStore, open_token_store
+
+
+def make_store(tmpdir: str, backend: str):
+    if backend == "sqlite":
+        return SqliteTokenStore(Path(tmpdir) / "tokens.db")
+    return DirectoryTokenStore()
+
+
+def make_buckets(tmpdir: str) -> tuple[Path, Path]:
+    pipe_in = Path(tmpdir) / "in"
+    pipe_out = Path(tmpdir) / "out"
+    pipe_in.mkdir()
+    pipe_out.mkdir()
+    return pipe_in, pipe_out
+
+
+def add(store, bucket: Path, barcode: str) -> None:
+    store.add(bucket, barcode, DEFAULT_CODEC.encode({"barcode": barcode}))
+
+
+@pytest.mark.parametrize("backend", ["directory", "sqlite"])
+def test_token_flow(backend):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = make_store(tmpdir, backend)
+        pipe_in, pipe_out = make_buckets(tmpdir)
+        for barcode in ["1", "2", "3"]:
+            add(store, pipe_in, barcode)
+        pipe = Pipe(pipe_in, pipe_out, worker_id="w1", store=store)
+
+        assert sorted(pipe.list_input_barcodes()) == ["1", "2", "3"]
+        assert pipe.take_token("2").name == "2"
+        assert store.counts(pipe_in) == {
+            "waiting_tokens": 2,
+            "errored_tokens": 0,
+            "in_process_tokens": 1,
+        }
+        assert store.scan(pipe_in)["in_process_tokens"] == ["2.w1.bak"]
+        pipe.token.put_prop("status", "done")
+        pipe.put_token()
+
+        pipe.take_token("1")
+        pipe.put_token(errorFlg=True)
+        pipe.take_token("3")
+        pipe.put_token_back()
+
+        assert store.scan(pipe_in) == {
+            "waiting_tokens": ["3.json"],
+            "errored_tokens": ["1.err"],
+            "in_process_tokens": [],
+        }
+        assert store.counts(pipe_out)["waiting_tokens"] == 1
+        assert store.load(pipe_out, "2") == {"barcode": "2", "status": "done"}
+        assert Pipe(pipe_in, pipe_out, store=store).take_token("1") is None
+
+
+def test_sqlite_claims_are_exclusive():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = make_store(tmpdir, "sqlite")
+        pipe_in, pipe_out = make_buckets(tmpdir)
+        barcodes = {str(n) for n in range(200)}
+        for barcode in barcodes:
+            add(store, pipe_in, barcode)
+
+        def drain(worker_id: str) -> list[str]:
+            pipe = Pipe(pipe_in, pipe_out, worker_id=worker_id, store=store)
+            taken = []
+            while tokens := pipe.take_tokens(5):
+                for token in tokens:
+                    taken.append(token.name)
+                    pipe.put_token(token=token)
+            return taken
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(drain, ["w1", "w2", "w3", "w4"]))
+
+        taken = [barcode for result in results for barcode in result]
+        assert sorted(taken) == sorted(barcodes)
+        assert store.counts(pipe_out)["waiting_tokens"] == len(barcodes)
+        assert store.counts(pipe_in) == {
+            "waiting_tokens": 0,
+            "errored_tokens": 0,
+            "in_process_tokens": 0,
+        }
+        assert store.locate("7") == [(pipe_out, "waiting")]
+
+
+def test_pipeline_uses_configured_store():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start, done = make_buckets(tmpdir)
+        database = Path(tmpdir) / "tokens.db"
+        pipeline = Pipeline(
+            {
+                "global": {"token_store": str(database)},
+                "buckets": [{"name": "start", "path": start}, {"name": "done", "path": done}],
+            }
+        )
+        assert isinstance(pipeline.store, SqliteTokenStore)
+
+        bag = TokenBag()
+        bag.add_books(["1", "2"])
+        bag.pour_into(start, pipeline.store)
+        assert list(start.iterdir()) == []
+        assert pipeline.summary["start"]["waiting_tokens"] == 2
+
+        pipe = pipeline.pipe("start", "done")
+        pipe.take_token()
+        pipe.put_token()
+        assert pipeline.summary["done"]["waiting_tokens"] == 1
+        assert len(pipeline.snapshot["start"]["waiting_tokens"]) == 1
+
+        # a second process opening the same database sees the same tokens
+        other = open_token_store(database)
+        assert other.counts(start)["waiting_tokens"] == 1
+
+
+def test_unknown_durability():
+    with pytest.raises(ValueError):
+        DirectoryTokenStore("sometimes")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with pytest.raises(ValueError):
+            SqliteTokenStore(Path(tmpdir) / "tokens.db", "sometimes")
+    assert isinstance(open_token_store(None), DirectoryTokenStore)
+
+
+@pytest.mark.parametrize("backend", ["directory", "sqlite"])
+def test_adding_replaces_errored_and_claimed_tokens(backend):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = make_store(tmpdir, backend)
+        pipe_in, pipe_out = make_buckets(tmpdir)
+        add(store, pipe_in, "1")
+        add(store, pipe_in, "2")
+        pipe = Pipe(pipe_in, pipe_out, worker_id="w1", store=store)
+        pipe.take_token("1")
+        pipe.put_token(errorFlg=True)
+        pipe.take_token("2")
+
+        store.add(pipe_in, "1", DEFAULT_CODEC.encode({"barcode": "1", "again": True}))
+        store.add(pipe_in, "2", DEFAULT_CODEC.encode({"barcode": "2", "again": True}))
+
+        assert sorted(store.barcodes(pipe_in)) == ["1", "2"]
+        assert list(store.barcodes(pipe_in, "error")) == []
+        assert store.load(pipe_in, "1") == {"barcode": "1", "again": True}
+        assert store.counts(pipe_in)["errored_tokens"] == 0
+        # the worker's copy still goes on
+        pipe.put_token()
+        assert store.load(pipe_out, "2") == {"barcode": "2"}
@@ -0,0 +1,42 @@
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from pipeline.plumbing import Token, dump_token
+from pipeline.watcher import InotifyWatcher, PollingWatcher, make_watcher
+
+
+def test_polling_watcher_times_out():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        watcher = make_watcher(Path(tmpdir), "poll")
+        assert isinstance(watcher, PollingWatcher)
+        assert watcher.wait(0.01) is False
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        make_watcher(Path("/tmp"), "carrier-pigeon")
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux-only")
+def test_inotify_watcher_wakes_on_token():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bucket = Path(tmpdir)
+        watcher = make_watcher(bucket, "inotify")
+        assert isinstance(watcher, InotifyWatcher)
+
+        assert watcher.wait(0.01) is False
+
+        def put():
+            time.sleep(0.05)
+            dump_token(Token({"barcode": "1234"}), bucket / "1234.json")
+
+        threading.Thread(target=put).start()
+        start = time.monotonic()
+        assert watcher.wait(5) is True
+        assert time.monotonic() - start < 1
+        watcher.close()